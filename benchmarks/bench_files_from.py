@@ -0,0 +1,75 @@
+"""Benchmark of include list sizes: shell brace expansion against --files-from over stdin
+
+For each batch size, builds the command the previous --include={...} code
+produced and runs it through bash, then streams the same paths NUL separated
+to a process's stdin as --files-from=- does, and reports argv size and wall
+time. With rsync installed the stdin side runs rsync --dry-run on a local
+tree, otherwise the paths are piped to cat.
+
+Usage: python -m benchmarks.bench_files_from [max batch size]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+DEFAULT_MAX_BATCH = 1000000
+FILES_PER_DIRECTORY = 1000
+
+
+def brace_command(paths):
+    """Return the shell command the brace expansion include list needed"""
+    include = "{" + ",".join(f"'{path}'" for path in paths) + "}"
+    return f"true --exclude='*' --include={include} src/ dst/"
+
+
+def time_brace(paths):
+    """Run the brace command through bash, return (argv bytes, seconds), seconds is None past ARG_MAX"""
+    command = brace_command(paths)
+    start = time.perf_counter()
+    try:
+        subprocess.run(["bash", "-c", command], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return len(command), None
+    return len(command), time.perf_counter() - start
+
+
+def time_files_from(paths, root, destination):
+    """Stream paths to --files-from=- (or cat), return (argv bytes, seconds)"""
+    if shutil.which("rsync"):
+        command = ["rsync", "-a", "--dry-run", "--files-from=-", "--from0", root + "/", destination]
+    else:
+        command = ["cat"]
+    data = b"".join(os.fsencode(path) + b"\0" for path in paths)
+    start = time.perf_counter()
+    subprocess.run(command, input=data, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return sum(len(arg) + 1 for arg in command), time.perf_counter() - start
+
+
+def main():
+    """Print argv size and wall time for growing batches"""
+    max_batch = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MAX_BATCH
+    sizes = [size for size in (1000, 10000, 100000, 1000000, 10000000) if size <= max_batch]
+    with tempfile.TemporaryDirectory() as workdir:
+        root = os.path.join(workdir, "src")
+        destination = os.path.join(workdir, "dst")
+        os.makedirs(destination)
+        paths = [f"dir{i // FILES_PER_DIRECTORY}/file{i}" for i in range(max(sizes))]
+        if shutil.which("rsync"):
+            for i, path in enumerate(paths):
+                if i % FILES_PER_DIRECTORY == 0:
+                    os.makedirs(os.path.join(root, os.path.dirname(path)))
+                open(os.path.join(root, path), "w", encoding="utf-8").close()
+        print(f"{'paths':>9} | {'brace argv':>12} {'brace time':>11} | {'stdin argv':>10} {'stdin time':>10}")
+        for size in sizes:
+            brace_size, brace_time = time_brace(paths[:size])
+            stdin_size, stdin_time = time_files_from(paths[:size], root, destination)
+            brace_elapsed = f"{brace_time:.3f}s" if brace_time is not None else "E2BIG"
+            print(f"{size:>9} | {brace_size:>12} {brace_elapsed:>11} | {stdin_size:>10} {stdin_time:>9.3f}s")
+
+
+if __name__ == "__main__":
+    main()
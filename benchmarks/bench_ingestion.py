@@ -0,0 +1,88 @@
+"""Benchmark of event ingestion throughput in FilesystemMonitor
+
+Feeds synthetic OPEN, MODIFY, MODIFY, CLOSE_WRITE sequences for N files
+through the monitor, either one event at a time (with lock housekeeping
+after every event, as the event loop used to do) or as inotify-sized
+batches, and reports events per second. Logging runs at INFO into
+/dev/null, as it would in production.
+
+Usage: python -m benchmarks.bench_ingestion [files] [batch size]
+"""
+import os
+import sys
+import time
+import tempfile
+from inotify_simple import Event, flags
+from fsrsync.utils.logs import Logger
+from fsrsync.utils.filesystem import FilesystemMonitor
+
+DEFAULT_FILES = 5000
+DEFAULT_BATCH_SIZE = 1000
+LOCKED_FILES = 10
+SEQUENCE = [flags.OPEN, flags.MODIFY, flags.MODIFY, flags.CLOSE_WRITE]
+
+
+def make_monitor(directory):
+    """Return a monitor watching directory"""
+    monitor = FilesystemMonitor(time_between_events=0)
+    monitor.add_destination(directory)
+    monitor.add_watch(directory, ["IN_MODIFY", "IN_CLOSE_WRITE", "IN_OPEN"])
+    return monitor
+
+
+def make_events(wd, names):
+    """Return the synthetic event stream for names"""
+    return [Event(wd, mask, 0, name) for name in names for mask in SEQUENCE]
+
+
+def run_per_event(monitor, events):
+    """Handle events one at a time with housekeeping after each"""
+    for event in events:
+        monitor.handle_event(event)
+        if hasattr(monitor, "run_housekeeping"):
+            monitor.run_housekeeping(force=True)
+
+
+def run_batched(monitor, events, batch_size):
+    """Handle events in batches with timed housekeeping"""
+    for start in range(0, len(events), batch_size):
+        monitor.handle_events(events[start:start + batch_size])
+        if hasattr(monitor, "run_housekeeping"):
+            monitor.run_housekeeping()
+
+
+def main():
+    """Run both ingestion modes and print events per second"""
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_FILES
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+    logger = Logger(filename=os.devnull)
+    logger.set_level("INFO")
+    for handler in logger.logger.handlers:
+        handler.setStream(open(os.devnull, "w", encoding="utf-8"))
+    with tempfile.TemporaryDirectory() as directory:
+        names = [f"file{i}" for i in range(file_count)]
+        for name in names:
+            with open(os.path.join(directory, name), "w", encoding="utf-8") as file:
+                file.write("x")
+        # Keep some files open for writing so lock housekeeping has work to do
+        held_open = [open(os.path.join(directory, name), "a", encoding="utf-8")
+                     for name in names[:LOCKED_FILES]]
+        modes = [("per event", run_per_event, ())]
+        if hasattr(FilesystemMonitor, "handle_events"):
+            modes.append((f"batches of {batch_size}", run_batched, (batch_size,)))
+        for label, runner, args in modes:
+            monitor = make_monitor(directory)
+            events = make_events(next(iter(monitor.watches)), names)
+            events += [Event(next(iter(monitor.watches)), flags.OPEN, 0, name)
+                       for name in names[:LOCKED_FILES]]
+            start = time.perf_counter()
+            runner(monitor, events, *args)
+            elapsed = time.perf_counter() - start
+            print(f"{label:>20}: {len(events):>8} events in {elapsed:8.3f}s, "
+                  f"{len(events) / elapsed:>10.0f} events/s")
+        for file in held_open:
+            file.close()
+
+
+if __name__ == "__main__":
+    main()
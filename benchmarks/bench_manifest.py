@@ -0,0 +1,60 @@
+"""Benchmark of the manifest diff that replaces a complete full sync
+
+Creates N files, records them in a fresh manifest, changes a few of them and
+reports how long the local diff takes and how many paths it hands to rsync.
+
+Usage: python -m benchmarks.bench_manifest [files] [changed]
+"""
+import os
+import sys
+import time
+import tempfile
+from fsrsync.utils.manifest import Manifest
+
+DEFAULT_FILES = 100000
+DEFAULT_CHANGED = 100
+FILES_PER_DIRECTORY = 500
+
+
+def make_tree(root, file_count):
+    """Create file_count files below root, return their paths"""
+    paths = []
+    for i in range(file_count):
+        directory = os.path.join(root, f"dir{i // FILES_PER_DIRECTORY}")
+        if i % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory)
+        path = os.path.join(directory, f"file{i}")
+        open(path, "w", encoding="utf-8").close()
+        paths.append(path)
+    return paths
+
+
+def main():
+    """Diff a tree against its manifest and print the timings"""
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_FILES
+    changed = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CHANGED
+    with tempfile.TemporaryDirectory() as workdir:
+        root = os.path.join(workdir, "tree")
+        paths = make_tree(root, file_count)
+        manifest = Manifest(os.path.join(workdir, "manifest.db"))
+        manifest.open()
+
+        start = time.perf_counter()
+        diff = manifest.diff("bench", root)
+        manifest.commit(diff)
+        print(f"{'first sync':>14}: {len(diff.sync_units()):>8} units, "
+              f"{time.perf_counter() - start:.3f}s to scan and record {len(diff.upserts)} entries")
+
+        step = max(1, file_count // changed)
+        for path in paths[::step][:changed]:
+            with open(path, "w", encoding="utf-8") as changed_file:
+                changed_file.write("changed")
+        start = time.perf_counter()
+        diff = manifest.diff("bench", root)
+        elapsed = time.perf_counter() - start
+        print(f"{'incremental':>14}: {len(diff.sync_units()):>8} units, {elapsed:.3f}s to diff {file_count} files")
+        manifest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Memory benchmark of the pending queues of FilesystemMonitor
+
+Queues N paths spread over nested directories, half for immediate sync and
+half for regular sync, with every tenth path also held in the locked files,
+and reports the bytes allocated per pending entry (records, paths and the
+index structures) as measured by tracemalloc.
+
+Usage: python -m benchmarks.bench_memory [sizes...]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from inotify_simple import flags
+from fsrsync.utils.logs import Logger
+from fsrsync.utils.coalescer import NetEvent, OP_CREATED, OP_MODIFIED
+from fsrsync.utils.filesystem import FilesystemMonitor
+
+DEFAULT_SIZES = [10000, 100000]
+FILES_PER_DIRECTORY = 100
+LOCKED_EVERY = 10
+
+
+def make_paths(count):
+    """Return (directory, name) pairs for count files below a few levels of directories"""
+    return [(f"/srv/data/project{i // 10000}/batch{i // FILES_PER_DIRECTORY}", f"file{i}.dat")
+            for i in range(count)]
+
+
+def fill(monitor, paths):
+    """Queue every path once, building each event path as the event loop would"""
+    for index, (directory, name) in enumerate(paths):
+        op = OP_CREATED if index % 2 else OP_MODIFIED
+        monitor.apply_net_event(NetEvent(f"{directory}/{name}", op))
+        if index % LOCKED_EVERY == 0:
+            monitor.track_open_state(f"{directory}/{name}", flags.OPEN)
+
+
+def measure(count):
+    """Return (bytes per entry, seconds) to queue count paths"""
+    paths = make_paths(count)
+    monitor = FilesystemMonitor(time_between_events=0)
+    monitor.add_destination("/srv/data")
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    fill(monitor, paths)
+    elapsed = time.perf_counter() - start
+    # Let the caller's path list go, the queues must keep their own copies alive
+    del paths
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return allocated / count, elapsed
+
+
+def main():
+    """Measure memory per pending entry for each size"""
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    logger = Logger(filename=os.devnull)
+    logger.set_level("INFO")
+    for size in sizes:
+        per_entry, elapsed = measure(size)
+        print(f"{size:>8} pending entries: {per_entry:8.0f} bytes/entry, queued in {elapsed:6.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark of "is this file open?" checks for the locked files of a tick
+
+Compares the psutil scan of every process per check with the shared
+OpenFileIndex built from one /proc scan, as the number of processes and
+locked files grows. Each locked file is held open by one `sleep` process.
+
+Usage: python -m benchmarks.bench_open_files
+"""
+import os
+import time
+import tempfile
+import subprocess
+import psutil
+from fsrsync.utils.openfiles import OpenFileIndex
+
+PROCESS_COUNTS = [100, 500]
+LOCKED_FILE_COUNTS = [10, 100]
+
+
+def is_file_open_process_scan(file_path):
+    """Previous implementation, scanning every process for each check"""
+    for proc in psutil.process_iter(['pid', 'open_files']):
+        try:
+            if any(f.path == file_path for f in proc.info['open_files'] or []):
+                return True
+        except (psutil.AccessDenied, psutil.NoSuchProcess):
+            pass
+    return False
+
+
+def time_checks(check, paths):
+    """Return the wall time of checking every path once"""
+    start = time.perf_counter()
+    for path in paths:
+        check(path)
+    return time.perf_counter() - start
+
+
+def main():
+    """Run the benchmark for each process and locked file count"""
+    index = OpenFileIndex()
+    print(f"{'processes':>10} {'locked':>8} {'psutil (s)':>12} {'index (s)':>12} {'speedup':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for process_count in PROCESS_COUNTS:
+            for locked_count in LOCKED_FILE_COUNTS:
+                paths = []
+                processes = []
+                for i in range(max(process_count, locked_count)):
+                    path = os.path.join(directory, f"file{i}")
+                    with open(path, "w", encoding="utf-8") as file:
+                        file.write("x")
+                    with open(path, "a", encoding="utf-8") as file:
+                        processes.append(subprocess.Popen(["sleep", "600"], stdout=file))
+                    if i < locked_count:
+                        paths.append(path)
+                try:
+                    old = time_checks(is_file_open_process_scan, paths)
+                    index.built_at = None  # Start the tick with a cold index
+                    new = time_checks(lambda path: index.is_open(path, for_write=True), paths)
+                finally:
+                    for process in processes:
+                        process.kill()
+                        process.wait()
+                print(f"{process_count:>10} {locked_count:>8} {old:>12.4f} {new:>12.4f} {old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Microbenchmark for the pending sync queues of FilesystemMonitor
+
+Compares adding and removing N distinct paths with the path-keyed queues
+against the linear set scans the queues used before.
+
+Usage: python -m benchmarks.bench_pending_queues [sizes...]
+"""
+import os
+import sys
+import time
+from fsrsync.utils.logs import Logger
+from fsrsync.utils.filesystem import File, FilesystemMonitor
+
+DEFAULT_SIZES = [1000, 5000, 20000]
+
+
+class LinearSetQueue:
+    """Queue implementation scanning a set of File objects, as before"""
+
+    def __init__(self):
+        self.files = set()
+
+    def add(self, file):
+        """Add file unless its path is already queued"""
+        for f in self.files:
+            if f.path == file.path:
+                return
+        self.files.add(file)
+
+    def delete(self, path):
+        """Delete file by path"""
+        to_remove = [f for f in self.files if f.path == path]
+        for f in to_remove:
+            self.files.discard(f)
+
+
+def time_it(function, *args):
+    """Return the wall time of a call in seconds"""
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def bench_linear(files):
+    """Add every file twice then delete them, linear scans"""
+    queue = LinearSetQueue()
+    for file in files + files:
+        queue.add(file)
+    for file in files:
+        queue.delete(file.path)
+
+
+def bench_keyed(queue, files):
+    """Add every file twice then delete them, path-keyed queues"""
+    for file in files + files:
+        queue.add_regular_sync_file(file)
+    for file in files:
+        queue.delete_regular_sync_file(file.path)
+
+
+def main():
+    """Run the benchmark for each size"""
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    logger = Logger(filename=os.devnull)
+    logger.set_level("WARNING")
+    queue = FilesystemMonitor().add_destination("/bench")
+    print(f"{'events':>10} {'linear (s)':>12} {'keyed (s)':>12} {'speedup':>10}")
+    for size in sizes:
+        files = [File(f"/bench/dir{i % 100}/file{i}") for i in range(size)]
+        linear = time_it(bench_linear, files)
+        keyed = time_it(bench_keyed, queue, files)
+        print(f"{size:>10} {linear:>12.4f} {keyed:>12.4f} {linear / keyed:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
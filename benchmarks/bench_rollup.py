@@ -0,0 +1,65 @@
+"""Benchmark of the include list rollup during a change storm
+
+Creates a tree as an archive extraction would (N files spread over nested
+directories, plus a directory where only a few files changed) and reports
+the number of include entries and the size of the rsync --include argument
+with and without the rollup.
+
+Usage: python -m benchmarks.bench_rollup [files]
+"""
+import os
+import sys
+import time
+import tempfile
+from fsrsync.utils.rollup import rollup_paths
+
+DEFAULT_FILES = 100000
+FILES_PER_DIRECTORY = 250
+DIRECTORIES_PER_PARENT = 20
+UNTOUCHED_FILES = 200
+CHANGED_UNTOUCHED = 5
+
+
+def make_tree(root, file_count):
+    """Create file_count files below root, return their paths"""
+    paths = []
+    for i in range(file_count):
+        directory = os.path.join(
+            root, "extract", f"part{i // (FILES_PER_DIRECTORY * DIRECTORIES_PER_PARENT)}",
+            f"dir{i // FILES_PER_DIRECTORY}")
+        if i % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory)
+        path = os.path.join(directory, f"file{i}")
+        open(path, "w", encoding="utf-8").close()
+        paths.append(path)
+    # A directory where only a handful of files changed must stay per-file
+    quiet = os.path.join(root, "quiet")
+    os.makedirs(quiet)
+    for i in range(UNTOUCHED_FILES):
+        open(os.path.join(quiet, f"file{i}"), "w", encoding="utf-8").close()
+    paths.extend(os.path.join(quiet, f"file{i}") for i in range(CHANGED_UNTOUCHED))
+    return paths
+
+
+def argument_size(paths):
+    """Return the length of the --include={...} argument for paths"""
+    return sum(len(path) + 3 for path in paths) + len("--include={}")
+
+
+def main():
+    """Roll up a change storm and print the include list sizes"""
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_FILES
+    with tempfile.TemporaryDirectory() as root:
+        paths = make_tree(root, file_count)
+        start = time.perf_counter()
+        units = rollup_paths(paths, root)
+        elapsed = time.perf_counter() - start
+        print(f"{'without rollup':>16}: {len(paths):>8} entries, {argument_size(paths):>10} bytes")
+        print(f"{'with rollup':>16}: {len(units):>8} entries, {argument_size(units):>10} bytes "
+              f"({elapsed:.3f}s)")
+        for unit in sorted(units)[:10]:
+            print(f"    {unit[len(root):]}")
+
+
+if __name__ == "__main__":
+    main()
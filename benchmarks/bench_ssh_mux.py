@@ -0,0 +1,148 @@
+"""Benchmark of a sync cycle's SSH connections with and without an SSH master
+
+A cycle is what RsyncManager.run does over SSH for a destination with one
+remote pre-sync and one remote post-sync command: pre hook, rsync, post hook,
+each one a session on the destination. Without multiplexing every session is
+a new ssh process doing a full handshake, with it the sessions are channels
+opened through SshMaster's control socket. rsync is stood in for by ssh
+running "true", the remote end of the transfer is not measured.
+
+Without a host argument the sessions go to an in-process paramiko server on
+localhost, so the numbers are the cost of the handshakes alone, without any
+network round trips. Give a user@host reachable with a key to measure a real
+destination.
+
+Usage: python -m benchmarks.bench_ssh_mux [cycles] [user@host [port [key]]]
+"""
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+import paramiko
+from fsrsync.utils.ssh_mux import SshMaster
+from fsrsync.utils.utils import run_process
+
+DEFAULT_CYCLES = 20
+SESSIONS_PER_CYCLE = 3  # Pre hook, rsync, post hook
+
+
+class NoopServer(paramiko.ServerInterface):
+    """SSH server accepting any key and exiting 0 from every command"""
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def finish():
+            time.sleep(0.001)  # Let the exec reply go out first
+            channel.send_exit_status(0)
+            channel.shutdown_write()
+            channel.close()
+
+        threading.Thread(target=finish, daemon=True).start()
+        return True
+
+
+def start_server(host_key):
+    """Serve NoopServer on a free localhost port, return the port"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+
+    def serve():
+        while True:
+            connection, _ = listener.accept()
+            # The exit status, EOF and close of a channel are separate small writes
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(host_key)
+            transport.start_server(server=NoopServer())
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+class BenchMaster(SshMaster):
+    """SshMaster that doesn't check host keys or read the user's ssh config"""
+
+    def connection_options(self):
+        return ["-F", "/dev/null", "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null",
+                "-o", "LogLevel=ERROR"] + super().connection_options()
+
+
+def direct_session(master):
+    """Run a command over a connection of its own"""
+    started, exit_code, _, stderr = run_process(
+        ["ssh"] + master.connection_options() + ["-o", "BatchMode=yes", "-T", master.destination, "true"]
+    )
+    if not started or exit_code != 0:
+        raise RuntimeError(f"ssh failed with exit code {exit_code}: {stderr}")
+
+
+def muxed_session(master):
+    """Run a command through the master"""
+    success, exit_code, _, stderr = master.run_command("true")
+    if not success:
+        raise RuntimeError(f"ssh through master failed with exit code {exit_code}: {stderr}")
+
+
+def time_cycles(cycles, session, master):
+    """Return the duration of each cycle in seconds"""
+    durations = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        if session is muxed_session:
+            master.ensure()
+        for _ in range(SESSIONS_PER_CYCLE):
+            session(master)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def report(label, durations):
+    """Print the median and mean cycle time"""
+    ordered = sorted(durations)
+    print(f"{label:<22} median {ordered[len(ordered) // 2] * 1000:8.1f} ms   "
+          f"mean {sum(durations) / len(durations) * 1000:8.1f} ms   "
+          f"per session {sum(durations) / len(durations) / SESSIONS_PER_CYCLE * 1000:6.1f} ms")
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CYCLES
+    with tempfile.TemporaryDirectory() as work:
+        if len(sys.argv) > 2:
+            destination = sys.argv[2]
+            port = int(sys.argv[3]) if len(sys.argv) > 3 else 22
+            key = sys.argv[4] if len(sys.argv) > 4 else None
+        else:
+            key = os.path.join(work, "id_ed25519")
+            subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", key], check=True)
+            port = start_server(paramiko.RSAKey.generate(2048))
+            destination = "bench@127.0.0.1"
+        master = BenchMaster(destination, key, port, os.path.join(work, "ssh"))
+        print(f"{cycles} cycles of {SESSIONS_PER_CYCLE} sessions to {destination} port {port}")
+        report("direct connections", time_cycles(cycles, direct_session, master))
+        start = time.perf_counter()
+        if not master.ensure():
+            sys.exit("Could not start the SSH master")
+        print(f"{'master startup':<22} {(time.perf_counter() - start) * 1000:8.1f} ms")
+        try:
+            report("through SSH master", time_cycles(cycles, muxed_session, master))
+        finally:
+            master.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
 import os
 import sys
 import time
+import uuid
+import atexit
 import threading
 import datetime
 from .utils.logs import Logger
 from .web_app import WebControl
 from .utils.rsync import RsyncManager
+from .utils.rollup import rollup_paths
+from .utils.ignore import IgnoreMatcher
+from .utils.journal import Journal
+from .utils.manifest import Manifest
+from .utils.fingerprint import FingerprintCache
+from .utils.merkle import DirectoryDigests, divergent_paths
+from .utils.ssh_mux import SshMaster
 from .utils.sentry import setup_sentry
 from .utils.utils import validate_path, fix_path_slashes
-from .utils.filesystem import FilesystemMonitor
+from .utils.filesystem import FilesystemMonitor, File
 from .utils.configuration import ConfigurationManager
 from .utils.web_client import WebClient
 from .utils.constants import (
@@ -18,13 +27,26 @@ from .utils.constants import (
     DEFAULT_FULL_SYNC,
     ZERO,
     DEFAULT_MAX_STATS,
-    EXCLUDE_ALL,
     CHECK_THREADS_SLEEP,
     WARNING_MAX_TIME_FILE_OPEN,
     DEFAULT_SSH_PORT,
     DEFAULT_WEB_SERVER_PORT,
     DEFAULT_LOGS,
-    TIME_EVENT_DELAY
+    TIME_EVENT_DELAY,
+    SCHEDULE_INTERVAL,
+    FINGERPRINT_CACHE_SIZE,
+    FINGERPRINT_WORKERS,
+    RSYNC_WORKERS,
+    SSH_CONTROL_DIR,
+    SYNC_RETRY_LIMIT,
+    SYNC_RETRY_BACKOFF,
+    DEBOUNCE_QUIET_PERIOD,
+    DEBOUNCE_MAX_STALENESS,
+    ROLLUP_MIN_FILES,
+    ROLLUP_MIN_RATIO,
+    LOCK_TRACKING_PROC,
+    LOCK_TRACKING_EVENTS,
+    LOCK_RECONCILE_INTERVAL,
 )
 
 
@@ -106,9 +128,68 @@ class SyncApplication:
         self.logs = self.config_manager.get_instance(config_file).config.get(
             "logs", DEFAULT_LOGS
         )
+        self.lock_tracking = self.config_manager.get_instance(config_file).config.get(
+            "lock_tracking", LOCK_TRACKING_PROC
+        )
+        # Pending files are journaled so a restart resumes where it stopped
+        self.journal = None
+        journal_path = self.config_manager.get_instance(config_file).config.get(
+            "journal_path", None
+        )
+        if journal_path and not full_sync:
+            self.journal = Journal(journal_path)
+            if not self.journal.open():
+                self.journal = None
+            else:
+                # Fsync the records still batched on exit
+                atexit.register(self.journal.close)
+        # Files synced to each destination, full syncs only transfer what changed since
+        self.manifest = None
+        manifest_path = self.config_manager.get_instance(config_file).config.get(
+            "manifest_path", None
+        )
+        if manifest_path:
+            self.manifest = Manifest(manifest_path)
+            if not self.manifest.open():
+                self.manifest = None
+            else:
+                atexit.register(self.manifest.close)
+        # Content fingerprints, files whose bytes didn't change since their last sync are skipped
+        self.fingerprints = None
+        if self.config_manager.get_instance(config_file).config.get("fingerprint_cache", False):
+            self.fingerprints = FingerprintCache(
+                max_bytes=self.config_manager.get_instance(config_file).config.get(
+                    "fingerprint_cache_size", FINGERPRINT_CACHE_SIZE // (1024 * 1024)
+                ) * 1024 * 1024,
+                workers=self.config_manager.get_instance(config_file).config.get(
+                    "fingerprint_workers", FINGERPRINT_WORKERS
+                ),
+            )
+        # Directory digests served to the peers syncing to this host, and compared with theirs
+        self.directory_digests = DirectoryDigests()
+        self.digest_roots = self.config_manager.get_instance(config_file).config.get(
+            "digest_roots", []
+        )
+        # SSH master connections, shared by the destinations reaching the same server the same way
+        self.ssh_masters = {}
+        self.ssh_control_dir = self.config_manager.get_instance(config_file).config.get(
+            "ssh_control_dir", SSH_CONTROL_DIR
+        )
         # Initialize global server locks
         self.fs_monitor = FilesystemMonitor(
-            time_between_events=self.time_event_delay)
+            time_between_events=self.time_event_delay,
+            lock_tracking=self.lock_tracking,
+            lock_reconcile_interval=self.config_manager.get_instance(config_file).config.get(
+                "lock_reconcile_interval", LOCK_RECONCILE_INTERVAL
+            ),
+            quiet_period=self.config_manager.get_instance(config_file).config.get(
+                "quiet_period", DEBOUNCE_QUIET_PERIOD
+            ),
+            max_staleness=self.config_manager.get_instance(config_file).config.get(
+                "max_staleness", DEBOUNCE_MAX_STALENESS
+            ),
+            journal=self.journal,
+        )
         self.global_server_locks = [ServerLocker(server_name=self.hostname,
                                                  is_self=True,
                                                  logger=self.logger)]
@@ -212,6 +293,10 @@ class SyncApplication:
                     continue
             self.setup_destination(dest_config)
 
+        # Drop journaled files of destinations that are no longer configured
+        if self.journal is not None:
+            self.journal.retain({destination["destination_name"] for destination in self.destinations})
+
         # If full sync is enabled, sync all files for each destination and exit
         if self.full_sync:
             self.logger.debug("Full sync enabled. Syncing all files...")
@@ -219,61 +304,89 @@ class SyncApplication:
                 self.logger.debug(
                     f"Running full sync for destination: {destination['rsync_manager'].destination}"
                 )
-                destination["rsync_manager"].run(exclude_list=destination.get("files_to_exclude", []))
+                self.run_full_sync(destination)
             sys.exit(ZERO)
         # Run check locations that need full sync in a separate thread
         self.run_check_locations_that_need_full_sync_in_thread()
 
     def run(self):
-        """Run the application to monitor filesystem events and trigger rsync"""
-        for event in self.fs_monitor.event_generator():
-            self.fs_monitor.handle_event(event)
+        """Run the application to monitor filesystem events and trigger rsync
 
-            # Check if there are files pending immediate sync
-            pending_immediate = len(self.fs_monitor.get_immediate_sync_files())
-            pending_regular = len(self.fs_monitor.get_regular_sync_files())
+        Each inotify read is ingested as one batch. Lock housekeeping runs on
+        its own timer, destinations are scheduled after a batch with events,
+        when files come out of their quiet period or every SCHEDULE_INTERVAL
+        seconds when idle.
+        """
+        last_schedule = ZERO
+        for events in self.fs_monitor.event_batch_generator():
+            if events or self.fs_monitor.has_pending_events():
+                self.fs_monitor.handle_events(events)
+                self.distribute_renames(self.fs_monitor.pop_renames())
+            self.fs_monitor.run_housekeeping()
+            promoted = self.fs_monitor.promote_quiet_files()
+            if events or promoted or time.time() - last_schedule >= SCHEDULE_INTERVAL:
+                last_schedule = time.time()
+                self.schedule_destinations()
+            if self.journal is not None:
+                self.journal.sync()
+
+    def destination_has_pending_work(self, destination):
+        """Check if a destination has files out of their quiet period or renames waiting to be synced
+
+        Regular sync files only count once there are event_queue_limit of them.
+        """
+        queue = destination["queue"]
+        ready_immediate = queue.count_ready_immediate_sync_files()
+        return (
+            ready_immediate > 0
+            or queue.count_ready_sync_files() - ready_immediate >= destination["event_queue_limit"]
+            or len(destination["pending_renames"]) > 0
+        )
+
+    def schedule_destinations(self):
+        """Run a sync for every destination with pending work and wait for them"""
+        pending_immediate = self.fs_monitor.count_immediate_sync_files()
+        pending_regular = self.fs_monitor.count_regular_sync_files()
+        self.logger.debug(
+            f"Pending immediate sync files:  {pending_immediate}, pending regular sync files: {pending_regular}"
+        )
+        threads = []
+        for destination in self.destinations:
+            # Check if destination is locked or has nothing to do, don't run if it is
+            if destination.get("locked_on_sync") or not self.destination_has_pending_work(destination):
+                continue
             self.logger.debug(
-                f"Pending immediate sync files:  {pending_immediate}, pending regular sync files: {pending_regular}"
+                f"Starting thread for destination: {destination['rsync_manager'].destination}"
             )
+            thread = threading.Thread(
+                target=self.manage_destination_event, args=(destination,)
+            )
+            thread.start()
+            threads.append(thread)
+        if not threads:
+            return
+        # Wait for all threads to finish
+        for thread in threads:
+            thread.join()
+        # All threads are back
+        self.logger.debug("All threads have finished")
+        # Clean all files that need to be deleted after sync
+        deleted_files_reg, deleted_files_imm = [], []
+        for queue, file in self.files_to_delete_after_sync_regular:
+            if file.synced_successfully:
+                queue.delete_regular_sync_file(file.path, file.synced_time)
+                deleted_files_reg.append((queue, file))
+        for queue, file in self.files_to_delete_after_sync_immediate:
+            if file.synced_successfully:
+                queue.delete_immediate_sync_file(file.path, file.synced_time)
+                deleted_files_imm.append((queue, file))
 
-            # Update event counts and check queue limits for each destination
-            if pending_immediate > 0 or pending_regular > 0:
-                self.logger.debug("Checking event queue limits for destinations...")
-                threads = []
-                for destination in self.destinations:
-                    # Call self.manage_destination_event(destination) in a separate thread
-                    # Check if destination is locked, don't run if it is
-                    if not destination.get("locked_on_sync"):
-                        self.logger.debug(
-                            f"Starting thread for destination: {destination['rsync_manager'].destination}"
-                        )
-                        thread = threading.Thread(
-                            target=self.manage_destination_event, args=(destination,)
-                        )
-                        thread.start()
-                        threads.append(thread)
-                # Wait for all threads to finish
-                for thread in threads:
-                    thread.join()
-                # All threads are back
-                self.logger.debug("All threads have finished")
-                # Clean all files that need to be deleted after sync
-                deleted_files_reg, deleted_files_imm = [], []
-                for file in self.files_to_delete_after_sync_regular:
-                    if file.synced_successfully:
-                        self.fs_monitor.delete_regular_sync_file(file)
-                        deleted_files_reg.append(file)
-                for file in self.files_to_delete_after_sync_immediate:
-                    if file.synced_successfully:
-                        self.fs_monitor.delete_immediate_sync_file(file)
-                        deleted_files_imm.append(file)
-
-                # Remove files from the list
-                for file in deleted_files_reg:
-                    self.files_to_delete_after_sync_regular.remove(file)
-                for file in deleted_files_imm:
-                    self.files_to_delete_after_sync_immediate.remove(file)
-                self.logger.debug("All files have been deleted after sync")
+        # Remove files from the list
+        for entry in deleted_files_reg:
+            self.files_to_delete_after_sync_regular.remove(entry)
+        for entry in deleted_files_imm:
+            self.files_to_delete_after_sync_immediate.remove(entry)
+        self.logger.debug("All files have been deleted after sync")
 
     def setup_destination(self, dest_config):
         """Set up a destination with an rsync manager and inotify watcher"""
@@ -303,6 +416,12 @@ class SyncApplication:
             )
             return
 
+        ssh_master = None
+        if dest_config.get("ssh_multiplexing", False):
+            ssh_master = self.get_ssh_master(
+                destination, dest_config.get("ssh_key", None), dest_config.get("ssh_port", DEFAULT_SSH_PORT)
+            )
+
         rsync_manager = RsyncManager(
             destination=destination,
             destination_path=destination_path,
@@ -327,6 +446,8 @@ class SyncApplication:
             post_sync_commands_checkexit_remote=dest_config.get(
                 "post_sync_commands_checkexit_remote", []
             ),
+            workers=dest_config.get("rsync_workers", RSYNC_WORKERS),
+            ssh_master=ssh_master,
         )
         event_queue_limit = dest_config["event_queue_limit"]
         destination_config = {
@@ -343,6 +464,8 @@ class SyncApplication:
             "files_to_exclude": dest_config.get("files_to_exclude", []),
             "remote_hostname": dest_config.get("remote_hostname", None),
             "location_last_full_sync": None,
+            "pending_renames": [],
+            "fingerprint_snapshot": {},  # Fingerprints of the files being synced (path -> state)
             "web_client": WebClient(
                 dest_config.get("control_server_host", ""),
                 dest_config.get("control_server_port", DEFAULT_WEB_SERVER_PORT),
@@ -350,8 +473,31 @@ class SyncApplication:
                 dest_config.get("control_server_lock", False)
             ),
             "max_wait_locked": dest_config.get("max_wait_locked", WAIT_60_SEC),
+            "verify_with_digests": dest_config.get("verify_with_digests", False),
+            "partitioned_full_sync": dest_config.get("partitioned_full_sync", False),
+            "sync_retry_limit": dest_config.get("sync_retry_limit", SYNC_RETRY_LIMIT),
+            "sync_retry_backoff": dest_config.get("sync_retry_backoff", SYNC_RETRY_BACKOFF),
+            "rollup_min_files": dest_config.get("rollup_min_files", ROLLUP_MIN_FILES),
+            "rollup_min_ratio": dest_config.get("rollup_min_ratio", ROLLUP_MIN_RATIO),
+            "ignore_matcher": IgnoreMatcher(
+                path,
+                dest_config.get("files_to_exclude", []),
+                dest_config.get("extensions_to_ignore", []),
+            ),
         }
 
+        # Changes below path are routed to this queue at ingestion
+        destination_config["destination_name"] = f"{path} -> {destination}:{destination_path}"
+        destination_config["queue"] = self.fs_monitor.add_destination(
+            path, destination_config["ignore_matcher"], destination_config["destination_name"]
+        )
+        # Files pending before a restart were restored from the journal, only run a full sync when it is due
+        if self.journal is not None:
+            last_full_sync = self.journal.last_full_sync(destination_config["destination_name"])
+            if last_full_sync is not None:
+                destination_config["location_last_full_sync"] = datetime.datetime.fromtimestamp(last_full_sync)
+        if destination_config["location_last_full_sync"] is None and not dest_config.get("initial_full_sync", True):
+            destination_config["location_last_full_sync"] = datetime.datetime.now()
         self.logger.debug(f"Destination config: {destination_config}")
 
         # Set filesystem warning time
@@ -368,14 +514,29 @@ class SyncApplication:
             events.append("IN_CLOSE_WRITE")
         if "IN_OPEN" not in events:
             events.append("IN_OPEN")
+        # Refcounting opens needs every close and the writes in between
+        if self.lock_tracking == LOCK_TRACKING_EVENTS:
+            for event in ("IN_CLOSE_NOWRITE", "IN_MODIFY"):
+                if event not in events:
+                    events.append(event)
         # If full sync is not enabled, add the path to the inotify watcher since its not needed for full sync
         if not self.full_sync:
-            self.fs_monitor.add_watch(path, events)
+            self.fs_monitor.add_watch(
+                path, events, recursive=dest_config.get("recursive_watch", False)
+            )
 
         # Add destination to the list of destinations
         self.remote_hosts.append(destination.split("@")[1])
         self.destinations.append(destination_config)
 
+    def get_ssh_master(self, destination, ssh_key, ssh_port):
+        """Return the SSH master connecting to destination with ssh_key and ssh_port, creating it if needed"""
+        key = (destination, ssh_key, ssh_port)
+        if key not in self.ssh_masters:
+            self.ssh_masters[key] = SshMaster(destination, ssh_key, ssh_port, self.ssh_control_dir)
+            atexit.register(self.ssh_masters[key].stop)
+        return self.ssh_masters[key]
+
     def validate_hostname_config(self):
         """Validate the hostname in the configuration file"""
         hostname = self.config_manager.get_hostname()
@@ -385,18 +546,47 @@ class SyncApplication:
             )
             sys.exit(1)
 
+    def distribute_renames(self, renames):
+        """Hand local renames to the destinations that have to apply them"""
+        for rename in renames:
+            for destination in self.destinations:
+                destination_path = destination.get("path").rstrip("/") + "/"
+                src_inside = rename.src.startswith(destination_path)
+                dst_inside = rename.path.startswith(destination_path)
+                if src_inside and dst_inside:
+                    destination["pending_renames"].append(rename)
+                elif src_inside:
+                    # Moved out of this destination, sync it as a delete
+                    destination["queue"].add_regular_sync_file(File(rename.src, rename.mask))
+                elif dst_inside and destination["queue"].accepts(rename.path):
+                    # Moved into this destination, sync it as new
+                    destination["queue"].add_immediate_sync_file(File(rename.path, rename.mask))
+
+    def apply_pending_renames(self, destination):
+        """Apply pending renames on the destination before any rsync"""
+        renames = destination["pending_renames"]
+        destination["pending_renames"] = []
+        for rename in renames:
+            if destination["rsync_manager"].rename(rename.src, rename.path):
+                self.logger.info(
+                    f"Renamed {rename.src} to {rename.path} on {destination['rsync_manager'].destination}"
+                )
+                continue
+            # Fall back to syncing both paths, rsync will transfer and delete as needed
+            destination["queue"].add_regular_sync_file(File(rename.src, rename.mask))
+            destination["queue"].add_immediate_sync_file(File(rename.path, rename.mask))
+
     def immediate_sync_files_for_destination(
         self, destination, immediate_sync_files_for_path
     ):
         """Check if we have immedeate sync files for a destination"""
-        # Grab extensions to ignore
-        extensions_to_ignore = destination.get("extensions_to_ignore", [])
-        destination_path = destination.get("path")
-        # Remove files with extensions to ignore
+        ignore_matcher = destination["ignore_matcher"]
+        # Remove ignored files
         filtered_files = []
         for file in immediate_sync_files_for_path:
-            if file.extension in extensions_to_ignore:
+            if ignore_matcher.matches(file.path):
                 self.logger.debug(f"Ignoring file {file.path} from immediate sync")
+                destination["queue"].delete_immediate_sync_file(file.path)
             else:
                 self.logger.debug(f"Adding file {file.path} to immediate sync")
                 filtered_files.append(file)
@@ -405,6 +595,7 @@ class SyncApplication:
         for file in filtered_files:
             files_to_sync_paths.append(file.path)
         if len(files_to_sync_paths) > 0:
+            files_to_sync_paths = self.rollup_include_list(destination, files_to_sync_paths)
             # Only sync the immediate sync files
             time_sync_start = time.time()
             self.logger.info(
@@ -416,19 +607,18 @@ class SyncApplication:
                 self.logger.error(
                     f"Could not run immediate sync for destination {destination.get('remote_hostname', None)} to global server locks. Skipping immediate sync..."
                 )
+                self.requeue_files(destination, filtered_files)
                 self.statistics_generator(
                     destination,
-                    self.fs_monitor.get_regular_sync_files(destination_path),
-                    self.fs_monitor.get_immediate_sync_files(destination_path),
+                    destination["queue"].get_regular_sync_files(),
+                    destination["queue"].get_immediate_sync_files(),
                     sync_result=False,
                     notification_result=notification,
                     log_type="immediate",
                 )
                 return
-            # ensure_excludes should be EXCLUDE_ALL + destination.get("files_to_exclude", [])
-            ensure_excludes = destination.get("files_to_exclude", [])
-            ensure_excludes.extend(EXCLUDE_ALL)
-            rsync_result, process_result = destination["rsync_manager"].run(
+            ensure_excludes = destination["ignore_matcher"].rsync_excludes()
+            rsync_result, process_result, report = destination["rsync_manager"].run(
                 exclude_list=ensure_excludes, include_list=files_to_sync_paths
             )
             if rsync_result:
@@ -437,31 +627,101 @@ class SyncApplication:
                 )
             else:
                 self.logger.error(
-                    f"Rsync failed for destination {destination['rsync_manager'].destination}, not clearing pending files..."
+                    f"Rsync failed for destination {destination['rsync_manager'].destination}, requeueing failed files..."
                 )
+            self.update_manifest(destination, self.synced_paths(destination, files_to_sync_paths, report["outcome"]))
             # Remove destination from global server locks
             notification = self.remove_remote_global_server_locks(destination)
             self.logger.debug(
                 f"Immediate removed destination {destination.get('remote_hostname', None)} to global server locks. Result: {notification}"
             )
-            # Remove these files from the immediate sync list
-            for file in self.fs_monitor.get_immediate_sync_files():
-                file.synced_successfully = True
-                file.synced_time = time_sync_start
-                self.files_to_delete_after_sync_immediate.append(file)
-                destination.get("web_client").delete_file_pending_for_path(file.path)
+            # Remove the synced files from the immediate sync list
+            synced_files = self.acknowledge_files(
+                destination,
+                filtered_files,
+                time_sync_start,
+                self.files_to_delete_after_sync_immediate,
+                report["outcome"],
+            )
+            self.record_fingerprints(destination, synced_files)
             self.statistics_generator(
                 destination,
-                self.fs_monitor.get_regular_sync_files(destination_path),
-                self.fs_monitor.get_immediate_sync_files(destination_path),
+                destination["queue"].get_regular_sync_files(),
+                destination["queue"].get_immediate_sync_files(),
                 sync_result=rsync_result,
                 notification_result=notification,
-                log_type="regular"
+                log_type="regular",
+                report=report,
             )
             # Clear files to sync paths
             files_to_sync_paths.clear()
             filtered_files.clear()
 
+    def acknowledge_files(self, destination, files, sync_start, delete_after_sync, outcome):
+        """Mark the files rsync synced as done and requeue those it failed to sync
+
+        outcome is the SyncOutcome in the report of the run that synced the
+        files. Files that vanished before they were sent are dropped with the
+        synced ones, both are added to delete_after_sync to leave the queue
+        unless they changed since sync_start. Return the synced files.
+        """
+        rsync_manager = destination["rsync_manager"]
+        synced, failed = [], []
+        for file in files:
+            status = rsync_manager.path_outcome(file.path, outcome)
+            if status == "failed":
+                failed.append(file)
+                continue
+            if status == "vanished":
+                self.logger.debug(f"File {file.path} vanished before it was synced, dropping it")
+            else:
+                synced.append(file)
+            file.attempts = 0
+            file.retry_at = 0
+            file.synced_successfully = True
+            file.synced_time = sync_start
+            delete_after_sync.append((destination["queue"], file))
+            destination.get("web_client").delete_file_pending_for_path(file.path)
+        self.requeue_files(destination, failed)
+        return synced
+
+    def requeue_files(self, destination, files):
+        """Retry files whose sync failed after a backoff, files out of retries are left to the next full sync"""
+        for file in files:
+            if destination["queue"].requeue(file, destination["sync_retry_backoff"], destination["sync_retry_limit"]):
+                self.logger.warning(
+                    f"Sync of {file.path} to {destination['rsync_manager'].destination} failed "
+                    f"{file.attempts} times, retrying in {file.retry_at - time.time():.0f}s"
+                )
+            else:
+                self.logger.error(
+                    f"Sync of {file.path} to {destination['rsync_manager'].destination} failed "
+                    f"{file.attempts} times, leaving it to the next full sync"
+                )
+                destination["queue"].delete_regular_sync_file(file.path)
+                destination["queue"].delete_immediate_sync_file(file.path)
+                destination.get("web_client").delete_file_pending_for_path(file.path)
+
+    def synced_paths(self, destination, paths, outcome):
+        """Return the paths of an include list a run didn't fail to sync, given its SyncOutcome"""
+        rsync_manager = destination["rsync_manager"]
+        return [path for path in paths if rsync_manager.path_outcome(path, outcome) != "failed"]
+
+    def rollup_include_list(self, destination, paths, keep_out=None):
+        """Sync directories as a whole once enough of their files changed, keeping the include list small"""
+        units = rollup_paths(
+            paths,
+            destination.get("path"),
+            destination["rollup_min_files"],
+            destination["rollup_min_ratio"],
+            keep_out,
+        )
+        if len(units) < len(paths):
+            self.logger.info(
+                f"Rolled up {len(paths)} paths into {len(units)} sync units for destination {destination['rsync_manager'].destination}"
+            )
+        return units
+
     def process_regular_sync(self, destination, events):
         """Process regular sync for a destination"""
         # Trigger rsync when event count reaches the limit
@@ -485,6 +745,7 @@ class SyncApplication:
             for event in events:
                 if event.path not in should_exclude_paths:
                     include.append(event.path)
+            include = self.rollup_include_list(destination, include, should_exclude_paths)
 
             # Add destination to global server locks if needed
             notification = self.notify_remote_global_server_locks(destination)
@@ -492,19 +753,18 @@ class SyncApplication:
                 self.logger.info(
                     f"Could not run regular sync for destination {destination.get('remote_hostname', None)} to global server locks. Skipping regular sync..."
                 )
+                self.requeue_files(destination, events)
                 self.statistics_generator(
                     destination,
-                    self.fs_monitor.get_regular_sync_files(destination_path),
-                    self.fs_monitor.get_immediate_sync_files(destination_path),
+                    destination["queue"].get_regular_sync_files(),
+                    destination["queue"].get_immediate_sync_files(),
                     sync_result=False,
                     notification_result=notification,
                     log_type="regular",
                 )
                 return
-            # ensure_excludes should be EXCLUDE_ALL + destination.get("files_to_exclude", [])
-            ensure_excludes = destination.get("files_to_exclude", [])
-            ensure_excludes.extend(EXCLUDE_ALL)
-            rsync_result, app_code_result = destination["rsync_manager"].run(
+            ensure_excludes = destination["ignore_matcher"].rsync_excludes()
+            rsync_result, app_code_result, report = destination["rsync_manager"].run(
                 exclude_list=ensure_excludes, include_list=include
             )
             if rsync_result:
@@ -513,8 +773,9 @@ class SyncApplication:
                 )
             else:
                 self.logger.error(
-                    f"Rsync failed for destination {destination['rsync_manager'].destination}, not clearing pending files..."
+                    f"Rsync failed for destination {destination['rsync_manager'].destination}, requeueing failed files..."
                 )
+            self.update_manifest(destination, self.synced_paths(destination, include, report["outcome"]))
             # Remove destination from global server locks
             notification = self.remove_remote_global_server_locks(destination)
             self.logger.debug(
@@ -522,18 +783,24 @@ class SyncApplication:
             )
             self.statistics_generator(
                 destination,
-                self.fs_monitor.get_regular_sync_files(destination_path),
-                self.fs_monitor.get_immediate_sync_files(destination_path),
+                destination["queue"].get_regular_sync_files(),
+                destination["queue"].get_immediate_sync_files(),
                 sync_result=rsync_result,
                 notification_result=notification,
                 log_type="regular",
+                report=report,
             )
-            # Remove these files from the regular sync list
-            for file in events:
-                file.synced_successfully = True
-                file.synced_time = time_sync_start
-                self.files_to_delete_after_sync_regular.append(file)
-                destination.get("web_client").delete_file_pending_for_path(file.path)
+            # Remove the synced files from the regular sync list, locked files left out are retried later
+            excluded = set(should_exclude_paths)
+            self.requeue_files(destination, [file for file in events if file.path in excluded])
+            synced_files = self.acknowledge_files(
+                destination,
+                [file for file in events if file.path not in excluded],
+                time_sync_start,
+                self.files_to_delete_after_sync_regular,
+                report["outcome"],
+            )
+            self.record_fingerprints(destination, synced_files)
 
     def manage_destination_event(self, destination):
         """Manage events for a destination"""
@@ -565,51 +832,35 @@ class SyncApplication:
                 )
                 return
 
-        destination_path = destination.get("path")
         # Check destination
         self.logger.debug(f"Checking destination: {destination}")
-        # Grab extensions to ignore
-        extensions_to_ignore = destination.get("extensions_to_ignore", [])
-        self.logger.debug(f"Extensions to ignore: {extensions_to_ignore}")
-        # Remove files with those extensions from the regular sync list and immediate sync list
-        files_to_remove = []
-        for file in self.fs_monitor.get_regular_sync_files(destination_path):
-            if file.extension in extensions_to_ignore:
-                self.logger.debug(
-                    f"Removing file {file.path} from regular sync as it has an extension to ignore"
-                )
-                files_to_remove.append(file)
-        for file in files_to_remove:
-            destination.get("web_client").delete_file_pending_for_path(file.path)
-            self.fs_monitor.delete_regular_sync_file(file.path)
-        files_to_remove = []
-        for file in self.fs_monitor.get_immediate_sync_files(destination_path):
-            if file.extension in extensions_to_ignore:
-                self.logger.debug(
-                    f"Removing file {file.path} from immediate sync as it has an extension to ignore"
-                )
-                files_to_remove.append(file)
-        for file in files_to_remove:
-            self.fs_monitor.delete_immediate_sync_file(file.path)
-            destination.get("web_client").delete_file_pending_for_path(file.path)
+        # Ignored files are never routed to the destination queue, no need to filter them here
+        queue = destination["queue"]
 
         destination["locked_on_sync"] = True
+        self.apply_pending_renames(destination)
         time_started = time.time()
+        destination["fingerprint_snapshot"].clear()
         # Check if we have immedeate sync files
+        # Only files out of their quiet period are synced, the rest wait for a later run
         self.immediate_sync_files_for_destination(
             destination,
-            self.fs_monitor.get_immediate_sync_files(destination_path),
+            self.skip_unchanged_files(
+                destination,
+                queue.get_immediate_sync_files(ready_only=True),
+                time_started,
+                self.files_to_delete_after_sync_immediate,
+            ),
         )
-        # Process regular sync
+        # Process regular sync, files below event_queue_limit stay queued for a later run
         self.process_regular_sync(
-            destination, self.fs_monitor.get_regular_sync_files(destination_path)
-        )
-        # After every sync clear pending files
-        self.fs_monitor.delete_regular_sync_files_for_path(
-            destination_path, time_started
-        )
-        self.fs_monitor.delete_immediate_sync_files_for_path(
-            destination_path, time_started
+            destination,
+            self.skip_unchanged_files(
+                destination,
+                queue.get_regular_sync_files(ready_only=True),
+                time_started,
+                self.files_to_delete_after_sync_regular,
+            ),
         )
         destination["locked_on_sync"] = False
 
@@ -713,8 +964,9 @@ class SyncApplication:
         sync_result=False,
         notification_result=False,
         log_type="regular",
+        report=None,
     ):
-        """Generator to get statistics for each destination"""
+        """Generator to get statistics for each destination, report is the one of the rsync run"""
         if destination is None:
             return None
         convert_regular_sync_files_to_list = [
@@ -737,6 +989,8 @@ class SyncApplication:
             "result": sync_result,
             "notification_result": notification_result,
             "log_type": log_type,
+            "shards": (report or {}).get("shards", []),
+            "rsync": (report or {}).get("stats", {}),
         }
         # If we have more than 10 statistics, remove the oldest one
         if len(destination["statistics"]) >= self.max_stats:
@@ -750,24 +1004,24 @@ class SyncApplication:
             self.logger.debug("Checking global server locks...")
             self.check_global_server_locks()
             self.logger.debug("Checking locations that need full sync...")
+            self.directory_digests.expire()
             for destination in self.destinations:
                 path = destination.get("path")
                 if destination.get("location_last_full_sync") is None:
                     self.logger.debug(
                         f"Location {path} has not been synced. Running full sync..."
                     )
-                    ensure_excludes = destination.get("files_to_exclude", None)
-                    sync_result = destination["rsync_manager"].run(
-                        exclude_list=ensure_excludes
-                        )
+                    rsync_result, process_result, report = self.run_full_sync(destination)
                     destination["location_last_full_sync"] = datetime.datetime.now()
+                    self.record_full_sync(destination)
                     self.statistics_generator(
                         destination,
-                        self.fs_monitor.get_regular_sync_files(path),
-                        self.fs_monitor.get_immediate_sync_files(path),
-                        sync_result=sync_result,
+                        destination["queue"].get_regular_sync_files(),
+                        destination["queue"].get_immediate_sync_files(),
+                        sync_result=(rsync_result, process_result),
                         notification_result=None,
                         log_type="full",
+                        report=report,
                     )
                 else:
                     # Check if we need to run a full sync
@@ -784,8 +1038,9 @@ class SyncApplication:
                         self.logger.debug(
                             f"Location {path} has not been synced in over {full_sync_interval} minutes. Running full sync..."
                         )
-                        destination["rsync_manager"].run(exclude_list=ensure_excludes)
+                        self.run_full_sync(destination)
                         destination["location_last_full_sync"] = current_time
+                        self.record_full_sync(destination)
                 # Remove destination from global server locks
                 notification = self.remove_remote_global_server_locks(destination)
                 self.logger.debug(
@@ -796,6 +1051,163 @@ class SyncApplication:
             )
             time.sleep(CHECK_THREADS_SLEEP)
 
+    def run_full_sync(self, destination):
+        """Run a full sync of a destination
+
+        With a manifest, the tree is compared with the files recorded at the
+        last sync and only new and changed files, and the directories of
+        deleted ones, are handed to rsync. The manifest is only updated once
+        rsync succeeded.
+
+        :return: (rsync success, post-sync commands success, report), as RsyncManager.run
+        :rtype: tuple
+        """
+        name = destination["destination_name"]
+        excludes = destination["ignore_matcher"].rsync_excludes()
+        if destination["verify_with_digests"]:
+            paths = self.reconcile_destination(destination)
+            if paths is not None:
+                if not paths:
+                    self.logger.info(f"{name} matches its source, nothing to sync")
+                    return True, True, {}
+                self.logger.info(f"Full sync of {name}: {len(paths)} paths differ from the source")
+                include = self.rollup_include_list(destination, paths)
+                sync_result = destination["rsync_manager"].run(
+                    exclude_list=excludes, include_list=include
+                )
+                if sync_result and sync_result[0]:
+                    self.update_manifest(destination, include)
+                return sync_result
+            self.logger.warning(f"Could not compare digests with {name}, running a full sync...")
+        if self.manifest is None:
+            return self.run_complete_sync(destination, excludes)
+        first_sync = self.manifest.is_empty(name)
+        # The tree is compared before rsync runs, files changed during the transfer show up next time
+        diff = self.manifest.diff(name, destination["path"], destination["ignore_matcher"])
+        if first_sync:
+            self.logger.info(f"No manifest for {name} yet, running a complete full sync...")
+            sync_result = self.run_complete_sync(destination, excludes)
+        elif not diff.has_changes():
+            self.logger.info(f"Nothing changed below {destination['path']} since the last sync of {name}")
+            return True, True, {}
+        else:
+            self.logger.info(
+                f"Full sync of {name}: {len(diff.changed)} changed and {len(diff.deleted)} deleted paths since the last sync"
+            )
+            include = self.rollup_include_list(destination, diff.sync_units())
+            sync_result = destination["rsync_manager"].run(
+                exclude_list=excludes, include_list=include
+            )
+        if sync_result and sync_result[0]:
+            self.manifest.commit(diff)
+        return sync_result
+
+    def skip_unchanged_files(self, destination, files, check_start, delete_after_sync):
+        """Return the files whose content or metadata changed since they were last synced to a destination
+
+        The unchanged files are acknowledged and added to delete_after_sync,
+        unless they changed again since check_start.
+        """
+        if self.fingerprints is None or not files:
+            return files
+        to_sync, skipped, snapshot = self.fingerprints.filter_unchanged(destination["destination_name"], files)
+        destination["fingerprint_snapshot"].update(snapshot)
+        if skipped:
+            self.logger.info(
+                f"Skipping {len(skipped)} files unchanged since their last sync to {destination['rsync_manager'].destination}"
+            )
+        for file in skipped:
+            file.synced_successfully = True
+            file.synced_time = check_start
+            delete_after_sync.append((destination["queue"], file))
+            destination.get("web_client").delete_file_pending_for_path(file.path)
+        return to_sync
+
+    def record_fingerprints(self, destination, files):
+        """Remember the fingerprints of files synced to a destination"""
+        if self.fingerprints is None:
+            return
+        snapshot = destination["fingerprint_snapshot"]
+        synced = {file.path: snapshot.pop(file.path) for file in files if file.path in snapshot}
+        self.fingerprints.record_synced(destination["destination_name"], synced)
+
+    def run_complete_sync(self, destination, excludes):
+        """Rsync the whole path of a destination, split into subtrees synced concurrently if configured"""
+        return destination["rsync_manager"].run(
+            exclude_list=excludes,
+            partitioned=destination["partitioned_full_sync"],
+            ignore=destination["ignore_matcher"],
+        )
+
+    def reconcile_destination(self, destination):
+        """Return the local paths that differ on a destination, None if its digests can't be fetched
+
+        Directory digests are compared from the root down with the ones the
+        destination's control server reports, only descending into
+        directories whose digests differ. Digests are only cached for this
+        pass on both ends, a tree changed since the last pass is never
+        reported from the cache.
+        """
+        scope = uuid.uuid4().hex
+        ignore_matcher = destination["ignore_matcher"]
+        local_root = destination["path"].rstrip("/") + "/"
+        remote_root = destination["rsync_manager"].destination_path.rstrip("/") + "/"
+        to_sync = []
+        directories = [""]
+        while directories:
+            directory = directories.pop()
+            remote = destination["web_client"].get_directory_digests(
+                remote_root,
+                remote_root + directory,
+                ignore_matcher.patterns,
+                ignore_matcher.extensions,
+                scope,
+            )
+            if remote.get("status") is not True:
+                self.logger.error(f"Could not get digests of {remote_root + directory}: {remote.get('message')}")
+                return None
+            local = self.directory_digests.children(local_root + directory, ignore_matcher, scope)
+            if local["digest"] == remote.get("digest"):
+                continue
+            descend, paths = divergent_paths(local, remote, directory)
+            directories.extend(descend)
+            to_sync.extend(local_root + path for path in paths)
+        return to_sync
+
+    def get_directory_digests(self, root, path, patterns=None, extensions=None, scope=None):
+        """Return the digests of the entries of a directory below root, for a peer reconciling with this host"""
+        real_root = os.path.realpath(root)
+        real_path = os.path.realpath(path)
+        allowed_roots = [os.path.realpath(allowed) for allowed in self.digest_roots]
+        if not any(real_root == allowed or real_root.startswith(allowed.rstrip("/") + "/")
+                   for allowed in allowed_roots):
+            return {"status": False, "message": f"{root} is not below any of digest_roots"}
+        if real_path != real_root and not real_path.startswith(real_root.rstrip("/") + "/"):
+            return {"status": False, "message": f"{path} is not below {root}"}
+        if not os.path.isdir(real_path):
+            return {"status": True, "digest": None, "directories": {}, "files": {}}
+        result = self.directory_digests.children(path, IgnoreMatcher(root, patterns, extensions), scope)
+        result["status"] = True
+        return result
+
+    def update_manifest(self, destination, paths):
+        """Record paths synced from the event stream in the manifest"""
+        if self.manifest is not None:
+            self.manifest.record_synced(
+                destination["destination_name"],
+                destination["path"],
+                paths,
+                destination["ignore_matcher"],
+            )
+
+    def record_full_sync(self, destination):
+        """Record the last full sync of a destination in the journal"""
+        if self.journal is not None:
+            self.journal.record_full_sync(
+                destination["destination_name"],
+                destination["location_last_full_sync"].timestamp(),
+            )
+
     def run_check_locations_that_need_full_sync_in_thread(self):
         """Run check locations that need full sync in a separate thread"""
         thread = threading.Thread(target=self.check_locations_that_need_full_sync)
@@ -0,0 +1,188 @@
+"""Fold the inotify events seen for a path during a batch into one net operation"""
+import time
+from inotify_simple import flags
+from .constants import MOVE_PAIRING_WINDOW
+
+# Net operations produced for a path
+OP_CREATED = "created"  # Path did not exist (or was replaced) and exists now
+OP_MODIFIED = "modified"  # Content changed
+OP_METADATA = "metadata"  # Only metadata (permissions, owner, times) changed
+OP_DELETED = "deleted"  # Path existed and is gone now
+OP_RENAMED = "renamed"  # Path was moved from NetEvent.src, content unchanged by the move
+
+CREATE_EVENTS = flags.CREATE | flags.MOVED_TO
+DELETE_EVENTS = flags.DELETE | flags.MOVED_FROM
+CONTENT_EVENTS = flags.MODIFY | flags.CLOSE_WRITE
+
+# Event mask recorded for each net operation in the pending queues
+OP_MASKS = {
+    OP_CREATED: flags.CREATE,
+    OP_MODIFIED: flags.MODIFY,
+    OP_METADATA: flags.ATTRIB,
+    OP_DELETED: flags.DELETE,
+    OP_RENAMED: flags.MOVED_TO,
+}
+
+
+class NetEvent:
+    """Net operation for a path once a batch of events has been folded"""
+
+    __slots__ = ("path", "op", "is_dir", "closed", "src")
+
+    def __init__(self, path, op, is_dir=False, closed=False, src=None):
+        self.path = path
+        self.op = op
+        self.is_dir = is_dir
+        self.closed = closed  # Last writer closed the file during the batch
+        self.src = src  # Previous path for OP_RENAMED
+
+    @property
+    def mask(self):
+        """Return the net operation as an inotify event mask"""
+        mask = OP_MASKS[self.op]
+        if self.is_dir:
+            mask |= flags.ISDIR
+        if self.closed:
+            mask |= flags.CLOSE_WRITE
+        return mask
+
+    def __str__(self):
+        if self.src:
+            return f"NetEvent(path={self.path}, op={self.op}, src={self.src})"
+        return f"NetEvent(path={self.path}, op={self.op})"
+
+
+class PathState:
+    """Events folded so far for a single path"""
+
+    __slots__ = ("first", "exists", "content", "metadata", "closed", "is_dir")
+
+    def __init__(self):
+        self.first = None  # "create", "delete" or "change", whichever came first
+        self.exists = None  # Whether the path exists after the last event
+        self.content = False
+        self.metadata = False
+        self.closed = False
+        self.is_dir = False
+
+
+class EventCoalescer:
+    """Reduce the event sequence of each path to a single net operation
+
+    CREATE, MODIFY, CLOSE_WRITE, ATTRIB and DELETE on the same path collapse to
+    one of the OP_* operations, a path created and deleted inside the same batch
+    produces nothing. Events that don't change anything (OPEN, ACCESS,
+    CLOSE_NOWRITE, *_SELF on the watched directory) are ignored here.
+
+    MOVED_FROM and MOVED_TO sharing a cookie are paired into an OP_RENAMED
+    event. A MOVED_FROM left unpaired for longer than move_window seconds is
+    treated as a delete (moved out of the watched tree).
+    """
+
+    def __init__(self, move_window=MOVE_PAIRING_WINDOW):
+        self.pending = {}  # Path -> PathState, in order of first event
+        self.move_sources = {}  # Cookie -> (path, is_dir, time) of unpaired MOVED_FROM
+        self.renames = []  # OP_RENAMED events, in the order the moves happened
+        self.move_window = move_window
+
+    def add(self, path, event_mask, cookie=0):
+        """Fold an event into the state of path"""
+        if cookie and event_mask & flags.MOVED_FROM:
+            self.move_sources[cookie] = (path, bool(event_mask & flags.ISDIR), time.time())
+            return
+        if cookie and event_mask & flags.MOVED_TO and cookie in self.move_sources:
+            src, is_dir, _ = self.move_sources.pop(cookie)
+            self.add_rename(src, path, is_dir)
+            return
+        state = self.pending.get(path)
+        if state is None:
+            state = self.pending[path] = PathState()
+        if event_mask & flags.ISDIR:
+            state.is_dir = True
+        if event_mask & CREATE_EVENTS:
+            if state.first is None:
+                state.first = "create"
+            state.exists = True
+            state.content = True
+        if event_mask & CONTENT_EVENTS:
+            if state.first is None:
+                state.first = "change"
+            state.exists = True
+            state.content = True
+        if event_mask & flags.CLOSE_WRITE:
+            state.closed = True
+        if event_mask & flags.ATTRIB:
+            if state.first is None:
+                state.first = "change"
+            state.exists = True
+            state.metadata = True
+        if event_mask & DELETE_EVENTS:
+            if state.first is None:
+                state.first = "delete"
+            state.exists = False
+
+    def add_rename(self, src, dst, is_dir):
+        """Record a paired move of src to dst"""
+        dir_flag = flags.ISDIR if is_dir else 0
+        src_state = self.pending.pop(src, None)
+        if src_state is not None and src_state.first == "create":
+            # src only existed within this batch (atomic save), dst is simply new
+            self.add(dst, flags.CREATE | dir_flag)
+            return
+        # Whatever happened to the old dst is superseded by the move
+        self.pending.pop(dst, None)
+        self.renames.append(NetEvent(dst, OP_RENAMED, is_dir, src=src))
+        if src_state is not None and (src_state.content or src_state.metadata):
+            # Changed before the move, dst still needs a sync after the rename
+            self.add(dst, flags.CLOSE_WRITE | dir_flag)
+
+    def pending_move_source(self, cookie):
+        """Return the source path of an unpaired MOVED_FROM with cookie, None if not found"""
+        move_source = self.move_sources.get(cookie)
+        return move_source[0] if move_source else None
+
+    def expire_move_sources(self, now=None):
+        """Turn MOVED_FROM events that waited longer than move_window into deletes"""
+        now = now or time.time()
+        expired = [cookie for cookie, (_, _, moved_at) in self.move_sources.items()
+                   if now - moved_at >= self.move_window]
+        for cookie in expired:
+            path, is_dir, _ = self.move_sources.pop(cookie)
+            self.add(path, flags.MOVED_FROM | (flags.ISDIR if is_dir else 0))
+
+    def has_pending(self):
+        """Check if there are folded events or unpaired moves waiting to be flushed"""
+        return len(self.pending) > 0 or len(self.move_sources) > 0 or len(self.renames) > 0
+
+    def net_operation(self, state):
+        """Return the net operation of a folded state, None if nothing changed"""
+        if state.exists is None:
+            return None
+        if not state.exists:
+            # Created and deleted within the batch, nothing to sync
+            if state.first == "create":
+                return None
+            return OP_DELETED
+        if state.first in ("create", "delete"):
+            return OP_CREATED
+        if state.content:
+            return OP_MODIFIED
+        if state.metadata:
+            return OP_METADATA
+        return None
+
+    def flush(self):
+        """Return the net operation of every pending path and reset the state
+
+        Renames come first so the paths they create exist before later operations.
+        Unpaired moves younger than move_window are kept for the next flush.
+        """
+        self.expire_move_sources()
+        net_events = self.renames
+        self.renames = []
+        for path, state in self.pending.items():
+            op = self.net_operation(state)
+            if op is not None:
+                net_events.append(NetEvent(path, op, state.is_dir, state.closed))
+        self.pending = {}
+        return net_events
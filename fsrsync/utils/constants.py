@@ -16,3 +16,45 @@ DEFAULT_SSH_PORT = 22  # Default SSH port
 DEFAULT_LOGS = "/var/log/fsrsync.log"  # Default log file
 MAX_LOG_SIZE = 100 * 1024 * 1024  # 100 MB
 TIME_EVENT_DELAY = 5  # 5 seconds
+MOVE_PAIRING_WINDOW = 1  # 1 second
+OPEN_FILE_INDEX_TTL = 1  # 1 second
+LOCK_TRACKING_PROC = "proc"  # Check locked files against /proc after every batch
+LOCK_TRACKING_EVENTS = "events"  # Track open refcounts from inotify events
+LOCK_RECONCILE_INTERVAL = 300  # 5 minutes
+HOUSEKEEPING_INTERVAL = 5  # 5 seconds
+SCHEDULE_INTERVAL = 30  # 30 seconds
+DEBOUNCE_QUIET_PERIOD = 0  # Seconds without changes before a file syncs, 0 disables debouncing
+DEBOUNCE_MAX_STALENESS = 60  # 1 minute
+DEBOUNCE_WHEEL_SLOTS = 64  # One slot per second
+ROLLUP_MIN_FILES = 1000  # Pending paths below a directory before it is synced as a whole
+ROLLUP_MIN_RATIO = 0.5  # Fraction of changed entries before a directory is synced as a whole
+ROLLUP_MIN_RATIO_FILES = 32  # Changed entries needed before the ratio is considered
+JOURNAL_FSYNC_INTERVAL = 1  # Seconds between fsyncs of the journal
+JOURNAL_SEGMENT_SIZE = 16 * 1024 * 1024  # 16 MB
+JOURNAL_MAX_SEGMENTS = 4  # Segments kept before the journal is compacted
+FINGERPRINT_CACHE_SIZE = 64 * 1024 * 1024  # 64 MB
+FINGERPRINT_WORKERS = 4  # Threads hashing files
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024  # 1 MB
+FINGERPRINT_MMAP_THRESHOLD = 8 * 1024 * 1024  # Files of 8 MB or more are memory-mapped
+MERKLE_CACHE_TTL = 300  # 5 minutes, how long a reconciliation pass keeps its digests
+RSYNC_SUCCESS_CODES = (0, 24)  # Success, and files that vanished before they were transferred
+RSYNC_WORKERS = 1  # Concurrent rsync processes per destination
+RSYNC_SHARDS_PER_WORKER = 4  # Shards queued per worker so faster workers take more
+RSYNC_MIN_SHARD_FILES = 64  # Smallest shard worth its own rsync process
+RSYNC_SHARD_RETRIES = 2  # Retries of a failed shard
+RSYNC_SHARD_FILE_COST = 256 * 1024  # Bytes a file costs on top of its size when balancing shards
+SSH_CONTROL_DIR = "/tmp/fsrsync-ssh"  # Control sockets of the SSH masters
+SSH_MASTER_START_TIMEOUT = 15  # Seconds an SSH master may take to connect
+SSH_MASTER_CHECK_INTERVAL = 30  # Seconds between health checks of a running SSH master
+SSH_MASTER_RETRY_INTERVAL = 60  # Seconds before starting an SSH master that failed again
+SSH_SERVER_ALIVE_INTERVAL = 15  # Seconds between keepalives of persistent SSH connections
+SSH_CONNECT_TIMEOUT = 15  # Seconds a paramiko connection may take to connect
+SSH_COMMAND_TIMEOUT = 1000  # Seconds without output before a remote command is abandoned
+SSH_POOL_MAX_CONNECTIONS = 2  # Pooled connections per server, user, port and key
+SSH_POOL_MAX_CHANNELS = 8  # Concurrent channels per pooled connection, below OpenSSH's MaxSessions of 10
+SSH_POOL_IDLE_TIMEOUT = 300  # Seconds an unused pooled connection is kept open
+RSYNC_MAX_CHANGES = 1000  # Changed paths kept in the statistics of a sync, the most bytes transferred first
+RSYNC_PARTIAL_CODES = (23, 24)  # Some files were not transferred, the others were
+SYNC_RETRY_LIMIT = 5  # Syncs of a path that may fail before it is left to the next full sync
+SYNC_RETRY_BACKOFF = 30  # Seconds before the first retry of a path whose sync failed, doubled at each failure
+SYNC_RETRY_MAX_BACKOFF = 900  # 15 minutes
@@ -0,0 +1,95 @@
+"""Timer wheel deciding when queued paths have been quiet long enough to sync"""
+import time
+from .pathindex import PathIndex
+from .constants import DEBOUNCE_QUIET_PERIOD, DEBOUNCE_MAX_STALENESS, DEBOUNCE_WHEEL_SLOTS
+
+
+class DebounceScheduler:
+    """Hold queued files back until no change was seen for quiet_period seconds
+
+    A file becomes ready quiet_period seconds after its last change, or
+    max_staleness seconds after its first change (or its last sync) if it keeps
+    changing, so files that are written continuously still sync regularly. A
+    file whose sync failed is never ready before its retry_at.
+
+    Waiting files sit in a hashed timer wheel with one slot per second. Further
+    changes to a waiting file only move its last_seen, the slot is re-checked
+    when it comes around and the file is put back on the wheel if it isn't due.
+    """
+
+    def __init__(self, quiet_period=DEBOUNCE_QUIET_PERIOD, max_staleness=DEBOUNCE_MAX_STALENESS,
+                 slots=DEBOUNCE_WHEEL_SLOTS, now=None):
+        self.quiet_period = quiet_period
+        self.max_staleness = max_staleness
+        self.wheel = [{} for _ in range(slots)]  # Slot -> {path: tick the path is due}
+        self.tick = int(now or time.time())  # Last tick processed
+        self.waiting = {}  # Path -> File on the wheel
+        self.ready = PathIndex()  # Path -> File eligible for sync
+
+    def deadline(self, file):
+        """Return the time file becomes eligible for sync"""
+        stale_since = max(file.start_time, file.synced_time or 0)
+        return max(min(file.last_seen + self.quiet_period, stale_since + self.max_staleness), file.retry_at)
+
+    def insert(self, file):
+        """Put file on the wheel at its deadline, never in a slot already processed"""
+        due_tick = max(int(self.deadline(file)) + 1, self.tick + 1)
+        self.wheel[due_tick % len(self.wheel)][file.path] = due_tick
+
+    def schedule(self, file):
+        """Start or restart the quiet period of a queued file"""
+        path = file.path
+        self.ready.pop(path)
+        if self.quiet_period <= 0 and file.retry_at <= time.time():
+            self.ready[path] = file
+            return
+        if path in self.waiting:
+            # Already on the wheel, it is re-checked against the new last_seen when due
+            self.waiting[path] = file
+            return
+        self.waiting[path] = file
+        self.insert(file)
+
+    def discard(self, path):
+        """Forget a path that left the sync queues"""
+        self.waiting.pop(path, None)
+        self.ready.pop(path)
+
+    def clear(self):
+        """Forget every path"""
+        for slot in self.wheel:
+            slot.clear()
+        self.waiting.clear()
+        self.ready.clear()
+
+    def advance(self, now=None):
+        """Process the wheel up to now, return the number of files that became ready"""
+        now = now or time.time()
+        now_tick = int(now)
+        # After a long pause every slot is due at most once
+        first_tick = max(self.tick + 1, now_tick - len(self.wheel) + 1)
+        self.tick = now_tick
+        promoted = 0
+        for tick in range(first_tick, now_tick + 1):
+            slot = self.wheel[tick % len(self.wheel)]
+            due = [path for path, due_tick in slot.items() if due_tick <= now_tick]
+            for path in due:
+                del slot[path]
+                file = self.waiting.get(path)
+                if file is None:
+                    continue  # Discarded while waiting
+                if self.deadline(file) <= now:
+                    del self.waiting[path]
+                    self.ready[path] = file
+                    promoted += 1
+                else:
+                    self.insert(file)
+        return promoted
+
+    def is_ready(self, path):
+        """Check if path is eligible for sync"""
+        return path in self.ready
+
+    def count_waiting(self):
+        """Return the number of files still in their quiet period"""
+        return len(self.waiting)
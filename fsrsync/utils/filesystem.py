@@ -1,6 +1,21 @@
+import os
 import time
-from .logs import Logger
-from .utils import fix_path_slashes, is_file_open
+import threading
+from collections import deque
+from .logs import Logger, LogLevel
+from .rescan import scan_changes
+from .pathindex import PathIndex
+from .syncqueue import File, SyncQueue
+from .coalescer import EventCoalescer, OP_CREATED, OP_MODIFIED, OP_DELETED, OP_RENAMED
+from .utils import normalize_path, file_extension, is_file_open
+from .constants import (
+    LOCK_TRACKING_PROC,
+    LOCK_TRACKING_EVENTS,
+    LOCK_RECONCILE_INTERVAL,
+    HOUSEKEEPING_INTERVAL,
+    DEBOUNCE_QUIET_PERIOD,
+    DEBOUNCE_MAX_STALENESS,
+)
 from inotify_simple import INotify, flags
 
 
@@ -21,70 +36,234 @@ EVENT_MAP = {
     "IN_ISDIR": flags.ISDIR
 }
 
+# Events always watched in recursive mode so the watch tree can follow new,
+# moved and deleted directories
+RECURSIVE_WATCH_MASK = flags.CREATE | flags.MOVED_TO | flags.DELETE_SELF
 
-class File:
-    """Class to represent a locked file"""
 
-    def __init__(self, path, logger):
-        """Initialize the file with a path"""
-        self.path = fix_path_slashes(path)
-        # Get the extension if it exists
-        if "." in path:
-            self.extension = path.split(".")[-1]
-        else:
-            self.extension = None
-        self.logger = logger
-        self.start_time = time.time()
-        self.successfully_synced = False
-        self.synced_time = None
+class OpenCount:
+    """Open file descriptors seen for a path through inotify"""
 
-    def how_long_locked(self):
-        """Return the time in seconds since the file was locked"""
-        return time.time() - self.start_time
+    __slots__ = ("count", "written")
 
-    def __str__(self):
-        return f"File(path={self.path})"
+    def __init__(self):
+        self.count = 0
+        self.written = False  # IN_MODIFY seen since the first open
 
 
 class FilesystemMonitor:
     """Class to monitor filesystem events using inotify"""
     warning_file_open_time = 86400
 
-    def __init__(self, time_between_events=5):
-        """Initialize the filesystem monitor"""
+    def __init__(self, time_between_events=5, lock_tracking=LOCK_TRACKING_PROC,
+                 lock_reconcile_interval=LOCK_RECONCILE_INTERVAL,
+                 quiet_period=DEBOUNCE_QUIET_PERIOD, max_staleness=DEBOUNCE_MAX_STALENESS,
+                 journal=None):
+        """Initialize the filesystem monitor
+
+        :param time_between_events: Seconds to wait for more events after the first of a batch
+        :type time_between_events: int
+        :param lock_tracking: "proc" checks locked files against /proc after every batch,
+            "events" keeps open refcounts from inotify and only reconciles with /proc
+            every lock_reconcile_interval seconds
+        :type lock_tracking: str
+        :param lock_reconcile_interval: Seconds between /proc reconciliations in "events" mode
+        :type lock_reconcile_interval: int
+        :param quiet_period: Seconds without changes before a queued file is eligible for sync
+        :type quiet_period: int
+        :param max_staleness: Seconds after which a file that keeps changing is eligible anyway
+        :type max_staleness: int
+        :param journal: Journal the destination queues record their paths in, defaults to None
+        :type journal: Journal, optional
+        """
         self.inotify_watcher = INotify()
-        self.watches = {}  # Keep track of paths being watched
-        self.open_files = set()  # Track files that are open for writing
-        self.immediate_sync = set()  # Track files that need immediate sync
-        self.regular_sync = set()  # Track files that need regular sync
+        self.watches = {}  # Keep track of paths being watched (wd -> path)
+        self.watched_paths = PathIndex()  # Reverse index of watches (path -> wd)
+        self.watch_masks = {}  # Event mask used for each watch descriptor
+        self.recursive_watches = set()  # Watch descriptors that follow new subdirectories
+        self.watch_roots = {}  # Top-level watched paths (path -> recursive)
+        self.routes = PathIndex()  # Queues of the destinations syncing each source path (path -> [SyncQueue])
+        self.sync_queues = []  # Queues of every destination
+        self.quiet_period = quiet_period
+        self.max_staleness = max_staleness
+        self.journal = journal
+        self.open_files = PathIndex()  # Track files that are open for writing (path -> File)
+        self.lock_tracking = lock_tracking
+        self.lock_reconcile_interval = lock_reconcile_interval
+        self.open_counts = PathIndex()  # Open refcount per path in "events" mode (path -> OpenCount)
+        self.last_lock_reconcile = time.time()
+        self.last_housekeeping = 0  # Lock housekeeping runs on a timer, not per event
+        self.coalescer = EventCoalescer()  # Folds each batch into one operation per path
+        self.renames = []  # Renames applied locally, waiting to be applied by destinations
+        self.last_read_time = time.time()  # Events before this time were all delivered
+        self.dirty_paths = {}  # Roots to rescan after an overflow (path -> (since, watched dirs))
+        self.synthetic_events = deque()  # (path, mask) found by rescans, handled with the next batch
+        self.rescan_lock = threading.Lock()
+        self.rescan_thread = None
+        self.metrics = {
+            "overflow_count": 0,
+            "rescan_count": 0,
+            "last_rescan_duration": None,
+            "last_rescan_events": 0,
+        }
         self.logger = Logger()
         self.time_between_events = time_between_events  # Time between events in seconds
 
     def get_aggregated_events(self):
         """Return all events"""
-        immediate = [f.path for f in self.immediate_sync]
-        regular = [f.path for f in self.regular_sync]
-        locked = [f.path for f in self.open_files]
+        immediate = sorted({path for queue in self.sync_queues for path in queue.immediate_sync})
+        regular = sorted({path for queue in self.sync_queues for path in queue.regular_sync})
+        locked = list(self.open_files)
         return {"immediate": immediate, "regular": regular, "locked": locked}
 
-    def add_watch(self, path, events):
-        """Add a watch for events on a given path"""
+    def add_destination(self, path, ignore=None, name=None):
+        """Create the sync queue of a destination and route the changes below path to it
+
+        :param path: Source path of the destination
+        :type path: str
+        :param ignore: Ignore rules of the destination
+        :type ignore: IgnoreMatcher, optional
+        :param name: Name of the destination in the journal, defaults to path
+        :type name: str, optional
+        :return: The queue changes for the destination are routed to
+        :rtype: SyncQueue
+        """
+        queue = SyncQueue(path, ignore, self.quiet_period, self.max_staleness, self.journal, name)
+        if self.journal is not None:
+            restored = queue.restore(self.journal.pending_paths(queue.name))
+            if restored:
+                self.logger.info(f"Restored {restored} pending paths for {queue.name} from the journal")
+        root = queue.root
+        if root not in self.routes:
+            self.routes[root] = []
+        self.routes[root].append(queue)
+        self.sync_queues.append(queue)
+        return queue
+
+    def route(self, path):
+        """Return the queues of the destinations that sync path"""
+        return [queue for queues in self.routes.values_above(path) for queue in queues
+                if queue.accepts(path)]
+
+    def add_watch(self, path, events, recursive=False):
+        """Add a watch for events on a given path
+
+        :param path: Path to watch
+        :type path: str
+        :param events: Event names from EVENT_MAP to watch for
+        :type events: list
+        :param recursive: Watch every directory below path as well, defaults to False
+        :type recursive: bool, optional
+        """
         event_mask = 0
         for event in events:
             if event in EVENT_MAP:
                 event_mask |= EVENT_MAP[event]
 
-        wd = self.inotify_watcher.add_watch(path, event_mask)
+        root = path.rstrip("/") + "/"
+        self.watch_roots[root] = self.watch_roots.get(root, False) or recursive
+        if recursive:
+            watched = self.add_watch_tree(path, event_mask | RECURSIVE_WATCH_MASK)
+            self.logger.info(f"Monitoring {path} recursively ({watched} directories) for events: {events}")
+        else:
+            self.add_watch_descriptor(path, event_mask)
+            self.logger.info(f"Monitoring {path} for events: {events}")
+
+    def add_watch_descriptor(self, path, event_mask, recursive=False):
+        """Add a single inotify watch and register it in the wd <-> path index"""
+        path = path.rstrip("/") + "/"
+        # inotify replaces the mask of an existing watch, keep the events already requested
+        existing_wd = self.watched_paths.get(path)
+        if existing_wd is not None:
+            event_mask |= self.watch_masks.get(existing_wd, 0)
+        try:
+            wd = self.inotify_watcher.add_watch(path, event_mask)
+        except OSError as e:
+            self.logger.error(f"Could not add watch on {path}: {e}")
+            return None
         self.watches[wd] = path
-        self.logger.info(f"Monitoring {path} for events: {events}")
+        self.watched_paths[path] = wd
+        self.watch_masks[wd] = event_mask
+        if recursive:
+            self.recursive_watches.add(wd)
+        return wd
+
+    def add_watch_tree(self, path, event_mask):
+        """Add a watch on path and every directory below it, return the number of watches"""
+        watched = 0
+        for root, dirs, _ in os.walk(path):
+            if self.add_watch_descriptor(root, event_mask, recursive=True) is None:
+                # Don't descend into directories we can't watch
+                dirs[:] = []
+                continue
+            watched += 1
+            # Nothing below an ignored directory is synced, don't spend watches on it
+            dirs[:] = [name for name in dirs if not self.is_ignored(os.path.join(root, name) + "/")]
+        return watched
+
+    def remove_watch_descriptor(self, wd):
+        """Forget a watch descriptor removed by the kernel"""
+        path = self.watches.pop(wd, None)
+        self.watch_masks.pop(wd, None)
+        self.recursive_watches.discard(wd)
+        if path is not None and self.watched_paths.get(path) == wd:
+            del self.watched_paths[path]
+            self.logger.debug(f"Watch on {path} removed")
+
+    def remove_watch_tree(self, path):
+        """Stop watching path and every directory below it"""
+        for watched_path in self.watched_paths.keys_under(path):
+            wd = self.watched_paths[watched_path]
+            try:
+                self.inotify_watcher.rm_watch(wd)
+            except OSError:
+                pass  # Already removed by the kernel
+            self.remove_watch_descriptor(wd)
+
+    def move_watch_tree(self, src, dst):
+        """Re-point the watches of a moved directory tree, the descriptors follow the inodes"""
+        src_prefix = src.rstrip("/")
+        dst_prefix = dst.rstrip("/")
+        for watched_path in self.watched_paths.keys_under(src):
+            wd = self.watched_paths.pop(watched_path)
+            new_path = dst_prefix + watched_path[len(src_prefix):]
+            self.watched_paths[new_path] = wd
+            self.watches[wd] = new_path
+
+    def update_watch_tree(self, wd, event_mask, full_path, cookie=0):
+        """Keep the recursive watch tree in sync with directory events"""
+        if event_mask & flags.IGNORED or event_mask & EVENT_MAP["IN_DELETE_SELF"]:
+            self.remove_watch_descriptor(wd)
+            return
+        if wd not in self.recursive_watches or not event_mask & EVENT_MAP["IN_ISDIR"]:
+            return
+        if event_mask & EVENT_MAP["IN_MOVED_TO"]:
+            move_source = self.coalescer.pending_move_source(cookie)
+            if move_source is not None and move_source.rstrip("/") + "/" in self.watched_paths:
+                # Moved within the watched tree, re-point its watches now so the
+                # rest of the batch already resolves to the new paths
+                self.move_watch_tree(move_source, full_path)
+                return
+        if event_mask & (EVENT_MAP["IN_CREATE"] | EVENT_MAP["IN_MOVED_TO"]):
+            # Directories may already have content by the time we watch them,
+            # the directory itself is queued by handle_event so rsync picks it up
+            watched = self.add_watch_tree(full_path, self.watch_masks[wd])
+            self.logger.debug(f"New directory {full_path}, added {watched} watches")
 
     def event_generator(self):
         """Generator to yield filesystem events"""
+        for events in self.event_batch_generator():
+            for event in events:
+                yield event
+
+    def event_batch_generator(self):
+        """Generator to yield the events of each inotify read as one batch, empty on timeout"""
         while True:
             events = self.inotify_watcher.read(timeout=5000,
                                                read_delay=self.time_between_events)
-            for event in events:
-                yield event
+            read_time = time.time()
+            yield events
+            self.last_read_time = read_time
 
     def handle_event(self, event):
         """Handle a filesystem event
@@ -92,58 +271,233 @@ class FilesystemMonitor:
         :param event: Event to handle
         :type event: inotify_simple.Event
         """
-        wd = event.wd
-        path = self.watches.get(wd, "Unknown path")
-        event_mask = event.mask
-        type_names = [str(flag) for flag in flags.from_mask(event_mask)]
-        filename = event.name or ""
-        full_path = f"{path}/{filename}" if filename else path
-        full_path = fix_path_slashes(full_path)
-
-        # All other events
-        ALL_OTHER_EVENTS = [
-            "IN_ACCESS",
-            "IN_MODIFY",
-            "IN_DELETE",
-            "IN_MOVED_FROM",
-            "IN_MOVED_TO",
-            "IN_MOVE_SELF",
-            "IN_DELETE_SELF",
-            "IN_ATTRIB",
-            "IN_CLOSE_NOWRITE",
-        ]
-
-        # Remove noise of "OPEN" events
-        if any(event_mask & EVENT_MAP[event] for event in ALL_OTHER_EVENTS):
-            self.logger.info(f"Event detected: {type_names} on {full_path}")
-
-        if event_mask & EVENT_MAP["IN_CREATE"]:
-            self.logger.debug(f"File created: {full_path}, added to immediate sync")
-            self.add_immediate_sync_file(File(full_path, self.logger))
+        self.handle_events([event])
+
+    def handle_events(self, events):
+        """Handle a batch of filesystem events
+
+        Events are folded per path into a net operation first, so each path
+        reaches the sync queues at most once per batch. Lock housekeeping is
+        not done here, see run_housekeeping.
+
+        :param events: Events to handle
+        :type events: list[inotify_simple.Event]
+        """
+        log_events = self.logger.get_level() <= LogLevel.DEBUG.value
+        for event in events:
+            wd = event.wd
+            event_mask = event.mask
+            if event_mask & flags.Q_OVERFLOW:
+                self.handle_overflow()
+                continue
+            path = self.watches.get(wd, "Unknown path")
+            # Watched paths end with a slash, IN_ISDIR says if the event is on a directory
+            full_path = normalize_path(path + event.name, event_mask & flags.ISDIR) if event.name else path
+            # Drop paths no destination syncs before they reach the watch tree, the lock tracking or the queues
+            if event.name and self.is_ignored(full_path):
+                continue
+
+            self.update_watch_tree(wd, event_mask, full_path, event.cookie)
+            # The watch was removed by the kernel, there is no file event to handle
+            if event_mask & flags.IGNORED:
+                continue
+
+            # Remove noise of "OPEN" events
+            if log_events and event_mask & ~(EVENT_MAP["IN_OPEN"] | EVENT_MAP["IN_ISDIR"]):
+                type_names = [str(flag) for flag in flags.from_mask(event_mask)]
+                self.logger.debug(f"Event detected: {type_names} on {full_path}")
+
+            self.track_open_state(full_path, event_mask)
+            self.coalescer.add(full_path, event_mask, event.cookie)
+
+        while self.synthetic_events:
+            self.handle_synthetic_event(*self.synthetic_events.popleft())
+
+        net_events = self.coalescer.flush()
+        for net_event in net_events:
+            self.apply_net_event(net_event)
+        if events:
+            self.logger.info(f"Handled {len(events)} events, {len(net_events)} paths changed")
+
+    def is_ignored(self, path):
+        """Check if no destination syncs path (outside every source path or ignored by all)"""
+        return not self.route(path)
+
+    def run_housekeeping(self, force=False):
+        """Check locked files, at most once every HOUSEKEEPING_INTERVAL seconds unless forced"""
+        now = time.time()
+        if not force and now - self.last_housekeeping < HOUSEKEEPING_INTERVAL:
+            return
+        self.last_housekeeping = now
+        self.log_files_opened_for_too_long()
+        self.check_if_file_still_locked()
 
+    def track_open_state(self, full_path, event_mask):
+        """Keep locked files up to date with open, close and delete events"""
+        if self.lock_tracking == LOCK_TRACKING_EVENTS:
+            self.track_open_count(full_path, event_mask)
+            return
         # If IN_OPEN and not ISDIR, add to locked files
         if event_mask & EVENT_MAP["IN_OPEN"] and not event_mask & EVENT_MAP["IN_ISDIR"]:
             self.logger.debug(f"File opened: {full_path}")
-            self.add_to_locked_files(File(full_path, self.logger))
+            self.add_to_locked_files(File(full_path, event_mask))
 
-        # File closed
-        FILE_CLOSED_EVENTS = ["IN_CLOSE_WRITE", "IN_CLOSE_NOWRITE"]
-        if any(event_mask & EVENT_MAP[event] for event in FILE_CLOSED_EVENTS):
+        # File closed or gone
+        FILE_RELEASED_EVENTS = ["IN_CLOSE_WRITE", "IN_CLOSE_NOWRITE", "IN_DELETE", "IN_MOVED_FROM"]
+        if any(event_mask & EVENT_MAP[event] for event in FILE_RELEASED_EVENTS):
             if full_path in self.open_files:
                 self.logger.debug(f"File closed: {full_path}")
                 self.delete_locked_file(full_path)
-                self.add_immediate_sync_file(File(full_path, self.logger))
-
-        if any(event_mask & EVENT_MAP[event] for event in ALL_OTHER_EVENTS):
-            self.logger.debug(f"File modified: {full_path}")
-            self.add_regular_sync_file(File(full_path, self.logger))
 
-        self.log_files_opened_for_too_long()
-        self.check_if_file_still_locked()
+    def track_open_count(self, full_path, event_mask):
+        """Keep a refcount of open file descriptors per path, a file written while open is locked"""
+        if event_mask & EVENT_MAP["IN_ISDIR"]:
+            return
+        if event_mask & (EVENT_MAP["IN_DELETE"] | EVENT_MAP["IN_MOVED_FROM"]):
+            self.open_counts.pop(full_path)
+            if full_path in self.open_files:
+                self.delete_locked_file(full_path)
+            return
+        open_count = self.open_counts.get(full_path)
+        if event_mask & EVENT_MAP["IN_OPEN"]:
+            if open_count is None:
+                open_count = self.open_counts[full_path] = OpenCount()
+            open_count.count += 1
+        if open_count is None:
+            return
+        if event_mask & EVENT_MAP["IN_MODIFY"] and not open_count.written:
+            open_count.written = True
+            self.logger.debug(f"File opened for writing: {full_path}")
+            self.add_to_locked_files(File(full_path, event_mask))
+        if event_mask & (EVENT_MAP["IN_CLOSE_WRITE"] | EVENT_MAP["IN_CLOSE_NOWRITE"]):
+            open_count.count -= 1
+            if open_count.count <= 0:
+                self.open_counts.pop(full_path)
+            # A writer closed the file, another writer still open locks it again on its next write
+            if open_count.count <= 0 or event_mask & EVENT_MAP["IN_CLOSE_WRITE"]:
+                open_count.written = False
+                if full_path in self.open_files:
+                    self.logger.debug(f"File closed: {full_path}")
+                    self.delete_locked_file(full_path)
+
+    def reconcile_open_counts(self):
+        """Drop refcounts of files no process has open anymore (events lost or missed)"""
+        self.last_lock_reconcile = time.time()
+        for path in list(self.open_counts):
+            if is_file_open(path):
+                continue
+            self.open_counts.pop(path)
+            if path in self.open_files:
+                self.delete_locked_file(path)
+            self.logger.debug(f"File {path} is no longer open, open count reset")
+
+    def apply_net_event(self, net_event):
+        """Queue the net operation of a path for sync
+
+        The change is routed to the queue of every destination syncing the path.
+        New files and files whose writer closed them go to immediate sync,
+        everything else to regular sync.
+        """
+        full_path = net_event.path
+        if net_event.op == OP_RENAMED:
+            self.apply_rename(net_event)
+            return
+        if net_event.op == OP_DELETED and net_event.is_dir:
+            # Moved out of the watched tree, its watches would report stale paths
+            self.remove_watch_tree(full_path)
+        immediate = net_event.op == OP_CREATED or (net_event.op == OP_MODIFIED and net_event.closed)
+        queues = self.route(full_path)
+        self.logger.debug(
+            f"File {net_event.op}: {full_path}, routed to {len(queues)} destinations for "
+            f"{'immediate' if immediate else 'regular'} sync"
+        )
+        for queue in queues:
+            queue.apply(full_path, net_event.mask, immediate)
+
+    def apply_rename(self, net_event):
+        """Move watches and pending entries of a renamed path and record the rename"""
+        src, dst = net_event.src, net_event.path
+        self.logger.debug(f"Renamed {src} to {dst}")
+        for queue in self.sync_queues:
+            queue.move_files(src, dst)
+        self.move_queued_files(self.open_files, src, dst)
+        src_prefix = src.rstrip("/")
+        for path in self.open_counts.keys_under(src):
+            self.open_counts[dst.rstrip("/") + path[len(src_prefix):]] = self.open_counts.pop(path)
+        self.renames.append(net_event)
+
+    def move_queued_files(self, queue, src, dst):
+        """Re-key files queued at or below src to dst"""
+        src_prefix = src.rstrip("/")
+        dst_prefix = dst.rstrip("/")
+        for file in queue.remove_under(src):
+            file.path = normalize_path(dst_prefix + file.path[len(src_prefix):], file.is_dir)
+            file.extension = file_extension(file.path)
+            queue[file.path] = file
+
+    def pop_renames(self):
+        """Return renames waiting to be applied by destinations and forget them"""
+        renames = self.renames
+        self.renames = []
+        return renames
+
+    def has_pending_events(self):
+        """Check if events are held back for a later batch (e.g. unpaired moves, rescans)"""
+        return self.coalescer.has_pending() or len(self.synthetic_events) > 0
+
+    def handle_synthetic_event(self, path, event_mask):
+        """Handle an event found by a rescan instead of read from inotify"""
+        path = normalize_path(path, event_mask & flags.ISDIR)
+        if self.is_ignored(path):
+            return
+        if event_mask & EVENT_MAP["IN_CREATE"] and event_mask & EVENT_MAP["IN_ISDIR"]:
+            parent_wd = self.watched_paths.get(os.path.dirname(path.rstrip("/")) + "/")
+            if parent_wd in self.recursive_watches:
+                self.add_watch_tree(path, self.watch_masks[parent_wd])
+        self.coalescer.add(path, event_mask)
+
+    def handle_overflow(self):
+        """Mark every watched tree dirty after the kernel dropped events and rescan them"""
+        self.metrics["overflow_count"] += 1
+        self.logger.warning("Inotify event queue overflowed, rescanning watched paths for lost events")
+        with self.rescan_lock:
+            for root, recursive in self.watch_roots.items():
+                if root in self.dirty_paths:
+                    continue
+                watched_dirs = set(self.watched_paths.keys_under(root)) if recursive else set()
+                self.dirty_paths[root] = (self.last_read_time, watched_dirs)
+            if self.rescan_thread is None:
+                self.rescan_thread = threading.Thread(target=self.rescan_dirty_paths, daemon=True)
+                self.rescan_thread.start()
+
+    def rescan_dirty_paths(self):
+        """Rescan dirty trees until none are left, queueing synthetic events for the changes"""
+        while True:
+            with self.rescan_lock:
+                if not self.dirty_paths:
+                    self.rescan_thread = None
+                    return
+                dirty_paths = self.dirty_paths
+                self.dirty_paths = {}
+            time_started = time.time()
+            found = 0
+            for root, (since, watched_dirs) in dirty_paths.items():
+                events = scan_changes(root, since, watched_dirs, self.watch_roots.get(root, False))
+                self.synthetic_events.extend(events)
+                found += len(events)
+            duration = time.time() - time_started
+            self.metrics["rescan_count"] += 1
+            self.metrics["last_rescan_duration"] = duration
+            self.metrics["last_rescan_events"] = found
+            self.logger.info(f"Rescanned {len(dirty_paths)} paths in {duration:.2f}s, {found} changes found")
+
+    def get_metrics(self):
+        """Return monitor metrics"""
+        return dict(self.metrics)
 
     def log_files_opened_for_too_long(self):
         """Log files that have been locked for too long"""
-        for file in self.open_files:
+        for file in self.open_files.values():
             if file.how_long_locked() > self.warning_file_open_time:
                 self.logger.warning(
                     f"File {file.path} has been locked for too long")
@@ -154,202 +508,75 @@ class FilesystemMonitor:
 
     def check_if_locked_files_exceeded_wait(self, path, max_wait_locked):
         """Check if a file has been locked for too long"""
-        for file in self.open_files:
-            if file.path == path and file.how_long_locked() > max_wait_locked:
-                return False
+        file = self.open_files.get(path)
+        if file is not None and file.how_long_locked() > max_wait_locked:
+            return False
         return True
 
     def check_if_file_still_locked(self):
         """Check if a file is still locked"""
+        if self.lock_tracking == LOCK_TRACKING_EVENTS:
+            # Locks follow the event stream, /proc is only consulted now and then
+            if time.time() - self.last_lock_reconcile >= self.lock_reconcile_interval:
+                self.reconcile_open_counts()
+            return
         files_to_remove = []
-        for file in self.open_files:
-            if not is_file_open(file.path):
+        for file in self.open_files.values():
+            if not is_file_open(file.path, for_write=True):
                 files_to_remove.append(file)
         for file in files_to_remove:
-            self.open_files.discard(file)
+            self.open_files.pop(file.path, None)
             self.logger.debug(f"File {file.path} removed from locked files, it is no longer open")
 
     def clear_locks_exceeded_wait(self, path, max_wait_locked):
         """Clear locks that have exceeded the wait time"""
-        to_remove = []
-        non_exceeded_for_path = []
-        for file in self.open_files:
-            if file.path.startswith(path) and file.how_long_locked() > max_wait_locked:
-                to_remove.append(file)
-            if file.path.startswith(path) and file.how_long_locked() <= max_wait_locked:
-                non_exceeded_for_path.append(file)
+        to_remove = self.open_files.remove_under(
+            path, lambda file: file.how_long_locked() > max_wait_locked
+        )
         for file in to_remove:
-            self.open_files.discard(file)
             self.logger.debug(f"File {file.path} removed from locked files")
-        return non_exceeded_for_path
+        return self.open_files.values_under(path)
 
     def get_locked_files_for_path(self, path):
         """Return locked files in a given path"""
-        locked_files = []
-        for file in self.open_files:
-            if path:
-                if file.path.startswith(path):
-                    locked_files.append(file)
-            else:
-                locked_files.append(file)
-        return locked_files
+        if path:
+            return self.open_files.values_under(path)
+        return list(self.open_files.values())
 
     def get_locked_files(self):
         """Return locked files"""
-        return self.open_files
-
-    def get_immediate_sync_files(self, path_filter=None):
-        """Return files that need immediate sync"""
-        imm_sync = []
-        for f in self.immediate_sync:
-            if path_filter:
-                if f.path.startswith(path_filter):
-                    imm_sync.append(f)
-            else:
-                imm_sync.append(f)
-        return imm_sync
-
-    def clear_immediate_sync_files(self):
-        """Clear files that need immediate sync"""
-        self.immediate_sync.clear()
-
-    def delete_immediate_sync_file(self, path, delete_up_to_time=None):
-        """Delete file from immediate sync"""
-        to_remove = []
-        for f in self.immediate_sync:
-            if f.path == path:
-                if delete_up_to_time is None:
-                    to_remove.append(f)
-                elif f.start_time < delete_up_to_time:
-                    to_remove.append(f)
-        for f in to_remove:
-            self.immediate_sync.discard(f)
-        self.logger.debug(f"File {path} removed from immediate sync")
+        return list(self.open_files.values())
 
-    def delete_locked_file(self, path, delete_up_to_time=None):
-        """Delete file from locked files using path"""
-        to_remove = []
-        for f in self.open_files:
-            if f.path == path:
-                if delete_up_to_time is None:
-                    to_remove.append(f)
-                elif f.start_time < delete_up_to_time:
-                    to_remove.append(f)
-        for f in to_remove:
-            self.open_files.discard(f)
-        self.logger.debug(f"File {path} removed from locked files")
+    def get_immediate_sync_files(self, path_filter=None, ready_only=False):
+        """Return files that need immediate sync in any destination"""
+        return [file for queue in self.sync_queues
+                for file in queue.get_immediate_sync_files(path_filter, ready_only)]
 
-    def clear_locked_files(self):
-        """Clear locked files"""
-        self.open_files.clear()
-        self.logger.info("Locked files cleared")
+    def get_regular_sync_files(self, path_filter=None, ready_only=False):
+        """Return files that need regular sync in any destination"""
+        return [file for queue in self.sync_queues
+                for file in queue.get_regular_sync_files(path_filter, ready_only)]
 
-    def get_regular_sync_files(self, path_filter=None):
-        """Return files that need regular sync"""
-        reg_sync = []
-        for f in self.regular_sync:
-            if path_filter:
-                if f.path.startswith(path_filter):
-                    reg_sync.append(f)
-            else:
-                reg_sync.append(f)
-        return reg_sync
-
-    def clear_regular_sync_files(self, path_filter=None):
-        """Clear files that need regular sync"""
-        if path_filter:
-            files_to_clear = []
-            for f in self.regular_sync:
-                if path_filter:
-                    if f.path.startswith(path_filter):
-                        files_to_clear.append(f)
-                else:
-                    files_to_clear.append(f)
-            for f in files_to_clear:
-                self.regular_sync.discard(f)
-        else:
-            self.regular_sync.clear()
+    def count_immediate_sync_files(self, path_filter=None):
+        """Return the number of files that need immediate sync over all destinations"""
+        return sum(queue.count_immediate_sync_files(path_filter) for queue in self.sync_queues)
 
-    def delete_fs_event_for_path(self, path):
-        """Delete filesystem events for a given path"""
-        self.delete_regular_sync_files_for_path(path)
-        self.delete_immediate_sync_files_for_path(path)
-
-    def delete_regular_sync_files_for_path(self, path, delete_up_to_time=None):
-        """Delete files that need regular sync in a given path"""
-        self.logger.debug(f"Deleting files in {path} from regular sync, with delete_up_to_time={delete_up_to_time}")
-        to_remove = []
-        for f in self.regular_sync:
-            if f.path.startswith(path):
-                if delete_up_to_time is None:
-                    to_remove.append(f)
-                elif f.start_time < delete_up_to_time:
-                    to_remove.append(f)
-        for f in to_remove:
-            self.regular_sync.discard(f)
-        self.logger.debug(f"Files in {path} removed from regular sync")
-
-    def delete_immediate_sync_files_for_path(self, path, delete_up_to_time=None):
-        """Delete files that need immediate sync in a given path"""
-        self.logger.debug(f"Deleting files in {path} from immediate sync, with delete_up_to_time={delete_up_to_time}")
-        to_remove = []
-        for f in self.immediate_sync:
-            if f.path.startswith(path):
-                if delete_up_to_time is None:
-                    self.logger.debug(f"File {f} has no delete_up_to_time")
-                    to_remove.append(f)
-                elif f.start_time < delete_up_to_time:
-                    self.logger.debug(f"File {f} has start time {f.start_time} and delete_up_to_time {delete_up_to_time}")
-                    to_remove.append(f)
-        for f in to_remove:
-            self.immediate_sync.discard(f)
-        self.logger.debug(f"Files in {path} removed from immediate sync")
-
-    def delete_regular_sync_file(self, path, delete_up_to_time=None):
-        """Delete file from regular sync"""
-        self.logger.debug(f"Deleting file {path} from regular sync, with delete_up_to_time={delete_up_to_time}")
-        to_remove = []
-        for f in self.regular_sync:
-            if f.path == path:
-                if delete_up_to_time is None:
-                    self.logger.debug(f"File {f} has no delete_up_to_time")
-                    to_remove.append(f)
-                elif f.start_time < delete_up_to_time:
-                    self.logger.debug(f"File {f} has start time {f.start_time} and delete_up_to_time {delete_up_to_time}")
-                    to_remove.append(f)
-        for f in to_remove:
-            self.regular_sync.discard(f)
-        self.logger.debug(f"File {path} removed from regular sync")
-
-    def add_regular_sync_file(self, file):
-        """Add file to regular sync"""
-        # Return if file already exists
-        for f in self.regular_sync:
-            if f.path == file.path:
-                self.logger.debug(f"File {file} already in regular sync")
-                return
-        self.regular_sync.add(file)
-        self.logger.debug(f"File {file} added to regular sync")
-
-    def add_immediate_sync_file(self, file):
-        """Add file to immediate sync"""
-        # Check if path already in immediate sync files
-        for f in self.immediate_sync:
-            if f.path == file.path:
-                self.logger.debug(f"File {file} already in immediate sync")
-                return
-        self.immediate_sync.add(file)
-        self.logger.debug(f"File {file} added to immediate sync")
+    def count_regular_sync_files(self, path_filter=None):
+        """Return the number of files that need regular sync over all destinations"""
+        return sum(queue.count_regular_sync_files(path_filter) for queue in self.sync_queues)
 
-    def add_to_locked_files(self, file):
-        """Add file to locked files"""
-        # Return if file already exists
-        for f in self.open_files:
-            if f.path == file.path:
-                self.logger.debug(f"File {file} already in locked files")
-                return
-        self.open_files.add(file)
-        self.logger.debug(f"File {file} added to locked files")
+    def count_ready_sync_files(self, path_filter=None):
+        """Return the number of queued files eligible for sync over all destinations"""
+        return sum(queue.count_ready_sync_files(path_filter) for queue in self.sync_queues)
+
+    def promote_quiet_files(self):
+        """Advance the debounce timers, return the number of files that became eligible for sync"""
+        return sum(queue.promote_quiet_files() for queue in self.sync_queues)
+
+    def delete_fs_event_for_path(self, path):
+        """Delete filesystem events for a given path from every destination"""
+        for queue in self.sync_queues:
+            queue.delete_fs_event_for_path(path)
 
     def get_all_events_for_path(self, path):
         """Return all events for a given path"""
@@ -357,9 +584,43 @@ class FilesystemMonitor:
             path
         ) + self.get_regular_sync_files(path)
 
+    def delete_from_queue(self, queue, path, delete_up_to_time=None):
+        """Delete a path from a queue, optionally only if not changed since delete_up_to_time"""
+        f = queue.get(path)
+        if f is None:
+            return False
+        if delete_up_to_time is not None and f.last_seen >= delete_up_to_time:
+            return False
+        del queue[path]
+        return True
+
+    def add_to_queue(self, queue, file):
+        """Add file to a queue unless its path is already queued, return True if added"""
+        if file.path in queue:
+            return False
+        queue[file.path] = file
+        return True
+
+    def delete_locked_file(self, path, delete_up_to_time=None):
+        """Delete file from locked files using path"""
+        self.delete_from_queue(self.open_files, path, delete_up_to_time)
+        self.logger.debug(f"File {path} removed from locked files")
+
+    def add_to_locked_files(self, file):
+        """Add file to locked files"""
+        if not self.add_to_queue(self.open_files, file):
+            self.logger.debug(f"File {file} already in locked files")
+            return
+        self.logger.debug(f"File {file} added to locked files")
+
+    def clear_locked_files(self):
+        """Clear locked files"""
+        self.open_files.clear()
+        self.logger.info("Locked files cleared")
+
     def clear_all_sync_files(self):
         """Clear all files that need sync"""
-        self.clear_immediate_sync_files()
-        self.clear_regular_sync_files()
+        for queue in self.sync_queues:
+            queue.clear()
         self.clear_locked_files()
         self.logger.info("All sync files cleared")
@@ -0,0 +1,181 @@
+"""Content fingerprints of synced files, to skip syncs of files whose bytes didn't change"""
+import os
+import mmap
+import stat
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .logs import Logger
+from .constants import (
+    FINGERPRINT_CACHE_SIZE,
+    FINGERPRINT_WORKERS,
+    FINGERPRINT_CHUNK_SIZE,
+    FINGERPRINT_MMAP_THRESHOLD,
+)
+
+# Approximate memory used by an entry besides its path
+ENTRY_OVERHEAD = 320
+DIGEST_SIZE = 16
+
+
+def file_digest(path, size):
+    """Return the blake2b digest of a file's content
+
+    Small files are read in chunks, files of FINGERPRINT_MMAP_THRESHOLD bytes
+    or more are memory-mapped and hashed a chunk at a time.
+    """
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        if size >= FINGERPRINT_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(mapped), FINGERPRINT_CHUNK_SIZE):
+                        digest.update(view[offset:offset + FINGERPRINT_CHUNK_SIZE])
+                finally:
+                    view.release()
+        else:
+            for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.digest()
+
+
+class Fingerprint:
+    """Digest of a file for the stat it was computed at, and the state last synced per destination"""
+
+    __slots__ = ("inode", "size", "mtime_ns", "metadata", "digest", "synced")
+
+    def __init__(self, inode, size, mtime_ns, metadata, digest):
+        self.inode = inode
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.metadata = metadata  # (mode, uid, gid)
+        self.digest = digest
+        self.synced = {}  # Destination -> (digest, metadata) last synced
+
+
+class FingerprintCache:
+    """LRU cache of file digests keyed by path, bounded to max_bytes
+
+    A digest is reused as long as the inode, size and mtime of the file are
+    unchanged, so a file is only read again once it was written. A file whose
+    digest, mode and ownership match what was last synced to a destination
+    has nothing to transfer, a touch or an identical rewrite is skipped.
+    """
+
+    def __init__(self, max_bytes=FINGERPRINT_CACHE_SIZE, workers=FINGERPRINT_WORKERS):
+        """Initialize the cache
+
+        :param max_bytes: Approximate memory the cache may use
+        :type max_bytes: int
+        :param workers: Threads hashing files in parallel
+        :type workers: int
+        """
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()  # Path -> Fingerprint, least recently used first
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fingerprint")
+        self.logger = Logger()
+
+    def fingerprint(self, path):
+        """Return the fingerprint of a regular file, None if it isn't one or can't be read"""
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(path_stat.st_mode):
+            return None
+        metadata = (path_stat.st_mode, path_stat.st_uid, path_stat.st_gid)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+                if (entry.inode, entry.size, entry.mtime_ns) == (
+                    path_stat.st_ino, path_stat.st_size, path_stat.st_mtime_ns
+                ):
+                    entry.metadata = metadata
+                    return entry
+        try:
+            digest = file_digest(path, path_stat.st_size)
+            after = os.stat(path)
+        except (OSError, ValueError) as e:
+            self.logger.debug(f"Could not fingerprint {path}: {e}")
+            return None
+        if (after.st_ino, after.st_size, after.st_mtime_ns) != (
+            path_stat.st_ino, path_stat.st_size, path_stat.st_mtime_ns
+        ):
+            # Written while it was hashed, the digest matches neither version
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                entry = Fingerprint(path_stat.st_ino, path_stat.st_size, path_stat.st_mtime_ns, metadata, digest)
+                self.entries[path] = entry
+                self.used_bytes += ENTRY_OVERHEAD + len(path)
+                self.evict()
+            else:
+                entry.inode = path_stat.st_ino
+                entry.size = path_stat.st_size
+                entry.mtime_ns = path_stat.st_mtime_ns
+                entry.metadata = metadata
+                entry.digest = digest
+        return entry
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits in max_bytes"""
+        while self.used_bytes > self.max_bytes and self.entries:
+            path, entry = self.entries.popitem(last=False)
+            self.used_bytes -= ENTRY_OVERHEAD + len(path) + len(entry.synced) * DIGEST_SIZE
+
+    def state(self, destination, path):
+        """Return (current state, state last synced to destination) of path, None if it has no fingerprint"""
+        entry = self.fingerprint(path)
+        if entry is None:
+            return None, None
+        return (entry.digest, entry.metadata), entry.synced.get(destination)
+
+    def filter_unchanged(self, destination, files):
+        """Split files into those that need a sync and those unchanged since the last one
+
+        Files are fingerprinted in the thread pool. The state of the files to
+        sync is returned so record_synced stores what was seen before the
+        transfer: a file written during the transfer is synced again next time.
+
+        :param destination: Name of the destination
+        :type destination: str
+        :param files: Queued files
+        :type files: list
+        :return: (files to sync, unchanged files, {path: state} of the files to sync)
+        :rtype: tuple
+        """
+        states = self.executor.map(lambda file: self.state(destination, file.path), files)
+        to_sync, skipped, snapshot = [], [], {}
+        for file, (current, synced) in zip(files, states):
+            if current is not None and current == synced:
+                skipped.append(file)
+                continue
+            to_sync.append(file)
+            if current is not None:
+                snapshot[file.path] = current
+        return to_sync, skipped, snapshot
+
+    def record_synced(self, destination, snapshot):
+        """Remember the state of files synced to destination, as returned by filter_unchanged"""
+        with self.lock:
+            for path, state in snapshot.items():
+                entry = self.entries.get(path)
+                if entry is None:
+                    continue  # Evicted since, it is fingerprinted again on its next change
+                if destination not in entry.synced:
+                    self.used_bytes += DIGEST_SIZE
+                entry.synced[destination] = state
+            self.evict()
+
+    def forget(self, path):
+        """Drop the fingerprint of a path"""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.used_bytes -= ENTRY_OVERHEAD + len(path) + len(entry.synced) * DIGEST_SIZE
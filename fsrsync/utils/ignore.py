@@ -0,0 +1,109 @@
+"""Ignore rules of a destination compiled into a single regular expression"""
+import re
+
+# Prefix of rules given as a regular expression instead of a glob
+REGEX_RULE_PREFIX = "re:"
+
+
+def glob_to_regex(pattern):
+    """Translate a gitignore style glob to a regular expression
+
+    "*" and "?" never match a slash, "**" matches across directories and
+    "[...]" is a character class ("[!...]" negated).
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            content = pattern[i + 1:end].replace("\\", "\\\\")
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            regex.append(f"[{content}]")
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return "".join(regex)
+
+
+def rule_to_regex(rule):
+    """Translate an exclude rule to a regex matching the path relative to the destination root
+
+    Like rsync and gitignore, a rule starting with a slash is anchored to the
+    root, a rule without a slash matches at any depth, and a rule ending with
+    a slash only matches directories. A rule matching a directory also
+    matches everything below it.
+    """
+    if rule.startswith(REGEX_RULE_PREFIX):
+        return f".*?(?:{rule[len(REGEX_RULE_PREFIX):]})"
+    directory_only = rule.endswith("/")
+    rule = rule.strip("/") if directory_only else rule
+    anchored = rule.startswith("/") or "/" in rule
+    regex = glob_to_regex(rule.lstrip("/"))
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return regex + ("/" if directory_only else "(?:/|$)")
+
+
+def normalize_extension(extension):
+    """Return an extension without its leading dot"""
+    return extension[1:] if extension.startswith(".") else extension
+
+
+class IgnoreMatcher:
+    """Match paths below a destination root against its exclude rules and ignored extensions
+
+    Every rule is compiled into one alternation, so checking a path is a
+    single regex match whatever the number of rules.
+    """
+
+    def __init__(self, root, patterns=None, extensions=None):
+        """Compile the rules of a destination
+
+        :param root: Destination path the rules are relative to
+        :type root: str
+        :param patterns: Exclude rules (globs, directories, "re:" regular expressions)
+        :type patterns: list, optional
+        :param extensions: Ignored file extensions, with or without the leading dot
+        :type extensions: list, optional
+        """
+        self.root = root.rstrip("/") + "/"
+        self.patterns = [pattern.strip() for pattern in patterns or []
+                         if pattern.strip() and not pattern.strip().startswith("#")]
+        self.extensions = [normalize_extension(extension) for extension in extensions or [] if extension]
+        alternatives = [rule_to_regex(pattern) for pattern in self.patterns]
+        if self.extensions:
+            names = "|".join(re.escape(extension) for extension in self.extensions)
+            alternatives.append(rf"(?:.*/)?[^/]*\.(?:{names})$")
+        self.regex = re.compile("|".join(alternatives)) if alternatives else None
+
+    def matches(self, path):
+        """Check if path is below the root and ignored"""
+        if self.regex is None or not path.startswith(self.root):
+            return False
+        relative_path = path[len(self.root):]
+        return bool(relative_path) and self.regex.match(relative_path) is not None
+
+    def rsync_excludes(self):
+        """Return the rules as rsync --exclude patterns
+
+        Regular expression rules have no rsync equivalent and are only applied
+        to events.
+        """
+        excludes = [pattern for pattern in self.patterns if not pattern.startswith(REGEX_RULE_PREFIX)]
+        excludes.extend(f"*.{extension}" for extension in self.extensions)
+        return excludes
@@ -0,0 +1,241 @@
+"""Write-ahead journal of the files pending sync, so a restart resumes where it stopped"""
+import os
+import json
+import time
+import threading
+from .logs import Logger
+from .constants import JOURNAL_FSYNC_INTERVAL, JOURNAL_SEGMENT_SIZE, JOURNAL_MAX_SEGMENTS
+
+# Record types, one JSON list per line
+ENQUEUE = "E"  # [ENQUEUE, destination, kind, path]
+ACK = "A"  # [ACK, destination, path]
+CLEAR = "C"  # [CLEAR, destination]
+FULL_SYNC = "F"  # [FULL_SYNC, destination, timestamp]
+
+# Queue a pending path belongs to
+IMMEDIATE = "i"
+REGULAR = "r"
+
+SEGMENT_PREFIX = "journal."
+SEGMENT_SUFFIX = ".log"
+
+
+class Journal:
+    """Append-only journal of the paths queued and acknowledged per destination
+
+    Records are appended to the current segment file and fsynced at most every
+    fsync_interval seconds, so a crash loses at most that much of the journal.
+    Once a segment reaches segment_size a new one is started, and once there
+    are more than max_segments they are compacted into a single segment holding
+    only the paths still pending and the last full sync of every destination.
+
+    Replaying is idempotent: a path is pending if its last record is an
+    enqueue, whatever happened before.
+    """
+
+    def __init__(self, directory, fsync_interval=JOURNAL_FSYNC_INTERVAL,
+                 segment_size=JOURNAL_SEGMENT_SIZE, max_segments=JOURNAL_MAX_SEGMENTS):
+        """Initialize the journal, nothing is read or written until open is called
+
+        :param directory: Directory holding the segment files
+        :type directory: str
+        :param fsync_interval: Maximum seconds between fsyncs of appended records
+        :type fsync_interval: int
+        :param segment_size: Size in bytes after which a new segment is started
+        :type segment_size: int
+        :param max_segments: Number of segments after which they are compacted
+        :type max_segments: int
+        """
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.pending = {}  # Destination -> {path: kind}
+        self.full_syncs = {}  # Destination -> timestamp of the last full sync
+        self.segment = None  # Segment records are appended to
+        self.segment_id = 0
+        self.dirty = False  # Records written since the last fsync
+        self.last_fsync = 0
+        self.lock = threading.Lock()
+        self.logger = Logger()
+
+    def segment_path(self, segment_id):
+        """Return the path of a segment file"""
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment_id:08d}{SEGMENT_SUFFIX}")
+
+    def segment_ids(self):
+        """Return the ids of the segments on disk, oldest first"""
+        ids = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segment_id = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+                if segment_id.isdigit():
+                    ids.append(int(segment_id))
+        return sorted(ids)
+
+    def open(self):
+        """Replay the segments on disk and compact them, return False if the journal can't be used"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            ids = self.segment_ids()
+            records = 0
+            for segment_id in ids:
+                records += self.replay(self.segment_path(segment_id))
+            self.segment_id = ids[-1] if ids else 0
+            with self.lock:
+                self.compact()
+        except OSError as e:
+            self.logger.error(f"Could not open journal in {self.directory}: {e}")
+            self.segment = None
+            return False
+        pending = sum(len(paths) for paths in self.pending.values())
+        self.logger.info(
+            f"Replayed {records} journal records from {len(ids)} segments, {pending} paths pending sync"
+        )
+        return True
+
+    def replay(self, segment_path):
+        """Apply the records of a segment, return the number of records applied"""
+        applied = 0
+        with open(segment_path, "r", encoding="utf-8") as segment:
+            for line in segment:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A record cut short by a crash is the last one of its segment
+                    self.logger.warning(f"Ignoring truncated record in journal segment {segment_path}")
+                    break
+                self.apply(record)
+                applied += 1
+        return applied
+
+    def apply(self, record):
+        """Apply a record to the in-memory state"""
+        record_type, destination = record[0], record[1]
+        if record_type == ENQUEUE:
+            self.pending.setdefault(destination, {})[record[3]] = record[2]
+        elif record_type == ACK:
+            self.pending.get(destination, {}).pop(record[2], None)
+        elif record_type == CLEAR:
+            self.pending.pop(destination, None)
+        elif record_type == FULL_SYNC:
+            self.full_syncs[destination] = record[2]
+
+    def append(self, record):
+        """Apply a record and write it to the current segment"""
+        with self.lock:
+            self.apply(record)
+            if self.segment is None:
+                return
+            try:
+                self.segment.write(json.dumps(record, separators=(",", ":")) + "\n")
+                self.dirty = True
+                if self.segment.tell() >= self.segment_size:
+                    self.rotate()
+            except OSError as e:
+                self.logger.error(f"Could not write to journal segment {self.segment_path(self.segment_id)}: {e}")
+
+    def enqueue(self, destination, path, kind):
+        """Record that path is pending sync to destination"""
+        self.append([ENQUEUE, destination, kind, path])
+
+    def ack(self, destination, path):
+        """Record that path no longer needs to be synced to destination"""
+        self.append([ACK, destination, path])
+
+    def clear(self, destination):
+        """Record that nothing is pending for destination"""
+        self.append([CLEAR, destination])
+
+    def record_full_sync(self, destination, timestamp=None):
+        """Record the time of the last full sync of destination"""
+        self.append([FULL_SYNC, destination, timestamp or time.time()])
+
+    def pending_paths(self, destination):
+        """Return {path: kind} for the paths pending sync to destination"""
+        return dict(self.pending.get(destination, {}))
+
+    def last_full_sync(self, destination):
+        """Return the timestamp of the last full sync of destination, None if there was none"""
+        return self.full_syncs.get(destination)
+
+    def retain(self, destinations):
+        """Forget destinations that are no longer configured"""
+        for destination in set(self.pending) | set(self.full_syncs):
+            if destination not in destinations:
+                self.clear(destination)
+                with self.lock:
+                    self.full_syncs.pop(destination, None)
+
+    def sync(self, force=False):
+        """Fsync the records appended since the last fsync, at most every fsync_interval seconds"""
+        with self.lock:
+            if self.segment is None or not self.dirty:
+                return
+            if not force and time.time() - self.last_fsync < self.fsync_interval:
+                return
+            try:
+                self.flush()
+            except OSError as e:
+                self.logger.error(f"Could not sync journal segment {self.segment_path(self.segment_id)}: {e}")
+
+    def flush(self):
+        """Flush and fsync the current segment"""
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.dirty = False
+        self.last_fsync = time.time()
+
+    def rotate(self):
+        """Start a new segment, compacting the journal once there are too many"""
+        self.flush()
+        self.segment.close()
+        self.segment = None
+        if len(self.segment_ids()) >= self.max_segments:
+            self.compact()
+            return
+        self.segment_id += 1
+        self.segment = open(self.segment_path(self.segment_id), "a", encoding="utf-8")
+
+    def compact(self):
+        """Write the current state as a new segment and delete the older segments"""
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        snapshot_id = self.segment_id + 1
+        snapshot_path = self.segment_path(snapshot_id)
+        temporary_path = snapshot_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot:
+            for destination, timestamp in self.full_syncs.items():
+                snapshot.write(json.dumps([FULL_SYNC, destination, timestamp], separators=(",", ":")) + "\n")
+            for destination, paths in self.pending.items():
+                for path, kind in paths.items():
+                    snapshot.write(json.dumps([ENQUEUE, destination, kind, path], separators=(",", ":")) + "\n")
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        # The snapshot only replaces the older segments once it is complete on disk
+        os.replace(temporary_path, snapshot_path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        for segment_id in self.segment_ids():
+            if segment_id < snapshot_id:
+                os.remove(self.segment_path(segment_id))
+        self.segment_id = snapshot_id
+        self.segment = open(snapshot_path, "a", encoding="utf-8")
+        self.dirty = False
+        self.last_fsync = time.time()
+
+    def close(self):
+        """Fsync and close the current segment"""
+        with self.lock:
+            if self.segment is None:
+                return
+            try:
+                self.flush()
+                self.segment.close()
+            except OSError as e:
+                self.logger.error(f"Could not close journal segment {self.segment_path(self.segment_id)}: {e}")
+            self.segment = None
@@ -0,0 +1,224 @@
+"""Persistent manifest of the files last synced to each destination"""
+import os
+import sqlite3
+import threading
+from .logs import Logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    destination TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (destination, parent, name)
+) WITHOUT ROWID
+"""
+
+
+def prefix_end(prefix):
+    """Return the smallest string greater than every string starting with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class ManifestDiff:
+    """Differences between a tree and its manifest, applied to the manifest once synced"""
+
+    def __init__(self, destination, root):
+        self.destination = destination
+        self.root = root
+        self.changed = []  # New or modified paths, a new directory stands for everything below it
+        self.deleted = []  # Paths in the manifest that no longer exist
+        self.upserts = []  # (parent, name, inode, size, mtime_ns) rows to write
+        self.removed = []  # (parent, name) rows to delete, directories with everything below
+
+    def has_changes(self):
+        """Check if anything changed since the manifest was written"""
+        return bool(self.changed or self.deleted)
+
+    def sync_units(self):
+        """Return the paths to sync, deletions are synced through their parent directory"""
+        units = list(self.changed)
+        parents = {os.path.dirname(path.rstrip("/")) + "/" for path in self.deleted}
+        units.extend(sorted(parents))
+        return units
+
+
+class Manifest:
+    """Inode, size and mtime of every file last synced to each destination, kept in sqlite
+
+    Rows are keyed by destination and parent directory, so diffing a tree only
+    ever holds one directory's rows in memory. Directories are stored with a
+    trailing slash in their name. A diff is only written back with commit,
+    once the sync it produced has succeeded.
+    """
+
+    def __init__(self, path):
+        """Initialize the manifest, the database is opened by open
+
+        :param path: Path of the sqlite database
+        :type path: str
+        """
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.logger = Logger()
+
+    def open(self):
+        """Open or create the database, return False if it can't be used"""
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(SCHEMA)
+            self.connection.commit()
+        except (OSError, sqlite3.Error) as e:
+            self.logger.error(f"Could not open manifest {self.path}: {e}")
+            self.connection = None
+            return False
+        return True
+
+    def is_empty(self, destination):
+        """Check if nothing was recorded for destination yet"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM files WHERE destination = ? LIMIT 1", (destination,)
+            ).fetchone()
+        return row is None
+
+    def directory_rows(self, destination, parent):
+        """Return {name: (inode, size, mtime_ns)} for the entries of a directory"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT name, inode, size, mtime_ns FROM files WHERE destination = ? AND parent = ?",
+                (destination, parent),
+            ).fetchall()
+        return {name: (inode, size, mtime_ns) for name, inode, size, mtime_ns in rows}
+
+    def diff(self, destination, root, ignore=None, subtree=None):
+        """Compare the tree below root, or below subtree only, with the manifest
+
+        :param destination: Name of the destination
+        :type destination: str
+        :param root: Source path of the destination
+        :type root: str
+        :param ignore: Ignore rules of the destination, ignored paths are skipped
+        :type ignore: IgnoreMatcher, optional
+        :param subtree: Directory below root to compare, defaults to root
+        :type subtree: str, optional
+        :rtype: ManifestDiff
+        """
+        root = root.rstrip("/") + "/"
+        diff = ManifestDiff(destination, root)
+        # (directory, True if it is new and already reported as changed)
+        stack = [((subtree or root).rstrip("/") + "/", False)]
+        while stack:
+            directory, reported = stack.pop()
+            parent = directory[len(root):]
+            known = self.directory_rows(destination, parent)
+            try:
+                with os.scandir(directory) as scanned:
+                    entries = list(scanned)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                path = entry.path + "/" if is_dir else entry.path
+                if ignore is not None and ignore.matches(path):
+                    continue
+                name = entry.name + "/" if is_dir else entry.name
+                if is_dir:
+                    row = (entry_stat.st_ino, 0, 0)
+                else:
+                    row = (entry_stat.st_ino, entry_stat.st_size, entry_stat.st_mtime_ns)
+                is_new = known.pop(name, None) != row
+                if is_new:
+                    diff.upserts.append((parent, name) + row)
+                    # Everything below a new directory is synced with it
+                    if not reported:
+                        diff.changed.append(path)
+                if is_dir:
+                    stack.append((path, reported or is_new))
+            for name in known:
+                diff.removed.append((parent, name))
+                diff.deleted.append(directory + name)
+        return diff
+
+    def commit(self, diff):
+        """Write the rows of a diff whose changes were synced"""
+        destination = diff.destination
+        with self.lock:
+            try:
+                with self.connection:
+                    for parent, name in diff.removed:
+                        self.connection.execute(
+                            "DELETE FROM files WHERE destination = ? AND parent = ? AND name = ?",
+                            (destination, parent, name),
+                        )
+                        if name.endswith("/"):
+                            below = parent + name
+                            self.connection.execute(
+                                "DELETE FROM files WHERE destination = ? AND parent >= ? AND parent < ?",
+                                (destination, below, prefix_end(below)),
+                            )
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                        ((destination,) + row for row in diff.upserts),
+                    )
+            except sqlite3.Error as e:
+                self.logger.error(f"Could not update manifest of {destination}: {e}")
+                return False
+        return True
+
+    def record_synced(self, destination, root, paths, ignore=None):
+        """Update the manifest with paths synced from the event stream
+
+        Directories are compared with the manifest as a whole and files are
+        stat'ed and written. Paths that no longer exist are kept, the next full
+        sync reports them as deleted and syncs their directory so the deletion
+        reaches the destination.
+        """
+        root = root.rstrip("/") + "/"
+        diff = ManifestDiff(destination, root)
+        for path in paths:
+            if path == root:
+                subtree = self.diff(destination, root, ignore)
+                diff.upserts.extend(subtree.upserts)
+                continue
+            if not path.startswith(root):
+                continue
+            relative_path = path[len(root):]
+            parent, _, name = relative_path.rstrip("/").rpartition("/")
+            parent = parent + "/" if parent else ""
+            try:
+                path_stat = os.lstat(path)
+            except OSError:
+                continue
+            if path.endswith("/"):
+                diff.upserts.append((parent, name + "/", path_stat.st_ino, 0, 0))
+                subtree = self.diff(destination, root, ignore, path)
+                diff.upserts.extend(subtree.upserts)
+            else:
+                diff.upserts.append((parent, name, path_stat.st_ino, path_stat.st_size, path_stat.st_mtime_ns))
+        return self.commit(diff)
+
+    def forget(self, destination):
+        """Drop every row of a destination"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM files WHERE destination = ?", (destination,))
+
+    def close(self):
+        """Close the database"""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,141 @@
+"""Merkle digests of directory trees, compared between both ends of a destination"""
+import os
+import time
+import hashlib
+import threading
+from .constants import MERKLE_CACHE_TTL
+
+
+def entry_digest(*fields):
+    """Return the hex digest of the fields of a directory entry"""
+    digest = hashlib.blake2b(digest_size=16)
+    for field in fields:
+        digest.update(str(field).encode("utf-8", "surrogateescape"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DirectoryDigests:
+    """Merkle digests of the directories below a root
+
+    A file is summarized by its name, size and mtime in whole seconds (what
+    rsync preserves everywhere), a symlink by its target and a directory by
+    the digests of its entries, so two trees have the same digest when rsync
+    would find nothing to transfer between them. Directory digests are cached
+    per scope, one reconciliation pass, so the pass descends a tree without
+    walking it again at every level while the next pass sees every change.
+    Scopes older than ttl seconds are dropped by expire.
+    """
+
+    def __init__(self, ttl=MERKLE_CACHE_TTL):
+        self.ttl = ttl
+        self.cache = {}  # (scope, directory, ignore rules) -> (time computed, digest)
+        self.lock = threading.Lock()
+
+    def scan(self, directory, ignore=None, scope=None):
+        """Return ({name: digest} of subdirectories, {name: digest} of other entries) of a directory"""
+        directories, files = {}, {}
+        try:
+            with os.scandir(directory) as scanned:
+                entries = list(scanned)
+        except OSError:
+            return directories, files
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir:
+                    path = entry.path + "/"
+                    if ignore is None or not ignore.matches(path):
+                        directories[entry.name] = self.directory_digest(path, ignore, scope)
+                    continue
+                if ignore is not None and ignore.matches(entry.path):
+                    continue
+                if entry.is_symlink():
+                    files[entry.name] = entry_digest("l", entry.name, os.readlink(entry.path))
+                else:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    files[entry.name] = entry_digest(
+                        "f", entry.name, entry_stat.st_size, int(entry_stat.st_mtime)
+                    )
+            except OSError:
+                continue
+        return directories, files
+
+    def directory_digest(self, directory, ignore=None, scope=None):
+        """Return the digest of everything below a directory, cached within scope, never cached without one"""
+        directory = directory.rstrip("/") + "/"
+        key = (scope, directory, ignore.regex.pattern if ignore is not None and ignore.regex else None)
+        if scope is not None:
+            with self.lock:
+                cached = self.cache.get(key)
+            if cached is not None:
+                return cached[1]
+        directories, files = self.scan(directory, ignore, scope)
+        digest = self.combine(directories, files)
+        if scope is not None:
+            with self.lock:
+                self.cache[key] = (time.time(), digest)
+        return digest
+
+    @staticmethod
+    def combine(directories, files):
+        """Return the digest of a directory from the digests of its entries"""
+        fields = [entry_digest("d", name, digest) for name, digest in sorted(directories.items())]
+        fields.extend(digest for _, digest in sorted(files.items()))
+        return entry_digest("dir", *fields)
+
+    def children(self, directory, ignore=None, scope=None):
+        """Return the digest of a directory and of each of its entries
+
+        :param directory: Directory to describe
+        :type directory: str
+        :param ignore: Ignore rules, ignored entries are left out of every digest
+        :type ignore: IgnoreMatcher, optional
+        :param scope: Reconciliation pass the digests of subdirectories are cached for
+        :type scope: str, optional
+        :return: {"digest": str, "directories": {name: digest}, "files": {name: digest}}
+        :rtype: dict
+        """
+        directories, files = self.scan(directory, ignore, scope)
+        return {
+            "digest": self.combine(directories, files),
+            "directories": directories,
+            "files": files,
+        }
+
+    def expire(self):
+        """Drop the cached digests computed more than ttl seconds ago, their passes are over"""
+        now = time.time()
+        with self.lock:
+            for key in [key for key, (computed, _) in self.cache.items() if now - computed >= self.ttl]:
+                del self.cache[key]
+
+
+def divergent_paths(local, remote, directory=""):
+    """Compare the entries of a directory on both ends
+
+    :param local: Children of the directory on the source, as returned by DirectoryDigests.children
+    :type local: dict
+    :param remote: Children of the directory on the destination
+    :type remote: dict
+    :param directory: Path of the directory relative to the root, with a trailing slash
+    :type directory: str
+    :return: (relative subdirectories to descend into, relative paths to sync)
+    :rtype: tuple
+    """
+    descend, to_sync = [], []
+    remote_directories = remote.get("directories", {})
+    remote_files = remote.get("files", {})
+    for name, digest in local["directories"].items():
+        if name not in remote_directories:
+            to_sync.append(f"{directory}{name}/")
+        elif remote_directories[name] != digest:
+            descend.append(f"{directory}{name}/")
+    for name, digest in local["files"].items():
+        if remote_files.get(name) != digest:
+            to_sync.append(f"{directory}{name}")
+    # Entries only on the destination are removed by syncing their directory
+    extra = set(remote_directories) - set(local["directories"]) or set(remote_files) - set(local["files"])
+    if extra:
+        to_sync.append(directory)
+    return descend, to_sync
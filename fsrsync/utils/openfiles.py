@@ -0,0 +1,98 @@
+"""Index of files held open by any process, built from a single /proc scan"""
+import os
+import stat
+import time
+import threading
+from .wrappers import singleton
+from .constants import OPEN_FILE_INDEX_TTL
+
+# Access mode bits of the fdinfo flags field
+O_ACCMODE = 0o3
+O_RDONLY = 0o0
+
+
+@singleton
+class OpenFileIndex:
+    """Shared index of open regular files keyed by (st_dev, st_ino)
+
+    The index is rebuilt at most once every ttl seconds, so every "is this file
+    open?" question asked during a tick is answered from the same /proc scan.
+    """
+
+    def __init__(self, ttl=OPEN_FILE_INDEX_TTL, proc_path="/proc"):
+        self.ttl = ttl
+        self.proc_path = proc_path
+        self.open_files = {}  # (st_dev, st_ino) -> [fd paths]
+        self.write_mode = {}  # (st_dev, st_ino) -> open for writing, filled on demand
+        self.built_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Rebuild the index from /proc/*/fd"""
+        open_files = {}
+        try:
+            pids = [pid for pid in os.listdir(self.proc_path) if pid.isdigit()]
+        except OSError:
+            pids = []
+        for pid in pids:
+            fd_dir = f"{self.proc_path}/{pid}/fd"
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue  # Process exited or not accessible
+            for fd in fds:
+                fd_path = f"{fd_dir}/{fd}"
+                try:
+                    fd_stat = os.stat(fd_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(fd_stat.st_mode):
+                    continue
+                open_files.setdefault((fd_stat.st_dev, fd_stat.st_ino), []).append(fd_path)
+        with self.lock:
+            self.open_files = open_files
+            self.write_mode = {}
+            self.built_at = time.monotonic()
+
+    def ensure_fresh(self):
+        """Rebuild the index if it is older than ttl"""
+        if self.built_at is None or time.monotonic() - self.built_at > self.ttl:
+            self.refresh()
+
+    def is_fd_writable(self, fd_path):
+        """Check the access mode of an open file descriptor in its fdinfo"""
+        fdinfo_path = fd_path.replace("/fd/", "/fdinfo/", 1)
+        try:
+            with open(fdinfo_path, "r", encoding="utf-8") as fdinfo:
+                for line in fdinfo:
+                    if line.startswith("flags:"):
+                        return int(line.split()[1], 8) & O_ACCMODE != O_RDONLY
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def is_open(self, path, for_write=False):
+        """Check if path is open by any process
+
+        :param path: The path to the file
+        :type path: str
+        :param for_write: Only count file descriptors open for writing, defaults to False
+        :type for_write: bool, optional
+        :return: True if the file is open, False otherwise
+        :rtype: bool
+        """
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return False
+        self.ensure_fresh()
+        key = (file_stat.st_dev, file_stat.st_ino)
+        with self.lock:
+            fd_paths = self.open_files.get(key)
+            if not fd_paths:
+                return False
+            if not for_write:
+                return True
+            if key not in self.write_mode:
+                self.write_mode[key] = any(self.is_fd_writable(fd_path) for fd_path in fd_paths)
+            return self.write_mode[key]
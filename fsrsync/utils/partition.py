@@ -0,0 +1,91 @@
+"""Split a tree into balanced subtrees for a partitioned full sync"""
+import os
+from .shards import split_into_shards
+from .constants import RSYNC_SHARD_FILE_COST
+
+
+def scan_tree(root, ignore=None):
+    """Return the file count and size of every subtree below root
+
+    :param root: Directory to scan
+    :type root: str
+    :param ignore: Ignore rules, ignored entries are not counted
+    :type ignore: IgnoreMatcher, optional
+    :return: ({relative directory: [files, bytes]}, {relative directory: [relative subdirectories]}),
+        directories relative to root with a trailing slash, root itself is ""
+    :rtype: tuple
+    """
+    root = root.rstrip("/") + "/"
+    totals = {}
+    children = {}
+    order = []
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        order.append(directory)
+        totals[directory] = [0, 0]
+        children[directory] = []
+        try:
+            with os.scandir(root + directory) as scanned:
+                entries = list(scanned)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectory = f"{directory}{entry.name}/"
+                    if ignore is None or not ignore.matches(root + subdirectory):
+                        children[directory].append(subdirectory)
+                        stack.append(subdirectory)
+                    continue
+                if ignore is not None and ignore.matches(entry.path):
+                    continue
+                totals[directory][0] += 1
+                totals[directory][1] += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    # Children are always scanned after their parent, add them up in reverse
+    for directory in reversed(order):
+        if directory:
+            parent = directory[:directory.rstrip("/").rfind("/") + 1]
+            totals[parent][0] += totals[directory][0]
+            totals[parent][1] += totals[directory][1]
+    return totals, children
+
+
+def partition_tree(root, count, ignore=None):
+    """Split the tree below root into count partitions of whole subtrees
+
+    Directories costing more than a partition's share are split into their
+    subdirectories, the remaining subtrees are packed into count partitions
+    balancing file count and bytes. Files directly in root or in a split
+    directory belong to no partition, they are synced by a last run over root
+    that excludes every partitioned subtree.
+
+    :param root: Directory to partition
+    :type root: str
+    :param count: Number of partitions
+    :type count: int
+    :param ignore: Ignore rules, ignored entries are not counted
+    :type ignore: IgnoreMatcher, optional
+    :return: (partitions as Shard objects holding relative subtrees, relative subtrees in any partition)
+    :rtype: tuple
+    """
+    totals, children = scan_tree(root, ignore)
+
+    def cost(directory):
+        files, size = totals[directory]
+        return size + files * RSYNC_SHARD_FILE_COST
+
+    share = cost("") / max(1, count)
+    subtrees = []
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        for subdirectory in children[directory]:
+            if cost(subdirectory) > share and children[subdirectory]:
+                stack.append(subdirectory)
+            else:
+                subtrees.append(subdirectory)
+    partitions = split_into_shards(subtrees, count, lambda subtree: tuple(totals[subtree]))
+    return partitions, subtrees
@@ -0,0 +1,176 @@
+"""Path keyed index with prefix queries backed by a path-component trie"""
+
+
+def split_path(path):
+    """Split a path into its components, ignoring empty ones"""
+    return [part for part in path.split("/") if part]
+
+
+class PathNode:
+    """Node of the path-component trie"""
+
+    __slots__ = ("children", "keys", "count")
+
+    def __init__(self):
+        self.children = None  # Component -> PathNode, created on demand
+        self.keys = None  # Key ending at this node, a list if several do (e.g. "a/b" and "a/b/")
+        self.count = 0  # Number of keys in this subtree
+
+
+class PathIndex:
+    """Mapping of path -> record answering prefix queries in time proportional to the result
+
+    Lookups, inserts and removals by exact path are dict operations, the trie is
+    only walked for the prefix queries and to keep the subtree counts up to date.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.root = PathNode()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, path):
+        return path in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, path):
+        return self.records[path]
+
+    def __setitem__(self, path, record):
+        if path not in self.records:
+            node = self.root
+            node.count += 1
+            for part in split_path(path):
+                if node.children is None:
+                    node.children = {}
+                node = node.children.setdefault(part, PathNode())
+                node.count += 1
+            if node.keys is None:
+                node.keys = path
+            elif isinstance(node.keys, str):
+                node.keys = [node.keys, path]
+            else:
+                node.keys.append(path)
+        self.records[path] = record
+
+    def __delitem__(self, path):
+        del self.records[path]
+        parts = split_path(path)
+        nodes = [self.root]
+        for part in parts:
+            nodes.append(nodes[-1].children[part])
+        node = nodes[-1]
+        if isinstance(node.keys, str):
+            node.keys = None
+        else:
+            node.keys.remove(path)
+            if len(node.keys) == 1:
+                node.keys = node.keys[0]
+        for node in nodes:
+            node.count -= 1
+        # Prune the branch that no longer holds any key
+        for depth in range(len(parts), 0, -1):
+            if nodes[depth].count > 0:
+                break
+            del nodes[depth - 1].children[parts[depth - 1]]
+
+    def get(self, path, default=None):
+        """Return the record for path or default"""
+        return self.records.get(path, default)
+
+    def pop(self, path, default=None):
+        """Remove path and return its record, or default if not present"""
+        if path not in self.records:
+            return default
+        record = self.records[path]
+        del self[path]
+        return record
+
+    def values(self):
+        """Return all records"""
+        return self.records.values()
+
+    def items(self):
+        """Return all (path, record) pairs"""
+        return self.records.items()
+
+    def clear(self):
+        """Remove all records"""
+        self.records.clear()
+        self.root = PathNode()
+
+    def find_node(self, prefix):
+        """Return the trie node for prefix, or None if nothing is stored under it"""
+        node = self.root
+        for part in split_path(prefix):
+            if node.children is None:
+                return None
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def keys_under(self, prefix):
+        """Return every path stored at or below prefix"""
+        node = self.find_node(prefix)
+        if node is None:
+            return []
+        keys = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node.keys, str):
+                keys.append(node.keys)
+            elif node.keys:
+                keys.extend(node.keys)
+            if node.children:
+                stack.extend(node.children.values())
+        return keys
+
+    def values_under(self, prefix):
+        """Return every record stored at or below prefix"""
+        return [self.records[path] for path in self.keys_under(prefix)]
+
+    def values_above(self, path):
+        """Return every record stored at path or at one of its parent directories"""
+        values = []
+        node = self.root
+        parts = split_path(path)
+        depth = 0
+        while node is not None:
+            if isinstance(node.keys, str):
+                values.append(self.records[node.keys])
+            elif node.keys:
+                values.extend(self.records[key] for key in node.keys)
+            if depth == len(parts) or node.children is None:
+                break
+            node = node.children.get(parts[depth])
+            depth += 1
+        return values
+
+    def count_under(self, prefix):
+        """Return the number of records stored at or below prefix"""
+        node = self.find_node(prefix)
+        return node.count if node is not None else 0
+
+    def remove_under(self, prefix, predicate=None):
+        """Remove records at or below prefix, only those matching predicate if given
+
+        :param prefix: Path prefix to remove records from
+        :type prefix: str
+        :param predicate: Called with each record, the record is removed if it returns True
+        :type predicate: callable, optional
+        :return: Removed records
+        :rtype: list
+        """
+        removed = []
+        for path in self.keys_under(prefix):
+            record = self.records[path]
+            if predicate is None or predicate(record):
+                del self[path]
+                removed.append(record)
+        return removed
@@ -0,0 +1,67 @@
+"""Incremental rescans of watched subtrees after inotify events were lost"""
+import os
+from inotify_simple import flags
+
+# Slack for filesystems with coarse timestamps
+MTIME_SLACK = 1  # 1 second
+
+
+def directory_path(path):
+    """Return a directory path with a single trailing slash"""
+    return path.rstrip("/") + "/"
+
+
+def scan_changes(root, since, watched_dirs=None, recursive=True):
+    """Return synthetic (path, mask) events for changes below root since a timestamp
+
+    Every directory scanned (root, and everything below it when recursive) is
+    stat'ed and its entries read with scandir, every file in it is stat'ed;
+    file contents are never read. Files and directories with an mtime or ctime
+    newer than since are reported. Directories in watched_dirs that no longer
+    exist are reported as deleted, directories missing from it as created.
+
+    :param root: Directory to scan
+    :type root: str
+    :param since: Timestamp of the last change known to be delivered
+    :type since: float
+    :param watched_dirs: Directories currently watched below root, defaults to None
+    :type watched_dirs: set, optional
+    :param recursive: Descend into subdirectories, defaults to True
+    :type recursive: bool, optional
+    :return: List of (path, mask) tuples
+    :rtype: list
+    """
+    since -= MTIME_SLACK
+    watched_dirs = watched_dirs or set()
+    seen_dirs = set()
+    events = []
+    stack = [root]
+    while stack:
+        directory = directory_path(stack.pop())
+        seen_dirs.add(directory)
+        try:
+            dir_stat = os.stat(directory)
+            with os.scandir(directory) as scanned:
+                entries = list(scanned)
+        except OSError:
+            continue
+        if max(dir_stat.st_mtime, dir_stat.st_ctime) >= since:
+            if recursive and directory not in watched_dirs:
+                events.append((directory, flags.CREATE | flags.ISDIR))
+            else:
+                # Entries were added or removed, rsync the directory to catch deletes
+                events.append((directory, flags.CLOSE_WRITE | flags.ISDIR))
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                    continue
+                entry_stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if max(entry_stat.st_mtime, entry_stat.st_ctime) >= since:
+                events.append((entry.path, flags.CLOSE_WRITE))
+    for directory in watched_dirs - seen_dirs:
+        events.append((directory.rstrip("/"), flags.DELETE | flags.ISDIR))
+    return events
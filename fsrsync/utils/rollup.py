@@ -0,0 +1,100 @@
+"""Collapse per-file include lists into directories during change storms"""
+import os
+import heapq
+from .constants import ROLLUP_MIN_FILES, ROLLUP_MIN_RATIO, ROLLUP_MIN_RATIO_FILES
+
+
+def parent_directory(path):
+    """Return the parent directory of a path with a trailing slash"""
+    return os.path.dirname(path.rstrip("/")) + "/"
+
+
+def count_entries(directory):
+    """Return the number of entries in a directory, None if it can't be listed"""
+    try:
+        with os.scandir(directory) as entries:
+            return sum(1 for _ in entries)
+    except OSError:
+        return None
+
+
+def rollup_paths(paths, root, min_files=ROLLUP_MIN_FILES, min_ratio=ROLLUP_MIN_RATIO,
+                 keep_out=None):
+    """Replace the pending paths below a directory by the directory once enough of it changed
+
+    A directory is rolled up once min_files sync entries are below it, or once
+    at least min_ratio of its entries (and ROLLUP_MIN_RATIO_FILES of them) have
+    pending changes. Directories are visited deepest first and a rolled up
+    directory counts as a pending entry of its parent, so rollups cascade up to
+    root but never above it.
+
+    :param paths: Pending paths, directories end with a slash
+    :type paths: list
+    :param root: Directory the paths are synced from
+    :type root: str
+    :param min_files: Sync entries below a directory that trigger a rollup
+    :type min_files: int
+    :param min_ratio: Fraction of changed entries in a directory that triggers a rollup
+    :type min_ratio: float
+    :param keep_out: Paths that must not be synced, their directories are never rolled up
+    :type keep_out: list, optional
+    :return: Paths and rolled up directories to sync
+    :rtype: list
+    """
+    root = root.rstrip("/") + "/"
+    blocked = set()
+    for path in keep_out or []:
+        directory = parent_directory(path)
+        while directory.startswith(root) and directory not in blocked:
+            blocked.add(directory)
+            directory = parent_directory(directory)
+
+    totals = {}  # Directory -> sync entries below it, after rolling up its subdirectories
+    direct = {}  # Directory -> entries directly in it with pending changes
+    heap = []  # (-depth, directory) so the deepest directory comes first
+
+    def add_to_parent(path, count):
+        if path == root:
+            return
+        parent = parent_directory(path)
+        if not parent.startswith(root):
+            return
+        if parent not in totals:
+            totals[parent] = 0
+            direct[parent] = 0
+            heapq.heappush(heap, (-parent.count("/"), parent))
+        totals[parent] += count
+        direct[parent] += 1
+
+    for path in paths:
+        add_to_parent(path, 1)
+
+    rolled = set()
+    while heap:
+        _, directory = heapq.heappop(heap)
+        if directory not in blocked:
+            if totals[directory] >= min_files:
+                rolled.add(directory)
+            elif direct[directory] >= ROLLUP_MIN_RATIO_FILES:
+                entries = count_entries(directory)
+                if entries and direct[directory] / entries >= min_ratio:
+                    rolled.add(directory)
+        # A rolled up directory is a single entry of its parent
+        add_to_parent(directory, 1 if directory in rolled else totals[directory])
+
+    if not rolled:
+        return list(paths)
+
+    def covered(path):
+        directory = parent_directory(path)
+        while directory.startswith(root):
+            if directory in rolled:
+                return True
+            if directory == root:
+                break
+            directory = parent_directory(directory)
+        return False
+
+    units = [directory for directory in rolled if not covered(directory)]
+    units.extend(path for path in paths if path not in rolled and not covered(path))
+    return units
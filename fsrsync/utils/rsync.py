@@ -1,6 +1,55 @@
+import os
+import time
+import uuid
+import queue
+import shlex
+import posixpath
+import threading
 from .logs import Logger
-from .utils import run_command
-from .ssh_lib import run_ssh_command
+from .utils import run_command, run_process
+from .ssh_lib import run_ssh_command, run_ssh_commands, batch_script, batch_results
+from .shards import Shard, split_into_shards, path_weight
+from .partition import partition_tree
+from .rsync_stats import OUT_FORMAT, SyncOutcome, parse_output, parse_errors, merge_stats, describe_stats
+from .constants import (
+    RSYNC_SUCCESS_CODES,
+    RSYNC_PARTIAL_CODES,
+    RSYNC_MAX_CHANGES,
+    RSYNC_WORKERS,
+    RSYNC_SHARDS_PER_WORKER,
+    RSYNC_MIN_SHARD_FILES,
+    RSYNC_SHARD_RETRIES,
+)
+
+
+def rsync_pattern(path, wildcard=False):
+    """Return a path as an rsync pattern matching only itself
+
+    rsync only treats backslashes as escapes in patterns with wildcards, so
+    a path is escaped when it has wildcard characters or is used in a
+    pattern that has some.
+    """
+    if wildcard or any(char in path for char in "*?["):
+        return "".join("\\" + char if char in "*?[\\" else char for char in path)
+    return path
+
+
+def deletion_rules(directories):
+    """Return the filter rules limiting a run over the whole tree to the entries of some directories
+
+    Each directory, relative with a trailing slash ("" for the root), is
+    synced one level deep: its parent directories and its entries are
+    included, the contents of its subdirectories and everything else are
+    excluded, so with --delete only entries removed directly in it are
+    deleted on the destination.
+    """
+    rules = {}
+    for directory in directories:
+        parts = directory.strip("/").split("/") if directory.strip("/") else []
+        for depth in range(1, len(parts) + 1):
+            rules["+ /" + rsync_pattern("/".join(parts[:depth])) + "/"] = None
+        rules["+ /" + "".join(rsync_pattern(part, wildcard=True) + "/" for part in parts) + "*"] = None
+    return list(rules) + ["- *"]
 
 
 class RsyncManager:
@@ -23,6 +72,8 @@ class RsyncManager:
         post_sync_commands_checkexit_local=None,
         pre_sync_commands_checkexit_remote=None,
         post_sync_commands_checkexit_remote=None,
+        workers=RSYNC_WORKERS,
+        ssh_master=None,
     ):
         """Initialize the rsync manager with destination and options"""
         self.destination = destination
@@ -39,49 +90,427 @@ class RsyncManager:
         self.post_sync_commands_checkexit_local = post_sync_commands_checkexit_local or []
         self.pre_sync_commands_checkexit_remote = pre_sync_commands_checkexit_remote or []
         self.post_sync_commands_checkexit_remote = post_sync_commands_checkexit_remote or []
+        self.workers = max(1, workers)  # Concurrent rsync processes for incremental syncs
+        self.ssh_master = ssh_master  # Shared SSH connection to the destination, if multiplexing
         self.logger = Logger()
 
     def dedupe_a_list(self, a_list):
-        """Return a deduplicated list of items"""
+        """Return a deduplicated list of items, keeping their order"""
         if not a_list:
             return []
-        new_list = []
-        for item in a_list:
-            if item not in new_list:
-                new_list.append(item)
-        return new_list
-
-    def format_option(self, options):
-        """Return a formatted string of options"""
-        string_cmd = "{"
-        if len(options) == 1:
-            string_cmd += f"'{options[0]}'"
+        return list(dict.fromkeys(a_list))
+
+    def ssh_command(self):
+        """Return the remote shell rsync connects with, None for rsync's default"""
+        if self.ssh_master is not None:
+            return self.ssh_master.ssh_command()
+        if not self.ssh_key and not self.ssh_port:
+            return None
+        command = ["ssh"]
+        if self.ssh_key:
+            command += ["-i", self.ssh_key]
+        if self.ssh_port:
+            command += ["-p", str(self.ssh_port)]
+        return " ".join(shlex.quote(part) for part in command)
+
+    def relative_paths(self, paths):
+        """Return (existing, missing) paths below self.path relative to it, without duplicates
+
+        A path equal to self.path becomes ".", directories keep their trailing
+        slash. Paths that no longer exist are returned apart, they are synced
+        as deletions by run_deletions.
+        """
+        root = self.path.rstrip("/") + "/"
+        existing, missing = {}, {}
+        for path in paths:
+            if path.rstrip("/") + "/" == root:
+                existing["."] = None
+            elif path.startswith(root):
+                (existing if os.path.lexists(path) else missing)[path[len(root):]] = None
+        return list(existing), list(missing)
+
+    def deletes(self):
+        """Check if the options make rsync delete files missing from the source"""
+        return any(option.startswith("--del") for option in shlex.split(self.options or ""))
+
+    def run_deletions(self, exclude_list, missing):
+        """Sync paths that no longer exist as deletions, return (success, metrics)
+
+        One rsync over the whole tree, limited by deletion_rules to the
+        entries of the nearest existing parent directory of each path, so the
+        options' --delete removes them from the destination without
+        recursing into anything else. Without --delete in the options
+        deletions are never synced and nothing is run.
+        """
+        if not self.deletes():
+            self.logger.debug(f"{len(missing)} paths no longer exist, options don't delete, nothing to sync")
+            return True, {}
+        root = self.path.rstrip("/") + "/"
+        parents = {}
+        for path in missing:
+            parent = os.path.dirname(path.rstrip("/"))
+            while parent and not os.path.isdir(root + parent):
+                parent = os.path.dirname(parent)
+            parents[parent + "/" if parent else ""] = None
+        self.logger.info(f"Syncing {len(missing)} deleted paths through {len(parents)} parent directories")
+        success, _, _, _, stats = self.run_rsync(exclude_list, exclude_from=deletion_rules(parents))
+        return success, stats
+
+    def path_outcome(self, path, outcome):
+        """Return "failed", "vanished" or "synced" for a path below self.path in the SyncOutcome of a run"""
+        root = self.path.rstrip("/") + "/"
+        return outcome.status(path[len(root):] if path.startswith(root) else "")
+
+    def build_command(self, exclude_list=None, files_from=False, recursive=False, exclude_from=False):
+        """Return the rsync argument list
+
+        :param exclude_list: Patterns passed as --exclude
+        :type exclude_list: list, optional
+        :param files_from: Read the paths to transfer, NUL separated, from stdin
+        :type files_from: bool
+        :param recursive: Recurse into the directories read from stdin
+        :type recursive: bool
+        :param exclude_from: Read more exclude patterns, one per line, from stdin
+        :type exclude_from: bool
+        :rtype: list
+        """
+        command = ["rsync"] + shlex.split(self.options or "") + ["--stats", f"--out-format={OUT_FORMAT}"]
+        ssh_command = self.ssh_command()
+        if ssh_command:
+            command += ["-e", ssh_command]
+        for exclude in exclude_list or []:
+            command.append(f"--exclude={exclude}")
+        if exclude_from:
+            command.append("--exclude-from=-")
+        if files_from:
+            # -a doesn't imply -r with --files-from, rolled up directories need it
+            command += ["--files-from=-", "--from0"]
+            if recursive:
+                command.append("--recursive")
+        command += [self.path, f"{self.destination}:{self.destination_path}"]
+        return command
+
+    def remote_path(self, local_path):
+        """Return the destination path of a local path below self.path"""
+        relative_path = local_path[len(self.path.rstrip("/")):].strip("/")
+        return posixpath.join(self.destination_path, relative_path)
+
+    def run_remote_command(self, command):
+        """Run a command on the destination, return (success, exit code, stdout, stderr)
+
+        The command goes through the SSH master when it is up, otherwise a
+        connection is opened for it.
+        """
+        if self.ssh_master is not None and self.ssh_master.ensure():
+            self.logger.info(f"Running remote command through SSH master: {command}")
+            return self.ssh_master.run_command(command)
+        return run_ssh_command(
+            command,
+            self.destination.split("@")[1],
+            self.destination.split("@")[0],
+            self.ssh_key,
+            logger=self.logger,
+            port=self.ssh_port,
+        )
+
+    def run_remote_commands(self, commands):
+        """Run commands on the destination as one batch over a single session
+
+        :param commands: (command, check exit) pairs, the batch stops after a failed command with check exit
+        :type commands: list
+        :return: (command, success, exit code, stdout, stderr) per command, without exit code for those not run
+        :rtype: list
+        """
+        if self.ssh_master is not None and self.ssh_master.ensure():
+            marker = f"FSRSYNC-{uuid.uuid4().hex}"
+            self.logger.info(f"Running {len(commands)} remote commands through SSH master in one batch")
+            _, _, stdout, stderr = self.ssh_master.run_command(batch_script(commands, marker), get_pty=True)
+            return batch_results(commands, marker, stdout, stderr)
+        return run_ssh_commands(
+            commands,
+            self.destination.split("@")[1],
+            self.destination.split("@")[0],
+            self.ssh_key,
+            logger=self.logger,
+            port=self.ssh_port,
+        )
+
+    def run_remote_hooks(self, phase, commands, checkexit_commands):
+        """Run a phase's remote commands, then its remote checkexit commands, in one batch
+
+        A failed command is logged and the next one runs, a failed checkexit
+        command stops the batch.
+
+        :return: True if every checkexit command ran and succeeded
+        :rtype: bool
+        """
+        hooks = [(command, False) for command in commands if command]
+        hooks += [(command, True) for command in checkexit_commands if command]
+        if not hooks:
+            return True
+        print(f"Running {phase.lower()} remote commands...")
+        results = self.run_remote_commands(hooks)
+        for (_, check_exit), (command, success, exit_code, stdout, stderr) in zip(hooks, results):
+            if success:
+                self.logger.info(f"{phase} remote command succeeded: {command}, stdout: {stdout}")
+            elif check_exit:
+                self.logger.error(
+                    f"{phase} checkexit command failed with exit code {exit_code}: {stdout} {stderr}"
+                )
+                return False
+            else:
+                self.logger.warning(
+                    f"{phase} remote command failed with exit code {exit_code}: {command}, {stdout} {stderr}"
+                )
+        return True
+
+    def rename(self, src, dst):
+        """Apply a local rename on the destination with a single remote mv
+
+        :param src: Local path before the rename, below self.path
+        :type src: str
+        :param dst: Local path after the rename, below self.path
+        :type dst: str
+        :return: True if the remote rename succeeded
+        :rtype: bool
+        """
+        remote_src = shlex.quote(self.remote_path(src))
+        remote_dst = self.remote_path(dst)
+        quoted_dst = shlex.quote(remote_dst)
+        # mv moves into an existing directory, rename(2) replaces it when empty, a non-empty one fails the rename
+        command = (
+            f"mkdir -p {shlex.quote(posixpath.dirname(remote_dst))} && "
+            f"{{ [ -L {quoted_dst} ] || [ ! -d {quoted_dst} ] || rmdir -- {quoted_dst}; }} && "
+            f"mv -f -- {remote_src} {quoted_dst}"
+        )
+        success, exit_code, stdout, stderr = self.run_remote_command(command)
+        if not success:
+            self.logger.error(
+                f"Remote rename of {src} to {dst} failed with exit code {exit_code}: {stdout} {stderr}"
+            )
+        return bool(success)
+
+    def error_path(self, printed):
+        """Return the path relative to self.path of a path printed in an rsync error"""
+        for root in (self.path.rstrip("/") + "/", self.destination_path.rstrip("/") + "/"):
+            if printed.startswith(root) or printed + "/" == root:
+                return printed[len(root):]
+        return printed
+
+    def run_outcome(self, include_list, started, exit_code, stderr):
+        """Return the SyncOutcome of a run over an include list
+
+        A run that exited with a partial transfer code failed for the paths
+        named in its errors, those rsync reported as vanished were dropped.
+        Any other failure is a failure of the whole include list.
+        """
+        if started and exit_code == 0:
+            return SyncOutcome()
+        if not started or exit_code not in RSYNC_PARTIAL_CODES:
+            return SyncOutcome(failed=include_list)
+        failed, vanished = [], []
+        for printed, has_vanished in parse_errors(stderr):
+            path = self.error_path(printed)
+            if has_vanished:
+                vanished.append(path)
+            else:
+                failed.append(path)
+        if not failed and not vanished and exit_code != 24:
+            # Errors rsync didn't name a path for, nothing can be trusted
+            failed = include_list
+        return SyncOutcome(failed, vanished)
+
+    def run_rsync(self, exclude_list=None, include_list=None, exclude_from=None):
+        """Run a single rsync process, return (success, exit code, stdout, stderr, metrics)
+
+        exclude_from patterns are read from stdin with --exclude-from, so any
+        number of them can be given to a run without an include list. The
+        metrics are parsed from the output, see rsync_stats.parse_output. The
+        metrics of a run with an include list also hold the paths that failed
+        and vanished, a run where every error was a vanished file succeeded.
+        """
+        # Construct rsync command, the include list is streamed over stdin so argv stays the same size
+        if include_list is not None:
+            rsync_command = self.build_command(
+                exclude_list,
+                files_from=True,
+                recursive=any(path == "." or path.endswith("/") for path in include_list),
+            )
+            input_data = b"".join(os.fsencode(path) + b"\0" for path in include_list)
+            self.logger.info(
+                f"Only syncing {len(include_list)} files in include list, rsync command: {shlex.join(rsync_command)}"
+            )
+            self.logger.debug(f"Include list: {include_list}")
+        elif exclude_from:
+            rsync_command = self.build_command(exclude_list, exclude_from=True)
+            input_data = b"".join(os.fsencode(pattern) + b"\n" for pattern in exclude_from)
+            self.logger.info(
+                f"Running rsync command excluding {len(exclude_from)} more patterns: {shlex.join(rsync_command)}"
+            )
         else:
-            # Format as a comma-separated list except for the last item
-            for option in options[:-1]:
-                string_cmd += f"'{option}',"
-            string_cmd += f"'{options[-1]}'"
-        string_cmd += "}"
-        return string_cmd
+            rsync_command = self.build_command(exclude_list)
+            input_data = None
+            self.logger.info(f"Running regular rsync command: {shlex.join(rsync_command)}")
+        start = time.time()
+        started, exit_code, stdout, stderr = run_process(rsync_command, input_data)
+        stats = parse_output(stdout)
+        stats["duration"] = round(time.time() - start, 3)
+        self.logger.info(f"Rsync return code: {exit_code}, {describe_stats(stats)}")
+        if stderr:
+            self.logger.info(f"Rsync stderr: {stderr}")
+        self.logger.debug(f"Rsync stdout: {stdout}")
+        success = started and exit_code in RSYNC_SUCCESS_CODES
+        if include_list is not None:
+            outcome = self.run_outcome(include_list, started, exit_code, stderr)
+            stats["failed"] = sorted(outcome.failed)
+            stats["vanished"] = sorted(outcome.vanished)
+            success = success or (exit_code in RSYNC_PARTIAL_CODES and not outcome.failed)
+        return success, exit_code, stdout, stderr, stats
+
+    def run_shards(self, exclude_list, include_list, shard_count, report):
+        """Transfer an include list with self.workers concurrent rsync processes
+
+        The list is split into shard_count shards of similar file count and
+        size, fed to the workers through a shared queue so a worker that is
+        done early takes the next shard. A failed shard is put back on the
+        queue up to RSYNC_SHARD_RETRIES times, the others are not redone.
+        The shard statistics are added to report.
 
-    def run(self, exclude_list=None, include_list=None):
-        """Run rsync with the specified options, paths, and destination"""
+        :return: True if every shard was transferred
+        :rtype: bool
+        """
+        root = self.path.rstrip("/") + "/"
+        shards = split_into_shards(
+            include_list,
+            shard_count,
+            lambda path: path_weight(root if path == "." else root + path),
+        )
+        self.logger.info(
+            f"Syncing {len(include_list)} paths to {self.destination} in {len(shards)} shards with {self.workers} workers"
+        )
+        return self.run_jobs(exclude_list, shards, report)
+
+    def run_partitioned(self, exclude_list, ignore, report):
+        """Run a full sync as concurrent rsync processes over balanced subtrees
+
+        The tree is scanned and split into partitions of whole subtrees (see
+        partition_tree) run by self.workers processes, a failed partition is
+        retried on its own. A last run over the whole path, excluding every
+        partitioned subtree, syncs the files directly in the split directories
+        and removes subtrees that no longer exist when --delete is used.
+
+        :param exclude_list: Patterns excluded from every run
+        :type exclude_list: list, optional
+        :param ignore: Ignore rules of the destination, ignored entries are not scanned
+        :type ignore: IgnoreMatcher, optional
+        :param report: Report of the run the partition statistics are added to
+        :type report: dict
+        :return: True if every partition and the last run succeeded
+        :rtype: bool
+        """
+        start = time.time()
+        partitions, subtrees = partition_tree(self.path, self.workers * RSYNC_SHARDS_PER_WORKER, ignore)
+        remainder = Shard(len(partitions), exclude_from=[f"/{subtree}" for subtree in subtrees])
+        remainder.paths = None
+        self.logger.info(
+            f"Scanned {self.path} in {time.time() - start:.1f}s, syncing {len(subtrees)} subtrees in "
+            f"{len(partitions)} partitions with {self.workers} workers"
+        )
+        return self.run_jobs(exclude_list, partitions + [remainder], report)
+
+    def run_jobs(self, exclude_list, shards, report):
+        """Run shards on self.workers threads from a shared queue, retrying failed ones on their own
+
+        The statistics of the shards are added to report under "shards", their
+        merged transfer metrics under "stats".
+        """
+        start = time.time()
+        work = queue.Queue()
+        for shard in shards:
+            work.put(shard)
+        progress = [0]  # Shards finished
+        progress_lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    shard = work.get_nowait()
+                except queue.Empty:
+                    return
+                shard.attempts += 1
+                start = time.time()
+                shard.success, shard.exit_code, _, _, shard.stats = self.run_rsync(
+                    exclude_list, shard.paths, shard.exclude_from
+                )
+                shard.duration += time.time() - start
+                if not shard.success and shard.attempts <= RSYNC_SHARD_RETRIES:
+                    if shard.paths is not None and shard.exit_code in RSYNC_PARTIAL_CODES:
+                        # Only the paths that failed are sent again
+                        outcome = SyncOutcome(shard.stats.get("failed", []))
+                        shard.paths = [path for path in shard.paths if outcome.status(path) == "failed"] or shard.paths
+                    self.logger.warning(
+                        f"Shard {shard.index} of {self.destination} failed with exit code {shard.exit_code}, "
+                        f"retrying {len(shard.paths) if shard.paths is not None else 'all'} paths..."
+                    )
+                    work.put(shard)
+                    continue
+                with progress_lock:
+                    progress[0] += 1
+                    self.logger.info(
+                        f"Shard {shard.index} of {self.destination} ({shard.files} files, {shard.bytes} bytes) "
+                        f"{'done' if shard.success else 'failed'} in {shard.duration:.1f}s, "
+                        f"{progress[0]}/{len(shards)} shards finished"
+                    )
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.workers, len(shards)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report["shards"] = [shard.to_dict() for shard in shards]
+        report["stats"] = merge_stats([shard.stats for shard in shards])
+        report["stats"]["duration"] = round(time.time() - start, 3)
+        failed = [shard.index for shard in shards if not shard.success]
+        if failed:
+            self.logger.error(f"Shards {failed} of {self.destination} failed after {RSYNC_SHARD_RETRIES} retries")
+        return not failed
+
+    def run(self, exclude_list=None, include_list=None, partitioned=False, ignore=None):
+        """Run rsync with the specified options, paths, and destination
+
+        A run without include list is split into subtrees synced concurrently
+        when partitioned is set and there is more than one worker. What the run
+        did is returned in a report of its own, so runs of the same manager in
+        different threads don't see each other's: "shards" holds the statistics
+        of its shards or partitions, "stats" its transfer metrics (see
+        rsync_stats.parse_output) and "outcome" the SyncOutcome of the paths
+        it was given, everything failed until rsync says otherwise.
+
+        :return: (rsync success, post-sync commands success, report)
+        :rtype: tuple
+        """
+
+        report = {"shards": [], "stats": {}, "outcome": SyncOutcome(failed=["."])}
 
         # Dedupe the exclude and include lists
         if exclude_list:
             exclude_list = self.dedupe_a_list(exclude_list)
         # Ensure no excluded files are included in the include list
-        if include_list:
-            include_list = self.dedupe_a_list(include_list)
-            if exclude_list:
-                for exclude_item in exclude_list:
-                    if exclude_item in include_list:
-                        include_list.remove(exclude_item)
-
-        # Don't run if include list is empty
-        if include_list and len(include_list) == 0:
-            self.logger.debug("Include list is empty, skipping rsync.")
-            return
+        missing = []
+        if include_list is not None:
+            excluded = set(exclude_list or [])
+            include_list, missing = self.relative_paths(
+                path for path in self.dedupe_a_list(include_list) if path not in excluded
+            )
+            # Don't run if include list is empty
+            if not include_list and not missing:
+                self.logger.debug("Include list is empty, skipping rsync.")
+                report["outcome"] = SyncOutcome()
+                return True, True, report
+
+        # Bring up the shared SSH connection, rsync and the remote commands connect through it
+        if self.ssh_master is not None:
+            self.ssh_master.ensure()
 
         # Run pre-sync commands
         if len(self.pre_sync_commands_local) > 0:
@@ -102,75 +531,43 @@ class RsyncManager:
                     self.logger.error(
                         f"Pre-sync checkexit command failed with exit code {exit_code}: {stdout} {stderr}"
                     )
-                    return False, False
-
-        # Run pre-sync remote commands
-        if len(self.pre_sync_commands_remote) > 0:
-            print("Running pre-sync commands...")
-            for command in self.pre_sync_commands_remote:
-                if not command:
-                    continue
-                run_ssh_command(
-                    command,
-                    self.destination.split("@")[1],
-                    self.destination.split("@")[0],
-                    self.ssh_key,
-                    logger=self.logger,
-                )
+                    return False, False, report
 
-        # Run pre-sync remote checkexit commands
-        if len(self.pre_sync_commands_checkexit_remote) > 0:
-            print("Running pre-sync checkexit commands...")
-            for command in self.pre_sync_commands_checkexit_remote:
-                if not command:
-                    continue
-                success, exit_code, stdout, stderr = run_ssh_command(
-                    command,
-                    self.destination.split("@")[1],
-                    self.destination.split("@")[0],
-                    self.ssh_key,
-                    logger=self.logger,
-                )
-                # If the command fails, log the error and return
-                if not success:
-                    self.logger.error(
-                        f"Pre-sync checkexit command failed with exit code {exit_code}: {stdout} {stderr}"
-                    )
-                    return False, False
+        # Run pre-sync remote commands and remote checkexit commands in one batch
+        if not self.run_remote_hooks("Pre-sync", self.pre_sync_commands_remote, self.pre_sync_commands_checkexit_remote):
+            return False, False, report
 
-        # Pre-set options from the configuration file
-        opts = f"{self.options} --stats"
-
-        # Add SSH key and port options if provided
-        if self.ssh_key and self.ssh_port:
-            opts += f" -e 'ssh -i {self.ssh_key} -p {self.ssh_port}'"
-        # Add SSH port option if provided
-        if self.ssh_port:
-            opts += f" -e 'ssh -p {self.ssh_port}'"
-        # Add SSH key option if provided
-        if self.ssh_key:
-            opts += f" -e 'ssh -i {self.ssh_key}'"
-        if exclude_list:
-            opts += f" --exclude={self.format_option(exclude_list)}"
-        if include_list:
-            opts += f" --include={self.format_option(include_list)}"
-        # Construct rsync command
-        # If include_list is provided, use it to sync only the specified files
-        if include_list:
-            rsync_command = (
-                f"rsync {opts} {self.path} {self.destination}:{self.destination_path}"
-            )
-            self.logger.info(
-                f"Only syncing files in include list: {include_list}, rsync command: {rsync_command}"
-            )
+        shard_count = 0
+        if include_list is not None and self.workers > 1:
+            shard_count = min(self.workers * RSYNC_SHARDS_PER_WORKER, len(include_list) // RSYNC_MIN_SHARD_FILES)
+        rsync_success = True
+        if include_list is None and partitioned and self.workers > 1:
+            rsync_success = self.run_partitioned(exclude_list, ignore, report)
+        elif shard_count > 1:
+            rsync_success = self.run_shards(exclude_list, include_list, shard_count, report)
+        elif include_list is None or include_list:
+            rsync_success, _, _, _, report["stats"] = self.run_rsync(exclude_list, include_list)
+        if missing:
+            # Deleted paths are synced apart so the include list is never widened to their parents
+            deletions_success, deletions_stats = self.run_deletions(exclude_list, missing)
+            if not deletions_success:
+                deletions_stats["failed"] = missing
+            if report["stats"]:
+                duration = report["stats"].get("duration", 0) + deletions_stats.get("duration", 0)
+                report["stats"] = merge_stats([report["stats"], deletions_stats])
+                report["stats"]["duration"] = round(duration, 3)
+            else:
+                report["stats"] = deletions_stats
+            rsync_success = rsync_success and deletions_success
+        stats = report["stats"]
+        if include_list is not None:
+            report["outcome"] = SyncOutcome(stats.get("failed", []), stats.get("vanished", []))
+            for field in ("failed", "vanished"):
+                paths = stats.get(field, [])
+                stats[f"{field}_count"] = len(paths)
+                stats[field] = paths[:RSYNC_MAX_CHANGES]
         else:
-            rsync_command = f"rsync {opts} {self.path} {self.destination}:{self.destination_path}"
-            self.logger.info(f"Running regular rsync command: {rsync_command}")
-        rsync_success, exit_code, stdout, stderr = run_command(rsync_command)
-        if stdout:
-            self.logger.info(
-                f"Rsync return code: {exit_code}, stdout: {stdout}, stderr: {stderr}"
-            )
+            report["outcome"] = SyncOutcome(failed=[] if rsync_success else ["."])
 
         # Run post-sync commands
         if len(self.post_sync_commands_local) > 0:
@@ -191,44 +588,16 @@ class RsyncManager:
                     self.logger.error(
                         f"Post-sync checkexit command failed with exit code {exit_code}: {stdout} {stderr}"
                     )
-                    return rsync_success, False
+                    return rsync_success, False, report
 
-        # Run post-sync checkexit commands
-        if len(self.post_sync_commands_remote) > 0:
-            print("Running post-sync commands...")
-            for command in self.post_sync_commands_remote:
-                if not command:
-                    continue
-                run_ssh_command(
-                    command,
-                    self.destination.split("@")[1],
-                    self.destination.split("@")[0],
-                    self.ssh_key,
-                    logger=self.logger,
-                )
-
-        # Run post-sync checkexit remote commands
-        if len(self.post_sync_commands_checkexit_remote) > 0:
-            print("Running post-sync checkexit commands...")
-            for command in self.post_sync_commands_checkexit_remote:
-                if not command:
-                    continue
-                success, exit_code, stdout, stderr = run_ssh_command(
-                    command,
-                    self.destination.split("@")[1],
-                    self.destination.split("@")[0],
-                    self.ssh_key,
-                    logger=self.logger,
-                )
-                # If the command fails, log the error and return
-                if not success:
-                    self.logger.error(
-                        f"Post-sync checkexit command failed with exit code {exit_code}: {stdout} {stderr}"
-                    )
-                    return rsync_success, False
+        # Run post-sync remote commands and remote checkexit commands in one batch
+        if not self.run_remote_hooks(
+            "Post-sync", self.post_sync_commands_remote, self.post_sync_commands_checkexit_remote
+        ):
+            return rsync_success, False, report
 
         exclude_list = []
         include_list = []
 
         # Return the success status of the rsync command
-        return rsync_success, True
+        return rsync_success, True, report
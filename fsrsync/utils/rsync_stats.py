@@ -0,0 +1,206 @@
+"""Parse rsync's --stats block and per-file output into sync metrics"""
+import re
+import bisect
+from .constants import RSYNC_MAX_CHANGES
+
+# Per-file output requested with --out-format: itemized changes, bytes transferred, file size and name
+OUT_FORMAT = "%i\t%b\t%l\t%n"
+
+# --stats line label -> metric, rsync 3.1+ labels first, then the older ones
+STATS_FIELDS = {
+    "Number of files": "files",
+    "Number of created files": "created_files",
+    "Number of deleted files": "deleted_files",
+    "Number of regular files transferred": "files_transferred",
+    "Number of files transferred": "files_transferred",
+    "Total file size": "total_size",
+    "Total transferred file size": "transferred_size",
+    "Literal data": "literal_bytes",
+    "Matched data": "matched_bytes",
+    "File list size": "file_list_size",
+    "File list generation time": "file_list_generation_time",
+    "File list transfer time": "file_list_transfer_time",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+STATS_LINE = re.compile(r"^([A-Z][A-Za-z ]+?): ([0-9][0-9.,]*[KMGTP]?)")
+SPEEDUP_LINE = re.compile(r"speedup is ([0-9][0-9.,]*)")
+# Paths in error messages: quoted, or in parentheses after a delete_file operation
+ERROR_PATHS = re.compile(r'"([^"]+)"|delete_file: \w+\((.+?)\)')
+# Name rsync gives a file while receiving it
+TEMPORARY_NAME = re.compile(r"^\.(.+)\.[A-Za-z0-9]{6}$")
+UNITS = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4, "P": 1000 ** 5}
+SUMMED = ("files", "created_files", "deleted_files", "files_transferred", "total_size", "transferred_size",
+          "literal_bytes", "matched_bytes", "file_list_size", "file_list_generation_time",
+          "file_list_transfer_time", "bytes_sent", "bytes_received", "changes_count")
+
+
+def parse_number(text):
+    """Return a number printed by rsync, with thousands separators or a --human-readable suffix"""
+    multiplier = UNITS.get(text[-1], 1)
+    text = text.rstrip("KMGTP").replace(",", "")
+    value = float(text) * multiplier
+    return value if "." in text and multiplier == 1 else int(value)
+
+
+def describe_change(itemized):
+    """Return what an --itemize-changes string says happened to a path"""
+    if itemized.startswith("*"):
+        return itemized[1:].strip()  # "deleting" and other messages
+    if itemized[2:].startswith("+"):
+        return "created"
+    if itemized[0] in "<>":
+        return "transferred"
+    if itemized[0] == "h":
+        return "hardlinked"
+    return "attributes" if itemized[0] == "." else "changed"
+
+
+def parse_change(line):
+    """Return the change an --out-format line describes, None if line isn't one"""
+    fields = line.split("\t", 3)
+    if len(fields) != 4 or len(fields[0]) < 2 or not fields[1].isdigit():
+        return None
+    itemized, transferred, size, name = fields
+    return {
+        "path": name,
+        "itemized": itemized.rstrip(),
+        "change": describe_change(itemized),
+        "bytes": int(transferred),
+        "size": int(size) if size.isdigit() else 0,
+    }
+
+
+def parse_output(stdout):
+    """Return the metrics of an rsync run from its output
+
+    The --stats block gives totals: files transferred, literal data sent
+    and data matched against the destination's copy, file list build and
+    transfer times, and the speedup. Lines written by OUT_FORMAT list the
+    paths that changed, kept in the result sorted by bytes transferred with
+    at most RSYNC_MAX_CHANGES of them.
+
+    :param stdout: Output of rsync run with --stats and --out-format=OUT_FORMAT
+    :type stdout: str
+    :return: Metrics, with the changes under "changes" and their count under "changes_count"
+    :rtype: dict
+    """
+    stats = {}
+    changes = []
+    for line in (stdout or "").splitlines():
+        change = parse_change(line)
+        if change is not None:
+            changes.append(change)
+            continue
+        match = STATS_LINE.match(line)
+        if match and match.group(1) in STATS_FIELDS:
+            stats[STATS_FIELDS[match.group(1)]] = parse_number(match.group(2))
+            continue
+        match = SPEEDUP_LINE.search(line)
+        if match:
+            stats["speedup"] = parse_number(match.group(1))
+    changes.sort(key=lambda change: change["bytes"], reverse=True)
+    stats["changes_count"] = len(changes)
+    stats["changes"] = changes[:RSYNC_MAX_CHANGES]
+    return stats
+
+
+def merge_stats(results):
+    """Add up the metrics of the rsync runs of one sync, shards or partitions of disjoint paths
+
+    Times add up too, they are the time spent by all the runs together.
+    """
+    merged = {}
+    changes = []
+    for stats in results:
+        for field in SUMMED:
+            if field in stats:
+                merged[field] = merged.get(field, 0) + stats[field]
+        changes.extend(stats.get("changes", []))
+        for field in ("failed", "vanished"):
+            if field in stats:
+                merged.setdefault(field, []).extend(stats[field])
+    if merged.get("bytes_sent") or merged.get("bytes_received"):
+        # Speedup as rsync computes it, total size over bytes on the wire
+        merged["speedup"] = round(
+            merged.get("total_size", 0) / (merged.get("bytes_sent", 0) + merged.get("bytes_received", 0)), 2
+        )
+    changes.sort(key=lambda change: change["bytes"], reverse=True)
+    merged["changes"] = changes[:RSYNC_MAX_CHANGES]
+    return merged
+
+
+def describe_stats(stats):
+    """Return a one line summary of the metrics of a run"""
+    return (
+        f"{stats.get('files_transferred', 0)} files transferred, {stats.get('changes_count', 0)} paths changed, "
+        f"{stats.get('literal_bytes', 0)} bytes literal, {stats.get('matched_bytes', 0)} bytes matched, "
+        f"speedup {stats.get('speedup', 0)}, file list built in {stats.get('file_list_generation_time', 0)}s "
+        f"and sent in {stats.get('file_list_transfer_time', 0)}s, took {stats.get('duration', 0)}s"
+    )
+
+
+def parse_errors(stderr):
+    """Return (path, vanished) for every path named by an error or warning of rsync
+
+    Paths are as rsync printed them: source paths, destination paths,
+    possibly under a temporary name, or relative ones. vanished is set for
+    files that disappeared before they were sent.
+    """
+    errors = []
+    for line in (stderr or "").splitlines():
+        vanished = line.startswith("file has vanished:")
+        if not vanished and not line.startswith("rsync:"):
+            continue  # Totals like "rsync error: ... (code 23)" name no path
+        for quoted, deleted in ERROR_PATHS.findall(line):
+            path = quoted or deleted
+            directory, _, name = path.rpartition("/")
+            match = TEMPORARY_NAME.match(name)
+            if match:
+                path = f"{directory}/{match.group(1)}" if directory else match.group(1)
+            errors.append((path, vanished))
+    return errors
+
+
+def outcome_key(path):
+    """Return a path relative to the source path as compared by SyncOutcome, "" for the source path itself"""
+    path = path.strip("/")
+    if path in (".", ""):
+        return ""
+    return path[2:] if path.startswith("./") else path
+
+
+class SyncOutcome:
+    """Paths of an rsync run that failed or vanished, relative to the source path
+
+    A path failed when it or one of its parent directories failed, or when
+    it is a directory something below which failed. Everything else that
+    was part of the run was synced.
+    """
+
+    def __init__(self, failed=(), vanished=()):
+        self.failed = {outcome_key(path) for path in failed}
+        self.vanished = {outcome_key(path) for path in vanished}
+        self.sorted_failed = sorted(self.failed)
+
+    def update(self, other):
+        """Add the paths of another run"""
+        self.failed |= other.failed
+        self.vanished |= other.vanished
+        self.sorted_failed = sorted(self.failed)
+
+    def status(self, path):
+        """Return "failed", "vanished" or "synced" for a relative path"""
+        key = outcome_key(path)
+        parts = key.split("/") if key else []
+        ancestors = [""] + ["/".join(parts[:depth]) for depth in range(1, len(parts) + 1)]
+        if any(ancestor in self.failed for ancestor in ancestors):
+            return "failed"
+        # Failures below the path, found in the sorted failures starting with its prefix
+        prefix = key + "/" if key else ""
+        index = bisect.bisect_left(self.sorted_failed, prefix)
+        if index < len(self.sorted_failed) and self.sorted_failed[index].startswith(prefix):
+            return "failed"
+        if any(ancestor in self.vanished for ancestor in ancestors):
+            return "vanished"
+        return "synced"
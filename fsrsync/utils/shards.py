@@ -0,0 +1,87 @@
+"""Split a sync into shards of similar cost for parallel rsync processes"""
+import os
+import heapq
+from .rollup import count_entries
+from .constants import RSYNC_SHARD_FILE_COST
+
+
+class Shard:
+    """Paths transferred by one rsync process, and how their transfer went"""
+
+    __slots__ = ("index", "paths", "exclude_from", "files", "bytes", "attempts", "exit_code", "duration",
+                 "success", "stats")
+
+    def __init__(self, index, exclude_from=None):
+        self.index = index
+        self.paths = []  # Paths to transfer, None for a run over the whole root
+        self.exclude_from = exclude_from  # Extra exclude patterns of a run over the whole root
+        self.files = 0
+        self.bytes = 0
+        self.attempts = 0
+        self.exit_code = None
+        self.duration = 0.0
+        self.success = False
+        self.stats = {}  # Transfer metrics of the last attempt
+
+    def cost(self):
+        """Return the estimated cost of the shard in bytes"""
+        return self.bytes + self.files * RSYNC_SHARD_FILE_COST
+
+    def to_dict(self):
+        """Return the shard as statistics"""
+        return {
+            "shard": self.index,
+            "files": self.files,
+            "bytes": self.bytes,
+            "attempts": self.attempts,
+            "exit_code": self.exit_code,
+            "duration": round(self.duration, 3),
+            "success": self.success,
+            "literal_bytes": self.stats.get("literal_bytes"),
+            "matched_bytes": self.stats.get("matched_bytes"),
+            "files_transferred": self.stats.get("files_transferred"),
+        }
+
+
+def path_weight(path):
+    """Return (files, bytes) a path is expected to transfer
+
+    A directory counts as its direct entries, its size is unknown without
+    walking it.
+    """
+    if path.endswith("/"):
+        return count_entries(path) or 1, 0
+    try:
+        return 1, os.lstat(path).st_size
+    except OSError:
+        return 1, 0
+
+
+def split_into_shards(paths, count, weight=path_weight):
+    """Distribute paths over count shards balancing file count and bytes
+
+    Paths are assigned heaviest first to the cheapest shard so far, each file
+    costing RSYNC_SHARD_FILE_COST bytes on top of its size for its round trips.
+
+    :param paths: Paths to transfer
+    :type paths: list
+    :param count: Number of shards
+    :type count: int
+    :param weight: Function returning (files, bytes) for a path
+    :type weight: callable
+    :return: Non-empty shards
+    :rtype: list
+    """
+    weighted = sorted(((weight(path), path) for path in paths),
+                      key=lambda item: item[0][1] + item[0][0] * RSYNC_SHARD_FILE_COST,
+                      reverse=True)
+    shards = [Shard(index) for index in range(max(1, count))]
+    heap = [(0, shard.index) for shard in shards]
+    for (files, size), path in weighted:
+        _, index = heapq.heappop(heap)
+        shard = shards[index]
+        shard.paths.append(path)
+        shard.files += files
+        shard.bytes += size
+        heapq.heappush(heap, (shard.cost(), index))
+    return [shard for shard in shards if shard.paths]
@@ -1,8 +1,25 @@
 """This module contains the functions to run commands on the remote server"""
 import os
+import time
+import socket
+import uuid
+import threading
 import paramiko
 from io import StringIO
 from .utils import validate_path
+from .constants import (
+    DEFAULT_SSH_PORT,
+    SSH_CONNECT_TIMEOUT,
+    SSH_COMMAND_TIMEOUT,
+    SSH_SERVER_ALIVE_INTERVAL,
+    SSH_POOL_MAX_CONNECTIONS,
+    SSH_POOL_MAX_CHANNELS,
+    SSH_POOL_IDLE_TIMEOUT,
+)
+
+# Parsed private keys by path, with the mtime they were read at
+SSH_KEYS = {}
+SSH_KEYS_LOCK = threading.Lock()
 
 
 def log_output(output, logger):
@@ -30,13 +47,21 @@ def read_linux_user_default_ssh_key():
 
 
 def read_ssh_key(ssh_key):
-    """Read the SSH key from the provided path"""
+    """Read the SSH key from the provided path, parsed keys are cached until the file changes"""
     try:
         if validate_path(ssh_key):
+            mtime = os.stat(ssh_key).st_mtime_ns
+            with SSH_KEYS_LOCK:
+                cached = SSH_KEYS.get(ssh_key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
             with open(ssh_key, "r", encoding="utf-8") as file:
                 f = file.read().strip()
                 stringiofile = StringIO(f)
-                return paramiko.RSAKey.from_private_key(stringiofile)
+                key = paramiko.RSAKey.from_private_key(stringiofile)
+            with SSH_KEYS_LOCK:
+                SSH_KEYS[ssh_key] = (mtime, key)
+            return key
     except FileNotFoundError:
         return None
     except paramiko.ssh_exception.SSHException as e:
@@ -48,9 +73,266 @@ def read_ssh_key(ssh_key):
         return None
 
 
-def run_ssh_command(command, host, username="root", ssh_key=None, logger=None):
+class PooledConnection:
+    """An SSH connection of the pool and the channels open on it"""
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = 0  # Channels currently open
+        self.commands = 0  # Commands run so far
+        self.last_used = time.time()
+
+    def is_active(self):
+        """Check if the connection's transport is still up"""
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        """Close the connection"""
+        try:
+            self.client.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+
+class SshSessionPool:
+    """Persistent paramiko connections keyed by (host, username, port, key)
+
+    Commands run on a channel of a pooled connection, so a connection's
+    handshake is paid once for all the commands run while it stays open. At
+    most max_connections are opened per key and max_channels run on each of
+    them at once, further commands wait for a free channel. Connections send
+    keepalives and are closed after idle_timeout seconds without use. When
+    a pooled connection turns out dead before the command could be started
+    on it, the command is started on a new one. A command that started is
+    never run again, it may have run on the remote.
+    """
+
+    def __init__(
+        self,
+        max_connections=SSH_POOL_MAX_CONNECTIONS,
+        max_channels=SSH_POOL_MAX_CHANNELS,
+        idle_timeout=SSH_POOL_IDLE_TIMEOUT,
+        keepalive=SSH_SERVER_ALIVE_INTERVAL,
+    ):
+        self.max_connections = max_connections
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connections = {}  # Key -> [PooledConnection]
+        self.connecting = {}  # Key -> connections being opened
+        self.condition = threading.Condition()
+
+    def evict_idle(self):
+        """Close the unused connections idle for too long or no longer active, with the condition held"""
+        now = time.time()
+        for key, connections in self.connections.items():
+            for connection in list(connections):
+                idle = now - connection.last_used > self.idle_timeout
+                if connection.channels == 0 and (idle or not connection.is_active()):
+                    connection.close()
+                    connections.remove(connection)
+
+    def acquire(self, host, username, port, ssh_key):
+        """Return a connection with a free channel, opening one if the key has room for it"""
+        key = (host, username, port, ssh_key)
+        with self.condition:
+            while True:
+                self.evict_idle()
+                connections = self.connections.setdefault(key, [])
+                for connection in connections:
+                    if connection.channels < self.max_channels and connection.is_active():
+                        connection.channels += 1
+                        return connection
+                if len(connections) + self.connecting.get(key, 0) < self.max_connections:
+                    self.connecting[key] = self.connecting.get(key, 0) + 1
+                    break
+                self.condition.wait()
+        try:
+            connection = PooledConnection(self.connect(host, username, port, ssh_key))
+        finally:
+            with self.condition:
+                self.connecting[key] -= 1
+                self.condition.notify_all()
+        with self.condition:
+            connection.channels = 1
+            self.connections[key].append(connection)
+        return connection
+
+    def release(self, connection, broken=False):
+        """Give back the channel of a command, closing the connection if it broke"""
+        with self.condition:
+            connection.channels -= 1
+            connection.last_used = time.time()
+            if broken:
+                connection.close()
+                for connections in self.connections.values():
+                    if connection in connections:
+                        connections.remove(connection)
+            self.condition.notify_all()
+
+    def connect(self, host, username, port, ssh_key):
+        """Open a connection, with the cached parsed key"""
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            host,
+            port=port or DEFAULT_SSH_PORT,
+            username=username,
+            pkey=read_ssh_key(ssh_key) if ssh_key else None,
+            timeout=SSH_CONNECT_TIMEOUT,
+        )
+        transport = client.get_transport()
+        transport.set_keepalive(self.keepalive)
+        # Opening a channel and its exec request are small writes, don't let Nagle hold the second one back
+        transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client
+
+    def run(self, command, host, username, port, ssh_key, get_pty=False):
+        """Run a command on a pooled connection
+
+        :return: (exit code, stdout, stderr)
+        :rtype: tuple
+        """
+        while True:
+            connection = self.acquire(host, username, port, ssh_key)
+            reused = connection.commands > 0
+            connection.commands += 1
+            try:
+                stdin, stdout, stderr = connection.client.exec_command(
+                    command, timeout=SSH_COMMAND_TIMEOUT, get_pty=get_pty
+                )
+            except (paramiko.SSHException, EOFError, OSError):
+                self.release(connection, broken=True)
+                if reused:
+                    continue  # The connection died while pooled, the command never started, start it on a new one
+                raise
+            try:
+                stdin.close()
+                output = stdout.read().decode("utf-8", "replace")
+                err = stderr.read().decode("utf-8", "replace")
+                exit_code = stdout.channel.recv_exit_status()
+            except (paramiko.SSHException, EOFError, OSError):
+                self.release(connection, broken=True)
+                raise
+            self.release(connection)
+            return exit_code, output, err
+
+    def close(self):
+        """Close every pooled connection"""
+        with self.condition:
+            for connections in self.connections.values():
+                for connection in connections:
+                    connection.close()
+            self.connections = {}
+
+
+SESSION_POOL = SshSessionPool()
+
+
+def batch_script(commands, marker):
+    """Return a shell script running commands one after the other
+
+    The script is run by the remote user's login shell on a PTY, like a
+    single command always was, so it only uses syntax every Bourne-style
+    shell understands. Each command runs in a subshell of that shell, then
+    its index and exit code are printed after marker, so the output of the
+    batch can be split back per command. On a PTY stderr is merged into
+    stdout, the output of a command holds both. The script exits after a
+    failed command whose check exit flag is set.
+
+    :param commands: (command, check exit) pairs
+    :type commands: list
+    :param marker: Token delimiting the output of the commands
+    :type marker: str
+    :rtype: str
+    """
+    lines = []
+    for index, (command, check_exit) in enumerate(commands):
+        lines.append(f"( {command}\n)")
+        lines.append(f"rc=$?; printf '\\n{marker} {index} %d\\n' \"$rc\"")
+        if check_exit:
+            lines.append('[ "$rc" -eq 0 ] || exit "$rc"')
+    return "\n".join(lines)
+
+
+def split_batch_output(output, marker):
+    """Return {index: (output, fields after the index)} of the commands of a batch"""
+    # A PTY turns every newline into CRLF
+    pieces = (output or "").replace("\r\n", "\n").split(f"\n{marker} ")
+    results = {}
+    body = pieces[0]
+    for piece in pieces[1:]:
+        header, _, next_body = piece.partition("\n")
+        fields = header.split()
+        if fields and fields[0].isdigit():
+            results[int(fields[0])] = (body, fields[1:])
+        body = next_body
+    return results
+
+
+def batch_results(commands, marker, stdout, stderr):
+    """Return (command, success, exit code, stdout, stderr) per command of a batch
+
+    Commands the batch didn't get to, after a failed check exit command or a
+    lost connection, have no exit code. The commands ran on a PTY, their
+    stderr is part of their stdout, what the batch wrote on stderr (errors
+    of the connection) is given to the commands that didn't run.
+    """
+    outputs = split_batch_output(stdout, marker)
+    results = []
+    for index, (command, _) in enumerate(commands):
+        output, fields = outputs.get(index, ("", []))
+        exit_code = int(fields[0]) if fields and fields[0].lstrip("-").isdigit() else None
+        results.append((command, exit_code == 0, exit_code, output, (stderr or "") if exit_code is None else ""))
+    return results
+
+
+def run_ssh_commands(commands, host, username="root", ssh_key=None, logger=None, port=None):
+    """Run a list of commands on a remote server as one batch over a pooled connection
+
+    The commands are sent as a single script on one channel instead of one
+    channel each, see batch_script.
+
+    :param commands: (command, check exit) pairs, the batch stops after a failed command with check exit
+    :type commands: list
+    :param host: The host to connect to
+    :type host: str
+    :param username: The username to use for the connection, defaults to "root"
+    :type username: str, optional
+    :param ssh_key: The SSH key to use for the connection, defaults to None
+    :type ssh_key: str, optional
+    :param logger: The logger to use for logging, defaults to None
+    :type logger: logging.Logger, optional
+    :param port: The port to connect to, defaults to 22
+    :type port: int, optional
+    :return: (command, success, exit code, stdout, stderr) per command
+    :rtype: list
+    """
+    marker = f"FSRSYNC-{uuid.uuid4().hex}"
+    script = batch_script(commands, marker)
+    try:
+        if not host or not commands:
+            log_output("Host and commands are required", logger)
+            return batch_results(commands, marker, "", "")
+        if not ssh_key:
+            ssh_key = read_linux_user_default_ssh_key()
+        if not ssh_key:
+            log_output("No SSH key provided or found", logger)
+            return batch_results(commands, marker, "", "")
+        log_output(f"Running {len(commands)} commands on {host} in one batch", logger)
+        _, output, err = SESSION_POOL.run(script, host, username, port, ssh_key, get_pty=True)
+        return batch_results(commands, marker, output, err)
+    except Exception as e:  # pylint: disable=broad-except
+        log_output(f"Error running ssh commands: {e}", logger)
+        return batch_results(commands, marker, "", "")
+
+
+def run_ssh_command(command, host, username="root", ssh_key=None, logger=None, port=None):
     """Run a command on a remote server using SSH
 
+    The command runs on a channel of a pooled connection, see SshSessionPool.
+
     :param command: The command to run
     :type command: str
     :param host: The host to connect to
@@ -61,6 +343,8 @@ def run_ssh_command(command, host, username="root", ssh_key=None, logger=None):
     :type ssh_key: str, optional
     :param logger: The logger to use for logging, defaults to None
     :type logger: logging.Logger, optional
+    :param port: The port to connect to, defaults to 22
+    :type port: int, optional
     :return: The output of the command
     :rtype: str
     """
@@ -74,26 +358,10 @@ def run_ssh_command(command, host, username="root", ssh_key=None, logger=None):
             log_output("No SSH key provided or found", logger)
             return None, None, None, None
 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        # Use the provided key or password
-        if ssh_key:
-            # Load ssh_key
-            log_output(f"Connecting to {host} with key {ssh_key}", logger)
-            ssh_key = read_ssh_key(ssh_key)
-            ssh.connect(host, username=username, pkey=ssh_key)
-        else:
-            log_output(f"Connecting to {host} with password", logger)
-            ssh.connect(host, username=username)
-
-        stdin, stdout, stderr = ssh.exec_command(
-            command, timeout=1000, get_pty=True)
-        output = stdout.read().decode("utf-8")
-        err = stderr.read().decode("utf-8")
-        exit_code = stdout.channel.recv_exit_status()
+        log_output(f"Connecting to {host} with key {ssh_key}", logger)
+        exit_code, output, err = SESSION_POOL.run(command, host, username, port, ssh_key, get_pty=True)
         log_output(f"Running command: {command}, stdout: {output}, stderr: {err}, exit_code: {exit_code}", logger)
-        ssh.close()
-        return exit_code == 0, exit_code, output, stderr
+        return exit_code == 0, exit_code, output, err
     except Exception as e:  # pylint: disable=broad-except
         log_output(f"Error running ssh command: {e}", logger)
         return False, None, None, None
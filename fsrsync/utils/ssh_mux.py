@@ -0,0 +1,195 @@
+"""OpenSSH ControlMaster connections shared by rsync and the remote hooks of a destination"""
+import os
+import time
+import shlex
+import hashlib
+import threading
+import subprocess
+from .logs import Logger
+from .utils import run_process
+from .constants import (
+    SSH_CONTROL_DIR,
+    SSH_MASTER_START_TIMEOUT,
+    SSH_MASTER_CHECK_INTERVAL,
+    SSH_MASTER_RETRY_INTERVAL,
+    SSH_SERVER_ALIVE_INTERVAL,
+)
+
+
+class SshMaster:
+    """A persistent OpenSSH master connection to a destination, owned by fsrsync
+
+    The master runs as a child process (ssh -M -N) listening on a control
+    socket. Clients connect through the socket with ControlMaster=no, so an
+    rsync or a remote command only opens a channel on the established
+    connection instead of doing a handshake. When the master is down the
+    clients fall back to connecting on their own, the master is checked with
+    ssh -O check before use and restarted when it died.
+    """
+
+    def __init__(self, destination, ssh_key=None, ssh_port=None, control_dir=SSH_CONTROL_DIR):
+        """Initialize the master, it is started on first use by ensure
+
+        :param destination: user@host to connect to
+        :type destination: str
+        :param ssh_key: Private key to authenticate with
+        :type ssh_key: str, optional
+        :param ssh_port: Port of the SSH server
+        :type ssh_port: int, optional
+        :param control_dir: Directory of the control sockets
+        :type control_dir: str
+        """
+        self.destination = destination
+        self.ssh_key = ssh_key
+        self.ssh_port = ssh_port
+        self.control_dir = control_dir
+        # Hashed to stay far below the 108 byte limit of a unix socket path
+        name = hashlib.blake2b(
+            f"{destination}:{ssh_port}:{ssh_key}".encode("utf-8"), digest_size=8
+        ).hexdigest()
+        self.control_path = os.path.join(control_dir, f"{name}.sock")
+        self.process = None
+        self.last_check = 0
+        self.last_start = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+        self.logger = Logger()
+
+    def connection_options(self):
+        """Return the ssh options selecting the user's key and port"""
+        options = []
+        if self.ssh_key:
+            options += ["-i", self.ssh_key]
+        if self.ssh_port:
+            options += ["-p", str(self.ssh_port)]
+        return options
+
+    def client_options(self):
+        """Return the ssh options of a client going through the master"""
+        return ["-o", f"ControlPath={self.control_path}", "-o", "ControlMaster=no"]
+
+    def ssh_command(self):
+        """Return the remote shell rsync connects with, as a string for -e"""
+        command = ["ssh"] + self.connection_options() + self.client_options()
+        return " ".join(shlex.quote(part) for part in command)
+
+    def is_running(self):
+        """Check if the master process is alive"""
+        return self.process is not None and self.process.poll() is None
+
+    def check(self):
+        """Ask the master if it still serves its control socket"""
+        started, exit_code, _, _ = run_process(
+            ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "check", self.destination],
+            timeout=SSH_MASTER_START_TIMEOUT,
+        )
+        return started and exit_code == 0
+
+    def start(self):
+        """Start the master and wait until its control socket answers, return True once it does"""
+        self.last_start = time.time()
+        try:
+            os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+            if os.path.exists(self.control_path):
+                os.unlink(self.control_path)  # Left behind by a master that was killed
+            self.process = subprocess.Popen(
+                ["ssh", "-M", "-N"] + self.connection_options() + [
+                    "-o", f"ControlPath={self.control_path}",
+                    "-o", "ControlPersist=no",
+                    "-o", "BatchMode=yes",
+                    "-o", f"ServerAliveInterval={SSH_SERVER_ALIVE_INTERVAL}",
+                    "-o", "ServerAliveCountMax=3",
+                    "-o", "LogLevel=ERROR",
+                    self.destination,
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            self.logger.error(f"Could not start SSH master for {self.destination}: {e}")
+            self.process = None
+            return False
+        while time.time() - self.last_start < SSH_MASTER_START_TIMEOUT:
+            if self.process.poll() is not None:
+                error = self.process.stderr.read().decode("utf-8", "replace").strip()
+                self.logger.error(
+                    f"SSH master for {self.destination} exited with code {self.process.returncode}: {error}"
+                )
+                self.process = None
+                return False
+            if os.path.exists(self.control_path) and self.check():
+                self.last_check = time.time()
+                self.logger.info(
+                    f"SSH master for {self.destination} started in {self.last_check - self.last_start:.2f}s"
+                )
+                return True
+            time.sleep(0.05)
+        self.logger.error(f"SSH master for {self.destination} did not start in {SSH_MASTER_START_TIMEOUT}s")
+        self.stop()
+        return False
+
+    def ensure(self):
+        """Make sure the master is up, restarting it if it died
+
+        A running master is checked at most every SSH_MASTER_CHECK_INTERVAL
+        seconds, a master that failed to start is retried after
+        SSH_MASTER_RETRY_INTERVAL seconds, clients connect directly meanwhile.
+
+        :return: True if clients go through the master
+        :rtype: bool
+        """
+        with self.lock:
+            now = time.time()
+            if self.is_running():
+                if now - self.last_check < SSH_MASTER_CHECK_INTERVAL:
+                    return True
+                if self.check():
+                    self.last_check = now
+                    return True
+                self.logger.warning(f"SSH master for {self.destination} stopped answering, restarting it...")
+                self.stop()
+            elif self.process is not None:
+                self.logger.warning(
+                    f"SSH master for {self.destination} exited with code {self.process.returncode}, restarting it..."
+                )
+                self.process = None
+            elif self.last_start and now - self.last_start < SSH_MASTER_RETRY_INTERVAL:
+                return False
+            if self.last_start:
+                self.restarts += 1
+            return self.start()
+
+    def run_command(self, command, get_pty=False):
+        """Run a command on the destination through the master
+
+        :param command: Shell command run by the remote user's shell
+        :type command: str
+        :param get_pty: Run the command on a PTY, its stderr then comes on stdout
+        :type get_pty: bool
+        :return: (success, exit code, stdout, stderr)
+        :rtype: tuple
+        """
+        started, exit_code, stdout, stderr = run_process(
+            ["ssh"] + self.connection_options() + self.client_options()
+            + ["-tt" if get_pty else "-T", self.destination, command]
+        )
+        return started and exit_code == 0, exit_code, stdout, stderr
+
+    def stop(self):
+        """Stop the master and remove its control socket"""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=SSH_MASTER_START_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stderr.close()
+        self.process = None
+        try:
+            os.unlink(self.control_path)
+        except OSError:
+            pass
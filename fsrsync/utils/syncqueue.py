@@ -0,0 +1,349 @@
+"""Pending files of a single destination"""
+import time
+import itertools
+from inotify_simple import flags
+from .logs import Logger
+from .pathindex import PathIndex
+from .debounce import DebounceScheduler
+from .journal import IMMEDIATE, REGULAR
+from .utils import normalize_path, file_extension
+from .constants import (
+    DEBOUNCE_QUIET_PERIOD,
+    DEBOUNCE_MAX_STALENESS,
+    SYNC_RETRY_LIMIT,
+    SYNC_RETRY_BACKOFF,
+    SYNC_RETRY_MAX_BACKOFF,
+)
+
+
+# Order in which paths were first queued, shared by all queues
+FILE_SEQUENCE = itertools.count()
+
+
+class File:
+    """Pending entry for a path in the sync and locked files queues"""
+
+    __slots__ = ("path", "extension", "event_mask", "start_time", "last_seen", "seq",
+                 "synced_successfully", "synced_time", "attempts", "retry_at")
+
+    def __init__(self, path, event_mask=0, now=None):
+        """Initialize the file with a path
+
+        :param path: Path of the file, a directory if event_mask has IN_ISDIR
+        :type path: str
+        :param event_mask: Inotify flags of the change queued for the path, defaults to 0
+        :type event_mask: int, optional
+        :param now: Time the change was seen, defaults to the current time
+        :type now: float, optional
+        """
+        self.path = normalize_path(path, event_mask & flags.ISDIR)
+        self.extension = file_extension(self.path)
+        self.event_mask = event_mask
+        self.start_time = self.last_seen = now or time.time()
+        self.seq = next(FILE_SEQUENCE)
+        self.synced_successfully = False
+        self.synced_time = None
+        self.attempts = 0  # Failed syncs so far
+        self.retry_at = 0  # Time the next sync may be tried after a failed one
+
+    @property
+    def is_dir(self):
+        """Check if the entry is a directory"""
+        return self.path.endswith("/")
+
+    def touch(self, event_mask=0, now=None):
+        """Record another change to an already queued path"""
+        self.event_mask |= event_mask
+        self.last_seen = now or time.time()
+
+    def how_long_locked(self):
+        """Return the time in seconds since the file was locked"""
+        return time.time() - self.start_time
+
+    def to_dict(self):
+        """Return the entry as JSON-serializable data for the control server, a slotted File has no __dict__"""
+        return {
+            "path": self.path,
+            "extension": self.extension,
+            "event_mask": self.event_mask,
+            "start_time": self.start_time,
+            "last_seen": self.last_seen,
+            "synced_successfully": self.synced_successfully,
+            "synced_time": self.synced_time,
+            "attempts": self.attempts,
+            "retry_at": self.retry_at,
+        }
+
+    def __str__(self):
+        return f"File(path={self.path})"
+
+
+class SyncQueue:
+    """Immediate and regular sync queues of one destination
+
+    FilesystemMonitor routes every change to the queues of the destinations
+    whose path covers it, so a destination only ever looks at its own files.
+    Each queue debounces its files on its own, a sync of one destination
+    doesn't touch the files pending for another.
+
+    With a journal, every path entering or leaving the queues is recorded
+    under the destination name so the queues survive a restart.
+    """
+
+    def __init__(self, root, ignore=None, quiet_period=DEBOUNCE_QUIET_PERIOD,
+                 max_staleness=DEBOUNCE_MAX_STALENESS, journal=None, name=None):
+        """Initialize the queues of a destination
+
+        :param root: Source path of the destination
+        :type root: str
+        :param ignore: Ignore rules of the destination, ignored paths are never queued
+        :type ignore: IgnoreMatcher, optional
+        :param quiet_period: Seconds without changes before a queued file is eligible for sync
+        :type quiet_period: int
+        :param max_staleness: Seconds after which a file that keeps changing is eligible anyway
+        :type max_staleness: int
+        :param journal: Journal recording queued and synced paths, defaults to None
+        :type journal: Journal, optional
+        :param name: Name of the destination in the journal
+        :type name: str, optional
+        """
+        self.root = root.rstrip("/") + "/"
+        self.ignore = ignore
+        self.immediate_sync = PathIndex()  # Track files that need immediate sync (path -> File)
+        self.regular_sync = PathIndex()  # Track files that need regular sync (path -> File)
+        self.debounce = DebounceScheduler(quiet_period, max_staleness)  # Sync eligibility of queued files
+        self.journal = journal
+        self.name = name or self.root
+        self.logger = Logger()
+
+    def journal_enqueue(self, queue, path):
+        """Record a path entering a queue"""
+        if self.journal is not None:
+            self.journal.enqueue(self.name, path, IMMEDIATE if queue is self.immediate_sync else REGULAR)
+
+    def journal_ack(self, path):
+        """Record a path leaving the queues"""
+        if self.journal is not None:
+            self.journal.ack(self.name, path)
+
+    def restore(self, pending):
+        """Queue the paths replayed from the journal, return the number queued
+
+        :param pending: Kind of queue of every pending path
+        :type pending: dict
+        """
+        restored = 0
+        for path, kind in pending.items():
+            if not self.accepts(path):
+                # Ignore rules changed since the path was queued
+                self.journal_ack(path)
+                continue
+            queue = self.immediate_sync if kind == IMMEDIATE else self.regular_sync
+            file = File(path, flags.ISDIR if path.endswith("/") else 0)
+            if file.path in self.immediate_sync or file.path in self.regular_sync:
+                continue
+            queue[file.path] = file
+            self.debounce.schedule(file)
+            restored += 1
+        return restored
+
+    def accepts(self, path):
+        """Check if path is below the root and not ignored"""
+        return path.startswith(self.root) and not (self.ignore and self.ignore.matches(path))
+
+    def apply(self, path, event_mask, immediate):
+        """Queue a change to path for immediate or regular sync, a path is never in both queues"""
+        if immediate:
+            queued = self.regular_sync.pop(path)
+            if queued is not None:
+                # Keep the first-seen time so a file that keeps changing still reaches max_staleness
+                queued.touch(event_mask)
+                self.immediate_sync[path] = queued
+                self.journal_enqueue(self.immediate_sync, path)
+                self.debounce.schedule(queued)
+            else:
+                self.queue_path(self.immediate_sync, path, event_mask)
+        elif path not in self.immediate_sync:
+            self.queue_path(self.regular_sync, path, event_mask)
+
+    def move_files(self, src, dst):
+        """Re-key files queued at or below src to dst
+
+        Files moved out of the root or onto ignored paths are dropped, the
+        rename itself syncs their old paths.
+        """
+        src_prefix = src.rstrip("/")
+        dst_prefix = dst.rstrip("/")
+        for queue in (self.immediate_sync, self.regular_sync):
+            for file in queue.remove_under(src):
+                self.debounce.discard(file.path)
+                self.journal_ack(file.path)
+                file.path = normalize_path(dst_prefix + file.path[len(src_prefix):], file.is_dir)
+                if not self.accepts(file.path):
+                    continue
+                file.extension = file_extension(file.path)
+                queue[file.path] = file
+                self.journal_enqueue(queue, file.path)
+                self.debounce.schedule(file)
+
+    def queue_path(self, queue, path, event_mask):
+        """Queue a normalized path, only allocating a File if it isn't queued yet"""
+        queued = queue.get(path)
+        added = queued is None
+        if added:
+            queued = queue[path] = File(path, event_mask)
+            self.journal_enqueue(queue, path)
+        else:
+            queued.touch(event_mask)
+        self.debounce.schedule(queued)
+        return added
+
+    def add_to_queue(self, queue, file):
+        """Add file to a queue unless its path is already queued, return True if added"""
+        queued = queue.get(file.path)
+        added = queued is None
+        if added:
+            queued = queue[file.path] = file
+            self.journal_enqueue(queue, file.path)
+        else:
+            queued.touch(file.event_mask, file.last_seen)
+        self.debounce.schedule(queued)
+        return added
+
+    def queued_before(self, delete_up_to_time):
+        """Return a predicate matching files queued before delete_up_to_time, None matches all"""
+        if delete_up_to_time is None:
+            return None
+        # Files changed since, or still in their quiet period, were not part of the sync
+        return lambda f: f.last_seen < delete_up_to_time and self.debounce.is_ready(f.path)
+
+    def delete_from_queue(self, queue, path, delete_up_to_time=None):
+        """Delete a path from a queue, optionally only if not changed since delete_up_to_time"""
+        f = queue.get(path)
+        if f is None:
+            return False
+        if delete_up_to_time is not None and f.last_seen >= delete_up_to_time:
+            return False
+        del queue[path]
+        self.forget_unqueued(path)
+        return True
+
+    def forget_unqueued(self, path):
+        """Stop debouncing and journaling a path once it left both sync queues"""
+        if path not in self.immediate_sync and path not in self.regular_sync:
+            self.debounce.discard(path)
+            self.journal_ack(path)
+
+    def requeue(self, file, backoff=SYNC_RETRY_BACKOFF, limit=SYNC_RETRY_LIMIT, now=None):
+        """Hold back a file whose sync failed until its next retry
+
+        The file stays queued and becomes eligible for sync again after
+        backoff seconds, doubled at each failure up to SYNC_RETRY_MAX_BACKOFF.
+
+        :return: False if the file failed more than limit times, it is left queued and not held back
+        :rtype: bool
+        """
+        file.attempts += 1
+        if file.attempts > limit:
+            return False
+        delay = min(backoff * 2 ** (file.attempts - 1), SYNC_RETRY_MAX_BACKOFF)
+        file.retry_at = (now or time.time()) + delay
+        if file.path in self.immediate_sync or file.path in self.regular_sync:
+            self.debounce.schedule(file)
+        return True
+
+    def promote_quiet_files(self):
+        """Advance the debounce timer, return the number of files that became eligible for sync"""
+        return self.debounce.advance()
+
+    def get_ready_files(self, queue, path_filter=None):
+        """Return files of a queue that are eligible for sync"""
+        paths = self.debounce.ready.keys_under(path_filter) if path_filter else self.debounce.ready
+        return [queue[path] for path in paths if path in queue]
+
+    def count_ready_sync_files(self, path_filter=None):
+        """Return the number of queued files eligible for sync"""
+        if path_filter:
+            return self.debounce.ready.count_under(path_filter)
+        return len(self.debounce.ready)
+
+    def count_ready_immediate_sync_files(self):
+        """Return the number of files in immediate sync eligible for sync"""
+        return sum(1 for path in self.debounce.ready if path in self.immediate_sync)
+
+    def add_immediate_sync_file(self, file):
+        """Add file to immediate sync"""
+        if not self.add_to_queue(self.immediate_sync, file):
+            self.logger.debug(f"File {file} already in immediate sync")
+            return
+        self.logger.debug(f"File {file} added to immediate sync")
+
+    def add_regular_sync_file(self, file):
+        """Add file to regular sync"""
+        if not self.add_to_queue(self.regular_sync, file):
+            self.logger.debug(f"File {file} already in regular sync")
+            return
+        self.logger.debug(f"File {file} added to regular sync")
+
+    def get_immediate_sync_files(self, path_filter=None, ready_only=False):
+        """Return files that need immediate sync, only those out of their quiet period if ready_only"""
+        if ready_only:
+            return self.get_ready_files(self.immediate_sync, path_filter)
+        if path_filter:
+            return self.immediate_sync.values_under(path_filter)
+        return list(self.immediate_sync.values())
+
+    def get_regular_sync_files(self, path_filter=None, ready_only=False):
+        """Return files that need regular sync, only those out of their quiet period if ready_only"""
+        if ready_only:
+            return self.get_ready_files(self.regular_sync, path_filter)
+        if path_filter:
+            return self.regular_sync.values_under(path_filter)
+        return list(self.regular_sync.values())
+
+    def count_immediate_sync_files(self, path_filter=None):
+        """Return the number of files that need immediate sync"""
+        if path_filter:
+            return self.immediate_sync.count_under(path_filter)
+        return len(self.immediate_sync)
+
+    def count_regular_sync_files(self, path_filter=None):
+        """Return the number of files that need regular sync"""
+        if path_filter:
+            return self.regular_sync.count_under(path_filter)
+        return len(self.regular_sync)
+
+    def delete_immediate_sync_file(self, path, delete_up_to_time=None):
+        """Delete file from immediate sync"""
+        self.delete_from_queue(self.immediate_sync, path, delete_up_to_time)
+        self.logger.debug(f"File {path} removed from immediate sync")
+
+    def delete_regular_sync_file(self, path, delete_up_to_time=None):
+        """Delete file from regular sync"""
+        self.delete_from_queue(self.regular_sync, path, delete_up_to_time)
+        self.logger.debug(f"File {path} removed from regular sync")
+
+    def delete_immediate_sync_files_for_path(self, path=None, delete_up_to_time=None):
+        """Delete files that need immediate sync in a given path, the whole queue by default"""
+        for file in self.immediate_sync.remove_under(path or self.root, self.queued_before(delete_up_to_time)):
+            self.forget_unqueued(file.path)
+        self.logger.debug(f"Files in {path or self.root} removed from immediate sync")
+
+    def delete_regular_sync_files_for_path(self, path=None, delete_up_to_time=None):
+        """Delete files that need regular sync in a given path, the whole queue by default"""
+        for file in self.regular_sync.remove_under(path or self.root, self.queued_before(delete_up_to_time)):
+            self.forget_unqueued(file.path)
+        self.logger.debug(f"Files in {path or self.root} removed from regular sync")
+
+    def delete_fs_event_for_path(self, path):
+        """Delete filesystem events for a given path"""
+        self.delete_regular_sync_files_for_path(path)
+        self.delete_immediate_sync_files_for_path(path)
+
+    def clear(self):
+        """Clear all files that need sync"""
+        self.immediate_sync.clear()
+        self.regular_sync.clear()
+        self.debounce.clear()
+        if self.journal is not None:
+            self.journal.clear(self.name)
@@ -1,8 +1,9 @@
 import os
+import sys
 import subprocess
-import psutil
 
 from .logs import Logger
+from .openfiles import OpenFileIndex
 
 
 def run_command(command, **kwargs):
@@ -27,6 +28,31 @@ def run_command(command, **kwargs):
         return False, None, str(e), None
 
 
+def run_process(args, input_data=None, timeout=None):
+    """
+    Run a command given as an argument list, without a shell.
+
+    :param args: The program and its arguments.
+    :param input_data: Bytes written to the standard input. Defaults to None.
+    :param timeout: Seconds after which the process is killed. Defaults to None.
+    :return: Tuple of (started, return code, stdout, stderr).
+    """
+    logger = Logger()
+    try:
+        # Without input the process gets an empty stdin rather than ours
+        stdin = subprocess.DEVNULL if input_data is None else None
+        result = subprocess.run(args, input=input_data, stdin=stdin, capture_output=True, check=False,
+                                timeout=timeout)
+        return (True, result.returncode,
+                result.stdout.decode("utf-8", "replace"), result.stderr.decode("utf-8", "replace"))
+    except subprocess.TimeoutExpired as e:
+        logger.error(f"Command {args[0]} timed out after {timeout}s")
+        return False, None, str(e), None
+    except (OSError, ValueError) as e:
+        logger.error(f"Command {args[0]} failed with error: {e}")
+        return False, None, str(e), None
+
+
 def pipe_processes(read_process, write_process, input_file=None, output_file=None):
     """
     Pipe output from one process to another.
@@ -88,27 +114,41 @@ def validate_path(path):
         return False
 
 
-def is_file_open(file_path):
+def is_file_open(file_path, for_write=False):
     """Check if a file is open by any process.
 
+    Answered from the shared OpenFileIndex, which scans /proc at most once per tick.
+
     :param file_path: The path to the file
     :type file_path: str
+    :param for_write: Only count processes that opened the file for writing, defaults to False
+    :type for_write: bool, optional
     :return: True if file is open, False otherwise
     :rtype: bool
     """
-    try:
-        for proc in psutil.process_iter(['pid', 'open_files']):
-            try:
-                if any(f.path == file_path for f in proc.info['open_files'] or []):
-                    return True
-            except (psutil.AccessDenied, psutil.NoSuchProcess):
-                pass  # Ignore processes that cannot be accessed or no longer exist
-            except Exception as e:
-                print(f"Unexpected error while checking process {proc.pid}: {e}")
-    except Exception as e:
-        print(f"Error while iterating processes: {e}")
+    return OpenFileIndex().is_open(file_path, for_write=for_write)
+
 
-    return False  # File not open
+def normalize_path(path, is_dir=False):
+    """Fix path slashes like fix_path_slashes, without a stat call
+
+    The caller says whether path is a directory (e.g. from IN_ISDIR). The result
+    is interned so every queue holding the same path shares one string.
+    """
+    if "//" in path:
+        path = path.replace("//", "/")
+    path = path.rstrip("/")
+    if is_dir or not path:
+        path += "/"
+    return sys.intern(path)
+
+
+def file_extension(path):
+    """Return the extension of the last path component, None if it has none"""
+    name = path.rpartition("/")[2]
+    if "." not in name:
+        return None
+    return sys.intern(name.rpartition(".")[2])
 
 
 def fix_path_slashes(path):
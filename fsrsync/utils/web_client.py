@@ -67,6 +67,14 @@ class WebClient:
         """Add files to the locked files"""
         return self.post("/add_file_to_locked_files", {"files": files})
 
+    def get_directory_digests(self, root, path, patterns=None, extensions=None, scope=None):
+        """Get the Merkle digests of the entries of a directory below root, cached within scope"""
+        return self.post("/directory_digests", {"root": root,
+                                                "path": path,
+                                                "patterns": patterns or [],
+                                                "extensions": extensions or [],
+                                                "scope": scope})
+
     def delete_file_pending_for_path(self, path):
         """Delete a file pending for a path"""
         return self.post("/delete_file_pending_for_path", {"path": path})
@@ -3,6 +3,7 @@ import uvicorn
 import threading
 from fastapi import FastAPI, Request, HTTPException, Form
 from fastapi.responses import HTMLResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.templating import Jinja2Templates
 
 
@@ -88,7 +89,7 @@ class WebControl:
         instance = WebControl._instance
         if not instance.check_if_secret_in_header(request.headers):
             raise HTTPException(status_code=401, detail="Unauthorized")
-        return instance.sync_state.fs_monitor.get_regular_sync_files()
+        return [file.to_dict() for file in instance.sync_state.fs_monitor.get_regular_sync_files()]
 
     @app.get("/immediate_pending")
     async def immediate_pending(request: Request):  # pylint: disable=no-self-argument
@@ -96,7 +97,7 @@ class WebControl:
         instance = WebControl._instance
         if not instance.check_if_secret_in_header(request.headers):
             raise HTTPException(status_code=401, detail="Unauthorized")
-        return instance.sync_state.fs_monitor.get_immediate_sync_files()
+        return [file.to_dict() for file in instance.sync_state.fs_monitor.get_immediate_sync_files()]
 
     @app.post("/delete_file_pending_for_path")
     async def delete_file_pending_for_path(request: Request):  # pylint: disable=no-self-argument
@@ -109,13 +110,32 @@ class WebControl:
         result = instance.sync_state.fs_monitor.delete_fs_event_for_path(path)
         return {"status": result}
 
+    @app.post("/directory_digests")
+    async def directory_digests(request: Request):  # pylint: disable=no-self-argument
+        """Get the Merkle digests of the entries of a directory"""
+        instance = WebControl._instance
+        if not instance.check_if_secret_in_header(request.headers):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        request_body = await request.json()
+        root = request_body.get("root", "")
+        path = request_body.get("path", root)
+        # Walking the tree blocks, keep it off the event loop
+        return await run_in_threadpool(
+            instance.sync_state.get_directory_digests,
+            root,
+            path,
+            request_body.get("patterns", []),
+            request_body.get("extensions", []),
+            request_body.get("scope"),
+        )
+
     @app.get("/locked_files")
     async def locked_files(request: Request):  # pylint: disable=no-self-argument
         """Get locked files"""
         instance = WebControl._instance
         if not instance.check_if_secret_in_header(request.headers):
             raise HTTPException(status_code=401, detail="Unauthorized")
-        return instance.sync_state.fs_monitor.get_locked_files()
+        return [file.to_dict() for file in instance.sync_state.fs_monitor.get_locked_files()]
 
     @app.get("/dashboard", response_class=HTMLResponse)
     async def dashboard(request: Request):  # pylint: disable=no-self-argument
@@ -159,6 +179,7 @@ class WebControl:
                 "destination": destination.get("path", ""),
                 "statistics": destination.get("statistics", {}),
             })
+        return {"result": result}
 
     @app.get("/stats-running")
     async def stats_running(request: Request):
@@ -183,6 +204,7 @@ class WebControl:
         maxstats = instance.sync_state.max_stats
         fse = instance.sync_state.full_sync
         aggregate_cel = instance.sync_state.fs_monitor.get_aggregated_events()
+        monitor_metrics = instance.sync_state.fs_monitor.get_metrics()
         return {
             "result": result,
             "remote_hosts": rh,
@@ -193,6 +215,7 @@ class WebControl:
             "max_stats": maxstats,
             "full_sync": fse,
             "aggregated_events": aggregate_cel,
+            "monitor_metrics": monitor_metrics,
         }
         
 